@@ -0,0 +1,488 @@
+import datetime
+import functools
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+#############################################################################################################
+# The storage backends of the database layer.
+#
+# A backend provides the connection pool the Database class checks connections out of, and the parts of the
+# SQL that differ between database engines (the dialect) - everything else the database layer and the
+# models write is plain SQL that every backend runs as is. The backend is selected by the 'backend' key of
+# the db_config:
+#   'mysql' (the default) - a MySQL server, reached through mysql.connector; the db_config holds the host,
+#                           port, username, password and db_name keys (and the pool keys of ConnectionPool)
+#   'sqlite' - an embedded SQLite database file, in the process itself; the db_config holds its path (and
+#              optionally pool_size and pool_timeout). A path starting with 'file:' is opened as a URI.
+#
+# The drivers are imported on first use, so a process only needs the driver of the backend it uses.
+#############################################################################################################
+
+MYSQL = 'mysql'
+SQLITE = 'sqlite'
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+#############################################################################################################
+# A function to get the shared backend for a database configuration, creating it on first use. Like the
+# connection pools, backends are keyed by the process id as well.
+#############################################################################################################
+
+def backend_for_config(db_config):
+    name = db_config.get('backend', MYSQL)
+
+    if (name == MYSQL):
+        key = (os.getpid(), MYSQL, db_config['host'], db_config['port'], db_config['username'], db_config['db_name'],
+               db_config.get('allow_local_infile', False))
+    elif (name == SQLITE):
+        key = (os.getpid(), SQLITE, db_config['path'])
+    else:
+        raise ValueError(f'Unknown database backend {name}')
+
+    with _backends_lock:
+        backend = _backends.get(key)
+        if (backend is None):
+            backend = MySQLBackend(db_config) if name == MYSQL else SQLiteBackend(db_config)
+            _backends[key] = backend
+
+    return backend
+
+#############################################################################################################
+# The MySQL backend - the ConnectionPool of connection_pool.py, and the MySQL dialect.
+#############################################################################################################
+
+class MySQLBackend:
+    name = MYSQL
+    supports_load_data_file = True
+    supports_partitioning = True
+    max_parameters = None
+
+    def __init__(self, db_config):
+        from connection_pool import ConnectionPool
+
+        self._db_config = db_config
+        self.pool = ConnectionPool.for_config(db_config)
+
+    def insert_ignore(self, table, column_names):
+        return f"INSERT IGNORE INTO {table} ({column_names})"
+
+    def upsert_clause(self, update_columns):
+        return " ON DUPLICATE KEY UPDATE " + ",".join([f"{column_name}=VALUES({column_name})" for column_name in update_columns])
+
+    def upsert_newer_clause(self, table, update_columns, newer_column):
+        # The assignments run in order - the newer_column one goes last, so the others still compare its old value.
+        # The columns are qualified, as an INSERT ... SELECT may read a table with the same column names.
+
+        update_columns = [column_name for column_name in update_columns if column_name != newer_column] + [newer_column]
+        return " ON DUPLICATE KEY UPDATE " + ",".join([f"{table}.{column_name}=IF(VALUES({newer_column}) > {table}.{newer_column}, "
+                                                       f"VALUES({column_name}), {table}.{column_name})" for column_name in update_columns])
+
+    def date_expression(self, column):
+        return f"DATE({column})"
+
+    def hour_start_expression(self, column):
+        return f"DATE({column}) + INTERVAL HOUR({column}) HOUR"
+
+    def week_start_expression(self, column):
+        return f"DATE({column}) - INTERVAL WEEKDAY({column}) DAY"
+
+    def month_start_expression(self, column):
+        return f"DATE({column}) - INTERVAL (DAYOFMONTH({column}) - 1) DAY"
+
+    def epoch_seconds_expression(self, column):
+        return f"TIMESTAMPDIFF(SECOND, '1970-01-01', {column})"
+
+    def scaled_integer_expression(self, column, digits):
+        return f"CAST({column} * {10 ** digits} AS SIGNED)"
+
+    def float_expression(self, column):
+        return f"{column} * 1e0"
+
+#############################################################################################################
+# A function to tell whether an error is transient - one that the same statements can be retried after:
+# a deadlock, a lock wait timeout, a lost connection, or no free connection in the pool.
+#############################################################################################################
+
+    TRANSIENT_ERRNOS = (1205, 1213, 2006, 2013)
+
+    def is_transient_error(self, error):
+        import mysql.connector
+
+        if (isinstance(error, mysql.connector.errors.PoolError)):
+            return True
+
+        return getattr(error, 'errno', None) in MySQLBackend.TRANSIENT_ERRNOS
+
+#############################################################################################################
+# Functions for schema management: whether a table has an index on exactly the given columns (optionally a
+# unique one), the partitions of a table, the EXPLAIN statement of a query and the tables its plan reads with
+# a full scan, and the creation of the (empty) database itself.
+#
+# The partitions are (name, upper bound, approximate row count) tuples, in order - the upper bound is the
+# (exclusive) datetime of a RANGE COLUMNS partition, None for the MAXVALUE one. An unpartitioned table has none.
+#############################################################################################################
+
+    def has_index(self, db, table, columns, unique=False):
+        rows = db.run_query('SELECT index_name, non_unique, column_name FROM information_schema.statistics '
+                            'WHERE table_schema = DATABASE() AND table_name = %s ORDER BY index_name, seq_in_index',
+                            (table,))
+
+        indexes = {}
+        for index_name, non_unique, column_name in rows:
+            index = indexes.setdefault(index_name, {'unique': not non_unique, 'columns': []})
+            index['columns'].append(column_name)
+
+        return any(index['columns'] == columns and (index['unique'] or not unique) for index in indexes.values())
+
+    def list_partitions(self, db, table):
+        rows = db.run_query('SELECT partition_name, partition_description, table_rows FROM information_schema.partitions '
+                            'WHERE table_schema = DATABASE() AND table_name = %s AND partition_name IS NOT NULL '
+                            'ORDER BY partition_ordinal_position', (table,))
+
+        partitions = []
+        for partition_name, description, table_rows in rows:
+            bound = None if description == 'MAXVALUE' else datetime.datetime.fromisoformat(description.strip("'"))
+            partitions.append((partition_name, bound, table_rows))
+
+        return partitions
+
+    def explain(self, sql):
+        return f'EXPLAIN {sql}'
+
+    def full_scans(self, plan):
+        return [step.get('table') for step in plan
+                if step.get('type') == 'ALL' and step.get('select_type') != 'INSERT']
+
+    def create_database(self, drop_existing=False):
+        import mysql.connector
+
+        self.pool.close_all()
+
+        db_handle = mysql.connector.connect(
+                user=self._db_config['username'],
+                password=self._db_config['password'],
+                host=self._db_config['host'],
+                port=self._db_config['port'],
+            )
+        cursor = db_handle.cursor()
+
+        if (drop_existing):
+            cursor.execute(f'DROP DATABASE IF EXISTS {self._db_config["db_name"]}')
+        cursor.execute(f'CREATE DATABASE IF NOT EXISTS {self._db_config["db_name"]}')
+
+        cursor.close()
+        db_handle.close()
+
+#############################################################################################################
+# The SQLite backend - a pool of connections to the database file, and the SQLite dialect.
+#
+# The database runs in WAL mode, so readers never block the writer (or each other), with synchronous=NORMAL -
+# a commit is durable once the WAL is checkpointed, and a crash cannot corrupt the file. Foreign keys are
+# enforced, as on MySQL.
+#
+# Values are converted the way mysql.connector converts them: the DATETIME columns come back as datetime
+# objects, and the DECIMAL columns as Decimals - though SQLite stores them as binary floating point, so sums
+# and averages computed inside SQLite may differ from MySQL's in the last digit (the Python aggregation
+# engine gives the same reports on both backends). Dates and timestamps computed by an expression (a
+# date_expression, say) come back as datetime objects too.
+#############################################################################################################
+
+class SQLiteBackend:
+    name = SQLITE
+    supports_load_data_file = False
+    supports_partitioning = False
+    max_parameters = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+
+    def __init__(self, db_config):
+        self._db_config = db_config
+        self.pool = SQLitePool(db_config['path'],
+                               db_config.get('pool_size', SQLitePool.DEFAULT_POOL_SIZE),
+                               db_config.get('pool_timeout', SQLitePool.DEFAULT_TIMEOUT))
+
+    def insert_ignore(self, table, column_names):
+        return f"INSERT OR IGNORE INTO {table} ({column_names})"
+
+    def upsert_clause(self, update_columns):
+        return " ON CONFLICT DO UPDATE SET " + ",".join([f"{column_name}=excluded.{column_name}" for column_name in update_columns])
+
+    def upsert_newer_clause(self, table, update_columns, newer_column):
+        return (" ON CONFLICT DO UPDATE SET " + ",".join([f"{column_name}=excluded.{column_name}" for column_name in update_columns]) + 
+                f" WHERE excluded.{newer_column} > {table}.{newer_column}")
+
+    def date_expression(self, column):
+        return f"datetime(date({column}))"
+
+    def hour_start_expression(self, column):
+        return f"strftime('%Y-%m-%d %H:00:00', {column})"
+
+    def week_start_expression(self, column):
+        return f"datetime(date({column}, '-' || ((CAST(strftime('%w', {column}) AS INTEGER) + 6) % 7) || ' days'))"
+
+    def month_start_expression(self, column):
+        return f"datetime(date({column}, 'start of month'))"
+
+    def epoch_seconds_expression(self, column):
+        return f"CAST(round((julianday({column}) - 2440587.5) * 86400) AS INTEGER)"
+
+    def scaled_integer_expression(self, column, digits):
+        return f"CAST(round({column} * {10 ** digits}) AS INTEGER)"
+
+    def float_expression(self, column):
+        return f"CAST({column} AS REAL)"
+
+    def is_transient_error(self, error):
+        # The database file is locked by another writer past the busy timeout, or the pool has no free connection
+
+        return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'No connection available' in str(error))
+
+    def has_index(self, db, table, columns, unique=False):
+        for _, index_name, is_unique, _, _ in db.run_query(f'PRAGMA index_list({table})'):
+            index_columns = [row[2] for row in db.run_query(f'PRAGMA index_info({index_name})')]
+            if (index_columns == columns and (is_unique or not unique)):
+                return True
+
+        return False
+
+    def list_partitions(self, db, table):
+        return []
+
+    def explain(self, sql):
+        return f'EXPLAIN QUERY PLAN {sql}'
+
+    def full_scans(self, plan):
+        scans = []
+        for step in plan:
+            detail = step.get('detail', '')
+            if (detail.startswith('SCAN ') and ' USING ' not in detail):
+                scans.append(detail.split()[1])
+
+        return scans
+
+    def create_database(self, drop_existing=False):
+        self.pool.close_all()
+
+        path = self._db_config['path']
+        if (drop_existing and not path.startswith('file:')):
+            for suffix in ('', '-wal', '-shm'):
+                if (os.path.exists(path + suffix)):
+                    os.remove(path + suffix)
+
+#############################################################################################################
+# The SQLite connection pool. It has the same interface as ConnectionPool (the parts the database layer
+# uses), and the same behaviour: up to pool_size connections, opened lazily and handed out one at a time.
+#############################################################################################################
+
+class SQLitePool:
+    DEFAULT_POOL_SIZE = 5
+    DEFAULT_TIMEOUT = 30
+
+    def __init__(self, path, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self._path = path
+        self._pool_size = pool_size
+        self._timeout = timeout
+
+        self._idle = []
+        self._created = 0
+        self._condition = threading.Condition()
+
+    @property
+    def pool_size(self):
+        return self._pool_size
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        except sqlite3.ProgrammingError:
+            self.release(connection, broken=True)
+            raise
+        except:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def acquire(self):
+        deadline = time.monotonic() + self._timeout
+
+        with self._condition:
+            while True:
+                if (self._idle):
+                    return self._idle.pop()
+
+                if (self._created < self._pool_size):
+                    self._created += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if (remaining <= 0):
+                    raise sqlite3.OperationalError(
+                        f'No connection available within {self._timeout} seconds (pool size {self._pool_size})')
+                self._condition.wait(remaining)
+
+        try:
+            return _SQLiteConnection(self._path, self._timeout)
+        except:
+            with self._condition:
+                self._created -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, connection, broken=False):
+        if (not broken):
+            try:
+                if (connection.in_transaction):
+                    connection.rollback()
+            except sqlite3.Error:
+                broken = True
+
+        with self._condition:
+            if (broken):
+                self._created -= 1
+            else:
+                self._idle.append(connection)
+            self._condition.notify()
+
+        if (broken):
+            connection.close()
+
+    def prepared_cursor(self, connection, sql):
+        # sqlite3 keeps its own cache of prepared statements per connection
+
+        return connection.cursor()
+
+    def close_all(self):
+        with self._condition:
+            idle = self._idle
+            self._idle = []
+            self._created -= len(idle)
+            self._condition.notify_all()
+
+        for connection in idle:
+            connection.close()
+
+#############################################################################################################
+# Wrappers that give sqlite3 connections and cursors the mysql.connector interface the database layer uses:
+# %s parameter markers, start_transaction, consume_results, column_names, and the cursor flags (buffered,
+# prepared) - which SQLite does not need, and ignores.
+#############################################################################################################
+
+class _SQLiteConnection:
+    STATEMENT_CACHE_SIZE = 256
+
+    def __init__(self, path, timeout):
+        self._connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False,
+                                           detect_types=sqlite3.PARSE_DECLTYPES, uri=path.startswith('file:'),
+                                           cached_statements=_SQLiteConnection.STATEMENT_CACHE_SIZE)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('PRAGMA foreign_keys=ON')
+
+    @property
+    def in_transaction(self):
+        return self._connection.in_transaction
+
+    def cursor(self, **kwargs):
+        return _SQLiteCursor(self._connection.cursor())
+
+    def start_transaction(self):
+        self._connection.execute('BEGIN IMMEDIATE')
+
+    def commit(self):
+        if (self._connection.in_transaction):
+            self._connection.execute('COMMIT')
+
+    def rollback(self):
+        if (self._connection.in_transaction):
+            self._connection.execute('ROLLBACK')
+
+    def consume_results(self):
+        pass
+
+    def ping(self):
+        self._connection.execute('SELECT 1')
+
+    def close(self):
+        self._connection.close()
+
+class _SQLiteCursor:
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._expression_columns = ()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def column_names(self):
+        return tuple(column[0] for column in self._cursor.description or ())
+
+    def execute(self, sql, val=()):
+        self._cursor.execute(_translate(sql), tuple(val))
+        self._expression_columns = tuple(index for index, column in enumerate(self._cursor.description or ())
+                                         if '(' in column[0])
+
+    def executemany(self, sql, multiple_data):
+        self._cursor.executemany(_translate(sql), multiple_data)
+        self._expression_columns = ()
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if (row is None or not self._expression_columns):
+            return row
+
+        return self._convert(row)
+
+    def fetchall(self):
+        return self._convert_rows(self._cursor.fetchall())
+
+    def fetchmany(self, size):
+        return self._convert_rows(self._cursor.fetchmany(size))
+
+    def close(self):
+        self._cursor.close()
+
+    def _convert_rows(self, rows):
+        if (not self._expression_columns):
+            return rows
+
+        return [self._convert(row) for row in rows]
+
+    def _convert(self, row):
+        row = list(row)
+        for index in self._expression_columns:
+            value = row[index]
+            if (isinstance(value, str) and _TIMESTAMP_PATTERN.match(value)):
+                row[index] = datetime.datetime.fromisoformat(value)
+
+        return tuple(row)
+
+_TIMESTAMP_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}( \d{2}:\d{2}:\d{2})?$')
+
+#############################################################################################################
+# A helper function that turns the %s parameter markers of an SQL text into SQLite's ? markers - leaving
+# string literals (which may hold strftime formats) alone. The SQL texts are cached, like the query builder's.
+#############################################################################################################
+
+@functools.lru_cache(maxsize=1024)
+def _translate(sql):
+    return re.sub(r"('(?:[^']|'')*')|%s", lambda match: match.group(1) or '?', sql)
+
+#############################################################################################################
+# The conversions of Python values to SQLite values and back, for the column types the schema uses.
+#############################################################################################################
+
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(sep=' '))
+sqlite3.register_adapter(datetime.date, lambda value: value.isoformat())
+sqlite3.register_converter('DATETIME', lambda value: datetime.datetime.fromisoformat(value.decode()))
+sqlite3.register_converter('DECIMAL', lambda value: Decimal(value.decode()))
@@ -0,0 +1,457 @@
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from backends import backend_for_config
+from cache import ReportCache
+from config import load_db_config
+from data_generator import generate_devices, generate_readings, load_rows, DEVICE_COLUMNS, WEATHER_DATA_COLUMNS
+from database import Database
+from instrumentation import Instrumentation, install
+from migrations import migrate
+from model import DeviceModel, WeatherDataModel, DailyReportModel
+from rows import DECODE_SCALED
+
+DEFAULT_SCALES = '1e4,1e5,1e6'
+DEFAULT_READINGS_PER_DEVICE = 1000
+DEFAULT_INTERVAL = 600
+DEFAULT_LOOKUPS = 1000
+DEFAULT_SINGLE_INSERTS = 1000
+DEFAULT_BATCH_INSERTS = 100000
+DEFAULT_THRESHOLD = 0.2
+DEFAULT_SEED = 1
+DEFAULT_STARTUP_RUNS = 10
+
+DATASET_START = datetime.datetime(2021, 12, 1)
+
+#######################################################################################
+# The benchmark suite.
+#
+# For each scale (a number of readings, 1e4 to 1e7), it builds a synthetic dataset -
+# scale / readings_per_device devices, each with a reading every interval seconds -
+# in a fresh database, and measures:
+#   load - bulk loading the dataset (data_generator.load_rows), readings/s
+#   ingest_single - WeatherDataModel.insert, one reading at a time: ops/s and latency
+#   ingest_batch - WeatherDataModel.insert_many, readings/s
+#   lookup - latency percentiles of the find_by_device_id* lookups, on random devices
+#            and timestamps
+#   range_scan - WeatherDataModel.iter_by_device_id over one day of a device, and
+#                find_all_chunked over the whole table: rows/s
+#   report_full - DailyReportModel.create_reports from scratch, per aggregation engine
+#   lookup (again) - find_by_device_id_and_date, without and with a ReportCache - every
+#                    lookup is made twice, so half of the cached ones are hits
+#   report_incremental - refresh_reports after late readings for 1% of the devices
+# and the peak memory of each phase: the peak resident size of the process, and - with
+# trace_memory - the peak of the Python heap during the phase (tracemalloc slows the
+# phase down, so its timings are then not comparable). With query_stats, the statements
+# of the whole run are instrumented (see instrumentation.py), and their statistics by
+# query shape and calling model method are added to the results.
+#
+# Before the scales, it measures the cold start of the command line (see cli.py), over
+# startup_runs fresh processes: the latency of python -c pass (the interpreter alone),
+# of cli.py --help, and of a cli.py query of one device in a small database.
+#
+# Every scale runs in a fresh process, so the peak memory of one does not hide that of
+# the next. By default the database is an SQLite file in a temporary directory (see
+# backends.py) - a local stand-in that needs no server. A db.json configuration can be
+# given instead - that database is DROPPED and recreated for every scale.
+#
+# The results are JSON. Compared against a baseline (a saved results file), every
+# metric that got worse by more than the threshold (a fraction - 0.2 is 20%) is a
+# regression, and the command exits with status 1.
+#######################################################################################
+
+#######################################################################################
+# Helper functions for the measurements: a timer, latency percentiles (in ms, nearest
+# rank) and the peak memory of the process.
+#######################################################################################
+
+class _Phase:
+
+    def __init__(self, trace_memory):
+        self._trace_memory = trace_memory
+        self.result = {}
+
+    def __enter__(self):
+        if (self._trace_memory):
+            tracemalloc.start()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.result['seconds'] = time.perf_counter() - self._started
+
+        if (self._trace_memory):
+            self.result['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+
+        peak_rss_mb = _peak_rss_mb()
+        if (peak_rss_mb is not None):
+            self.result['peak_rss_mb'] = peak_rss_mb
+
+    def rate(self, name, count):
+        self.result[name] = count / self.result['seconds'] if self.result['seconds'] else 0.0
+
+def _peak_rss_mb():
+    if (resource is None):
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if (sys.platform == 'darwin'):
+        return peak / 2 ** 20
+    return peak / 2 ** 10
+
+def _latencies(timings):
+    timings = sorted(timings)
+
+    def percentile(fraction):
+        return timings[min(len(timings) - 1, int(fraction * len(timings)))] * 1000
+
+    return {
+        'count': len(timings),
+        'p50_ms': percentile(0.5),
+        'p90_ms': percentile(0.9),
+        'p99_ms': percentile(0.99),
+        'max_ms': timings[-1] * 1000
+    }
+
+def _timed(function, arguments):
+    timings = []
+    for args in arguments:
+        started = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - started)
+
+    return timings
+
+#######################################################################################
+# A function to run all the benchmarks of a single scale, in a fresh database. It runs
+# in its own process, and returns the results of the scale.
+#######################################################################################
+
+def run_scale(db_config, scale, options):
+    rng = random.Random(options['seed'])
+    trace_memory = options['trace_memory']
+    interval = datetime.timedelta(seconds=options['interval'])
+
+    device_count = max(1, scale // options['readings_per_device'])
+    readings_per_device = scale // device_count
+    dataset_end = DATASET_START + interval * readings_per_device
+
+    instrumentation = None
+    if (options['query_stats']):
+        instrumentation = install(Instrumentation())
+
+    backend_for_config(db_config).create_database(drop_existing=True)
+    db = Database(db_config)
+    with contextlib.redirect_stdout(sys.stderr):
+        migrate(db)
+
+    devices = generate_devices(device_count)
+    device_ids = [device[0] for device in devices]
+    load_rows(db, 'devices', DEVICE_COLUMNS, devices)
+
+    device_model = DeviceModel(db_config, db)
+    weather_data_model = WeatherDataModel(db_config, db, device_model)
+    daily_report_model = DailyReportModel(db_config, db)
+
+    results = {'devices': device_count, 'readings': device_count * readings_per_device}
+
+    with _Phase(trace_memory) as phase:
+        readings = generate_readings(devices, DATASET_START, dataset_end, interval, options['seed'])
+        loaded = load_rows(db, 'weather_data', WEATHER_DATA_COLUMNS, readings)
+    phase.rate('readings_per_s', loaded)
+    results['load'] = phase.result
+
+    # New readings, after the end of the dataset - the single inserts first, then the batch
+
+    def new_readings(count, offset):
+        return [(device_ids[number % device_count],
+                 Decimal(f'{rng.gauss(24, 2.2):.2f}'),
+                 dataset_end + interval * (offset + number // device_count))
+                for number in range(count)]
+
+    single_count = min(options['single_inserts'], scale)
+    single_readings = new_readings(single_count, 0)
+    with _Phase(trace_memory) as phase:
+        timings = _timed(weather_data_model.insert, single_readings)
+    phase.rate('ops_per_s', single_count)
+    phase.result.update(_latencies(timings))
+    results['ingest_single'] = phase.result
+
+    batch_count = min(options['batch_inserts'], scale)
+    batch_readings = new_readings(batch_count, single_count // device_count + 1)
+    with _Phase(trace_memory) as phase:
+        counts = weather_data_model.insert_many(batch_readings)
+    phase.rate('readings_per_s', counts['inserted'])
+    results['ingest_batch'] = phase.result
+
+    # Point lookups, on random devices and timestamps of the dataset
+
+    def random_timestamp():
+        return DATASET_START + interval * rng.randrange(readings_per_device)
+
+    lookup_devices = [(rng.choice(device_ids),) for _ in range(options['lookups'])]
+    lookup_timestamps = [(device_id, random_timestamp()) for (device_id,) in lookup_devices]
+
+    results['lookup'] = {}
+    for name, function, arguments in [
+            ('find_by_device_id', device_model.find_by_device_id, lookup_devices),
+            ('find_by_device_id_and_timestamp', weather_data_model.find_by_device_id_and_timestamp, lookup_timestamps),
+            ('find_latest_by_device_id', weather_data_model.find_latest_by_device_id,
+                [(device_id, 10) for (device_id,) in lookup_devices])]:
+        with _Phase(trace_memory) as phase:
+            timings = _timed(function, arguments)
+        phase.result.update(_latencies(timings))
+        results['lookup'][name] = phase.result
+
+    # Range scans - a day of a device at a time, and the whole table
+
+    scan_days = [(device_id, DATASET_START + datetime.timedelta(days=rng.randrange(max(1, (dataset_end - DATASET_START).days))))
+                 for (device_id,) in lookup_devices[:max(1, options['lookups'] // 10)]]
+    with _Phase(trace_memory) as phase:
+        rows = 0
+        for device_id, day in scan_days:
+            rows += sum(1 for _ in weather_data_model.iter_by_device_id(device_id, day, day + datetime.timedelta(days=1)))
+    phase.rate('rows_per_s', rows)
+    results['range_scan'] = {'day_of_device': phase.result}
+
+    with _Phase(trace_memory) as phase:
+        rows = sum(len(batch) for batch in weather_data_model.find_all_chunked(10000, decode=DECODE_SCALED))
+    phase.rate('rows_per_s', rows)
+    results['range_scan']['full_table'] = phase.result
+
+    # Report generation from scratch, with each engine - then an incremental refresh
+
+    results['report_full'] = {}
+    for engine in options['engines']:
+        db.delete_data(DailyReportModel.WATERMARK_TABLE, None)
+        with _Phase(trace_memory) as phase:
+            daily_report_model.create_reports(chunk_size=10000, engine=engine, workers=options['workers'],
+                                              fast=options['fast'])
+        results['report_full'][engine] = phase.result
+
+    # Report lookups - every one a database round trip, then through a ReportCache (the repeats are hits)
+
+    lookup_days = [(device_id, DATASET_START + datetime.timedelta(days=rng.randrange(max(1, (dataset_end - DATASET_START).days))))
+                   for (device_id,) in lookup_devices]
+    for name, cache in [('find_by_device_id_and_date', None), ('find_by_device_id_and_date_cached', ReportCache())]:
+        report_model = DailyReportModel(db_config, db, cache=cache)
+        with _Phase(trace_memory) as phase:
+            timings = _timed(report_model.find_by_device_id_and_date, lookup_days + lookup_days)
+        phase.result.update(_latencies(timings))
+        results['lookup'][name] = phase.result
+
+    late_devices = rng.sample(device_ids, max(1, device_count // 100))
+    late_readings = [(device_id, Decimal('24.00'), random_timestamp() + datetime.timedelta(seconds=1))
+                     for device_id in late_devices for _ in range(5)]
+    weather_data_model.insert_many(late_readings)
+
+    with _Phase(trace_memory) as phase:
+        refreshed = daily_report_model.refresh_reports(options['engines'][0])
+    phase.result['reports'] = refreshed
+    results['report_incremental'] = phase.result
+
+    if (instrumentation is not None):
+        results['query_stats'] = instrumentation.snapshot()['statements']
+
+    return results
+
+#######################################################################################
+# A function to measure the start up time of the command line, in runs fresh processes
+# of each command - in a database of a single device, and with the configuration in a
+# file, as a cron job would run it. The latencies include the interpreter start up,
+# which python -c pass gives alone.
+#######################################################################################
+
+def run_startup(db_config, runs):
+    backend_for_config(db_config).create_database(drop_existing=True)
+    db = Database(db_config)
+    with contextlib.redirect_stdout(sys.stderr):
+        migrate(db)
+
+    devices = generate_devices(1)
+    load_rows(db, 'devices', DEVICE_COLUMNS, devices)
+    device_id = devices[0][0]
+
+    cli_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+    config_directory = tempfile.mkdtemp(prefix='weather-startup-')
+    config_path = os.path.join(config_directory, 'db.json')
+    with open(config_path, 'w') as config_fh:
+        json.dump(db_config, config_fh)
+
+    commands = {
+        'interpreter': ['-c', 'pass'],
+        'cli_help': [cli_path, '--help'],
+        'cli_query_device': [cli_path, '--config', config_path, 'query', 'device', device_id]
+    }
+
+    def run(arguments):
+        subprocess.run([sys.executable] + arguments, check=True, stdout=subprocess.DEVNULL)
+
+    try:
+        return {name: _latencies(_timed(run, [(arguments,)] * runs)) for name, arguments in commands.items()}
+    finally:
+        shutil.rmtree(config_directory, ignore_errors=True)
+
+#######################################################################################
+# Functions to compare results with a baseline. The metrics are compared by their
+# flattened path (e.g. 100000.lookup.find_by_device_id.p99_ms); rates (*_per_s) are
+# better higher, the other metrics (times and memory) better lower. Counts are not
+# compared. The start up latencies are compared as startup.<command>.<percentile>.
+#######################################################################################
+
+def _flatten(results, prefix=''):
+    metrics = {}
+    for name, value in results.items():
+        path = f'{prefix}{name}'
+        if (isinstance(value, dict)):
+            metrics.update(_flatten(value, path + '.'))
+        elif (isinstance(value, float)):
+            metrics[path] = value
+
+    return metrics
+
+def _metrics(results):
+    metrics = _flatten(results['scales'])
+    metrics.update(_flatten(results.get('startup', {}), 'startup.'))
+    return metrics
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    current = _metrics(results)
+    previous = _metrics(baseline)
+
+    comparisons = []
+    for path in sorted(current.keys() & previous.keys()):
+        if (not previous[path]):
+            continue
+
+        change = (current[path] - previous[path]) / previous[path]
+        worse = -change if path.endswith('_per_s') else change
+        comparisons.append((path, previous[path], current[path], change, worse > threshold))
+
+    return comparisons
+
+#######################################################################################
+# The command line entry point:
+#   python bench.py [--scales 1e4,1e5] [--startup-runs 10] [--output results.json]
+#                   [--baseline baseline.json]
+#######################################################################################
+
+def _parse_scales(text):
+    return [int(float(scale)) for scale in text.split(',') if scale]
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark ingest, lookups, range scans and report generation')
+    parser.add_argument('--scales', type=_parse_scales, default=_parse_scales(DEFAULT_SCALES),
+                        help=f'comma separated dataset sizes, in readings (default: {DEFAULT_SCALES})')
+    parser.add_argument('--readings-per-device', type=int, default=DEFAULT_READINGS_PER_DEVICE,
+                        help='readings of each device - the scale sets the number of devices')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help='seconds between the readings of a device')
+    parser.add_argument('--lookups', type=int, default=DEFAULT_LOOKUPS, help='point lookups timed per lookup function')
+    parser.add_argument('--single-inserts', type=int, default=DEFAULT_SINGLE_INSERTS, help='readings inserted one at a time')
+    parser.add_argument('--batch-inserts', type=int, default=DEFAULT_BATCH_INSERTS, help='readings inserted with insert_many')
+    parser.add_argument('--engines', default=','.join([DailyReportModel.ENGINE_DATABASE, DailyReportModel.ENGINE_PYTHON]),
+                        help='comma separated report engines to time')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the Python report engine')
+    parser.add_argument('--fast', action='store_true', help='aggregate scaled integers in the Python report engine')
+    parser.add_argument('--trace-memory', action='store_true', help='also record the Python heap peak of each phase (slower)')
+    parser.add_argument('--query-stats', action='store_true',
+                        help='also record the time of each query shape and model method (adds some overhead)')
+    parser.add_argument('--startup-runs', type=int, default=DEFAULT_STARTUP_RUNS,
+                        help='processes started per command line measurement (0 skips the start up measurement)')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='random seed of the datasets and lookups')
+    parser.add_argument('--config', default=None,
+                        help='db.json of the database to use - it is DROPPED and recreated (default: a temporary SQLite file)')
+    parser.add_argument('--output', default=None, help='file to write the JSON results to (default: standard output)')
+    parser.add_argument('--baseline', default=None, help='results file to compare with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative change that counts as a regression (default: 0.2)')
+    args = parser.parse_args(args)
+
+    options = {
+        'readings_per_device': args.readings_per_device,
+        'interval': args.interval,
+        'lookups': args.lookups,
+        'single_inserts': args.single_inserts,
+        'batch_inserts': args.batch_inserts,
+        'engines': args.engines.split(','),
+        'workers': args.workers,
+        'fast': args.fast,
+        'trace_memory': args.trace_memory,
+        'query_stats': args.query_stats,
+        'seed': args.seed
+    }
+
+    temp_directory = None
+    if (args.config):
+        db_config = load_db_config(args.config)
+    else:
+        temp_directory = tempfile.mkdtemp(prefix='weather-bench-')
+        db_config = {'backend': 'sqlite', 'path': os.path.join(temp_directory, 'bench.db')}
+
+    results = {
+        'meta': {
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'backend': db_config.get('backend', 'mysql'),
+            'options': options
+        },
+        'scales': {}
+    }
+
+    try:
+        if (args.startup_runs > 0):
+            print('Measuring the command line start up', file=sys.stderr)
+            results['startup'] = run_startup(db_config, args.startup_runs)
+
+        for scale in args.scales:
+            print(f'Running scale {scale}', file=sys.stderr)
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                results['scales'][str(scale)] = executor.submit(run_scale, db_config, scale, options).result()
+    finally:
+        if (temp_directory is not None):
+            shutil.rmtree(temp_directory, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if (args.output):
+        with open(args.output, 'w') as output_fh:
+            output_fh.write(output + '\n')
+    else:
+        print(output)
+
+    if (args.baseline is None):
+        return 0
+
+    with open(args.baseline) as baseline_fh:
+        baseline = json.load(baseline_fh)
+
+    regressions = 0
+    for path, previous, current, change, regressed in compare(results, baseline, args.threshold):
+        regressions += regressed
+        print(f'{"REGRESSION " if regressed else ""}{path}: {previous:.4g} -> {current:.4g} ({change:+.1%})', file=sys.stderr)
+
+    print(f'{regressions} regressions beyond {args.threshold:.0%}', file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+#############################################################################################################
+# An in-process, thread-safe LRU cache, used by the model layer to avoid database round trips for data that
+# rarely changes.
+#
+# Constructor parameters:
+# 1. max_entries: The maximum number of entries - the least recently used entry is evicted beyond that
+# 2. ttl: The number of seconds an entry stays valid (None - until evicted or invalidated)
+# 3. negative_ttl: The number of seconds a negative entry stays valid. A negative entry records that a key
+#                  does not exist (a None value), so that repeated lookups of unknown keys are cached too.
+#                  It is usually kept shorter than ttl, so that new keys show up quickly.
+# 4. max_bytes: The maximum total (estimated) size of the values, in bytes (None - no limit). The least 
+#               recently used entries are evicted beyond that as well.
+#
+# The hit, miss and eviction counters are exposed by stats(), to help size the cache.
+#############################################################################################################
+
+class LRUCache:
+    DEFAULT_MAX_ENTRIES = 10000
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=None, negative_ttl=None, max_bytes=None):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+        self._hits = 0
+        self._negative_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+#############################################################################################################
+# A function to look a key up. It returns a (found, value) tuple - found is False on a miss (or an expired
+# entry), and value is None for a negative entry.
+#############################################################################################################
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if (entry is not None):
+                value, expires_at, _ = entry
+                if (expires_at is None or expires_at > time.monotonic()):
+                    self._entries.move_to_end(key)
+                    if (value is None):
+                        self._negative_hits += 1
+                    else:
+                        self._hits += 1
+                    return True, value
+
+                self._remove(key)
+
+            self._misses += 1
+            return False, None
+
+#############################################################################################################
+# A function to add (or replace) an entry. A value of None adds a negative entry.
+#############################################################################################################
+
+    def put(self, key, value):
+        ttl = self._negative_ttl if value is None else self._ttl
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        size = estimate_size(value) if self._max_bytes is not None else 0
+
+        with self._lock:
+            if (key in self._entries):
+                self._remove(key)
+
+            self._entries[key] = (value, expires_at, size)
+            self._bytes += size
+            self._added(key)
+
+            while (len(self._entries) > self._max_entries or 
+                   (self._max_bytes is not None and self._bytes > self._max_bytes and len(self._entries) > 1)):
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if (key in self._entries):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+#############################################################################################################
+# Helper functions, called with the lock held, that remove an entry - and hooks for subclasses that keep 
+# their own index of the entries, called whenever an entry is added or removed (for whatever reason).
+#############################################################################################################
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+        self._removed(key)
+
+    def _added(self, key):
+        pass
+
+    def _removed(self, key):
+        pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self._hits,
+                'negative_hits': self._negative_hits,
+                'misses': self._misses,
+                'evictions': self._evictions
+            }
+
+#############################################################################################################
+# The cache of DailyReportModel lookups - an LRUCache of the rows of find_by_device_id_and_date and 
+# find_by_device_id_and_date_range, keyed by the device and the date (or the date range, both as the 
+# 'YYYY-MM-DD HH:MM:SS' strings the queries use):
+#   (DATE_KEY, device_id, date)
+#   (RANGE_KEY, device_id, from_date, to_date)
+#
+# It is invalidated precisely: invalidate_report(device_id, date) removes the entries of that device whose date
+# (or date range) includes date - a None device_id or date stands for all the devices, or all the dates.
+#
+# A lookup takes a stamp() before it queries the database, and passes it to put: if the cache was 
+# invalidated meanwhile, the (possibly stale) rows are not cached.
+#
+# The generation is the report generation counter of the database (see DailyReportModel) the entries were
+# read at. Reports written by another process bump it, and a model that finds it changed clears the cache.
+#############################################################################################################
+
+class ReportCache(LRUCache):
+    DATE_KEY = 'date'
+    RANGE_KEY = 'range'
+
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+    DEFAULT_GENERATION_CHECK_INTERVAL = 1
+
+    def __init__(self, max_entries=LRUCache.DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, ttl=None,
+                 generation_check_interval=DEFAULT_GENERATION_CHECK_INTERVAL):
+        super().__init__(max_entries, ttl, ttl, max_bytes)
+        self._generation_check_interval = generation_check_interval
+
+        self._spans = {}
+        self._invalidations = 0
+        self._generation = None
+        self._generation_checked_at = None
+
+    def stamp(self):
+        return self._invalidations
+
+    def put(self, key, value, stamp=None):
+        with self._lock:
+            if (stamp is None or stamp == self._invalidations):
+                super().put(key, value)
+
+    def _added(self, key):
+        if (key[0] == ReportCache.DATE_KEY):
+            span = (key[2], key[2])
+        else:
+            span = (key[2], key[3])
+
+        self._spans.setdefault(key[1], {})[key] = span
+
+    def _removed(self, key):
+        spans = self._spans.get(key[1])
+        if (spans is not None):
+            spans.pop(key, None)
+            if (not spans):
+                del self._spans[key[1]]
+
+    def clear(self):
+        self.invalidate_report()
+
+    def invalidate_report(self, device_id=None, date=None):
+        with self._lock:
+            self._invalidations += 1
+            device_ids = list(self._spans) if device_id is None else [device_id]
+
+            for device_id in device_ids:
+                for key, (from_date, to_date) in list(self._spans.get(device_id, {}).items()):
+                    if (date is None or from_date <= date <= to_date):
+                        self._remove(key)
+
+#############################################################################################################
+# Functions for the generation check. generation_check_due tells whether it is time to compare the 
+# generation with the database's again; check_generation records the generation read from the database, and
+# clears the cache if it changed. advance_generation records the generation the model bumped the counter to
+# itself - if another process bumped it too since the last check, the cache is cleared all the same.
+#############################################################################################################
+
+    def generation_check_due(self):
+        checked_at = self._generation_checked_at
+        return checked_at is None or time.monotonic() - checked_at >= self._generation_check_interval
+
+    def check_generation(self, generation):
+        with self._lock:
+            if (generation != self._generation):
+                self.invalidate_report()
+                self._generation = generation
+            self._generation_checked_at = time.monotonic()
+
+    def advance_generation(self, generation):
+        with self._lock:
+            if (self._generation is None or generation != self._generation + 1):
+                self.invalidate_report()
+            self._generation = generation
+
+#############################################################################################################
+# A helper function that estimates the memory taken by a cached value - the object itself, and the items of
+# the tuples, lists and row objects (see rows.py) in it.
+#############################################################################################################
+
+def estimate_size(value):
+    size = sys.getsizeof(value)
+
+    if (isinstance(value, (tuple, list))):
+        size += sum(estimate_size(item) for item in value)
+    elif (hasattr(value, '__slots__') and hasattr(value, '__iter__')):
+        size += sum(estimate_size(item) for item in value)
+
+    return size
@@ -0,0 +1,197 @@
+import argparse
+import datetime
+import json
+import sys
+
+from config import load_db_config
+
+TRANSFER_TABLES = ['weather_data', 'daily_report']
+
+#######################################################################################
+# The command line interface of the package - one entry point for the jobs that are
+# run from cron or in short-lived containers:
+#   python cli.py setup                         - create the database afresh, with
+#                                                 sample devices and readings
+#   python cli.py ingest FILE [--table T]       - import a file of readings (or
+#                                                 reports), see transfer.py
+#   python cli.py report [--engine E] [--rollups]
+#                                               - create or refresh the daily reports
+#                                                 (and the rollups)
+#   python cli.py query device ID               - print a device
+#   python cli.py query readings ID [--start S] [--end E]
+#                                               - print the readings of a device
+#   python cli.py query latest [--devices A,B] [--type T] [--manufacturer M]
+#                                               - print the latest reading of devices
+#   python cli.py query report ID DATE [--to DATE]
+#                                               - print the daily reports of a device
+#   python cli.py export FILE [--table T] [--devices A,B] [--start S] [--end E]
+#                                               - export a table to a file
+#
+# The configuration is loaded when a command runs - from --config, or as config.py
+# finds it (the WDM_CONFIG and WDM_DB_* environment variables). Only argparse and the
+# configuration are imported up front: every command imports the modules it uses, and
+# the database connects on its first statement, so --help and the light commands
+# start without loading the model layer and its dependencies.
+#
+# The query commands print one JSON object per row.
+#######################################################################################
+
+def _datetime(text):
+    return datetime.datetime.fromisoformat(text)
+
+def _device_ids(text):
+    return text.split(',') if text else None
+
+def _print_rows(rows):
+    for row in rows:
+        print(json.dumps(row.as_dict(), default=str))
+
+#######################################################################################
+# The command functions - each is given the parsed arguments and the configuration,
+# and returns the exit status.
+#######################################################################################
+
+def run_setup(args, db_config):
+    from setup import setup_database
+
+    setup_database(db_config)
+    print('Database created')
+    return 0
+
+def run_ingest(args, db_config):
+    from database import Database
+    from transfer import import_table
+
+    counts = import_table(Database(db_config), args.table, args.file, args.format, args.batch_size)
+    print(f'Imported {args.file} into {args.table}: {counts}')
+    return 0
+
+def run_report(args, db_config):
+    from database import Database
+    from model import DailyReportModel
+
+    db = Database(db_config)
+    daily_report_model = DailyReportModel(db_config, db)
+
+    if (not daily_report_model.create_reports(args.chunk_size, args.engine, args.workers, args.fast)):
+        print(daily_report_model.latest_error, file=sys.stderr)
+        return 1
+    print('Daily reports created')
+
+    if (args.rollups):
+        from rollup import RollupModel
+
+        touched = RollupModel(db_config, db).refresh()
+        print(f'Rollups refreshed ({touched} hourly buckets)')
+
+    return 0
+
+def run_query(args, db_config):
+    from database import Database
+    from model import DeviceModel, WeatherDataModel, DailyReportModel
+
+    db = Database(db_config)
+
+    if (args.query == 'device'):
+        device = DeviceModel(db_config, db, typed_rows=True).find_by_device_id(args.device_id)
+        if (device is None):
+            print(f'No device {args.device_id}', file=sys.stderr)
+            return 1
+        _print_rows([device])
+
+    elif (args.query == 'readings'):
+        weather_data_model = WeatherDataModel(db_config, db, typed_rows=True)
+        _print_rows(weather_data_model.iter_by_device_id(args.device_id, args.start, args.end))
+
+    elif (args.query == 'latest'):
+        weather_data_model = WeatherDataModel(db_config, db, typed_rows=True)
+        _print_rows(weather_data_model.find_latest_by_device_ids(args.devices, args.type, args.manufacturer))
+
+    else:
+        daily_report_model = DailyReportModel(db_config, db, typed_rows=True)
+        if (args.to is None):
+            report = daily_report_model.find_by_device_id_and_date(args.device_id, args.date)
+            _print_rows([report] if report is not None else [])
+        else:
+            _print_rows(daily_report_model.find_by_device_id_and_date_range(args.device_id, args.date, args.to))
+
+    return 0
+
+def run_export(args, db_config):
+    from database import Database
+    from transfer import export_table
+
+    exported = export_table(Database(db_config), args.table, args.file, args.format, args.devices, args.start, args.end,
+                            args.chunk_size)
+    print(f'Exported {exported} rows of {args.table} to {args.file}')
+    return 0
+
+#######################################################################################
+# The command line parser, and the entry point.
+#######################################################################################
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Manage the weather data database')
+    parser.add_argument('--config', default=None,
+                        help='path of the db.json configuration file (default: $WDM_CONFIG, or ../config/db.json)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('setup', help='create the database afresh, with sample data').set_defaults(run=run_setup)
+
+    ingest = commands.add_parser('ingest', help='import a file of readings or reports')
+    ingest.add_argument('file', help='file to read - .csv, .ndjson or .wdc, optionally with .gz, .bz2 or .xz')
+    ingest.add_argument('--table', choices=TRANSFER_TABLES, default='weather_data')
+    ingest.add_argument('--format', choices=['csv', 'ndjson', 'columnar'], default=None,
+                        help='file format (default: from the file extension)')
+    ingest.add_argument('--batch-size', type=int, default=5000, help='rows inserted at a time')
+    ingest.set_defaults(run=run_ingest)
+
+    report = commands.add_parser('report', help='create or refresh the daily reports')
+    report.add_argument('--engine', choices=['database', 'python'], default='database', help='where the aggregation runs')
+    report.add_argument('--workers', type=int, default=1, help='worker processes of the Python engine')
+    report.add_argument('--fast', action='store_true', help='aggregate scaled integers in the Python engine')
+    report.add_argument('--chunk-size', type=int, default=None, help='rows streamed at a time by the Python engine')
+    report.add_argument('--rollups', action='store_true', help='refresh the rollups too')
+    report.set_defaults(run=run_report)
+
+    query = commands.add_parser('query', help='print devices, readings or reports as JSON lines')
+    query.set_defaults(run=run_query)
+    queries = query.add_subparsers(dest='query', required=True)
+
+    device = queries.add_parser('device', help='a device')
+    device.add_argument('device_id')
+
+    readings = queries.add_parser('readings', help='the readings of a device, in timestamp order')
+    readings.add_argument('device_id')
+    readings.add_argument('--start', type=_datetime, default=None, help='from this time on, ISO format')
+    readings.add_argument('--end', type=_datetime, default=None, help='before this time, ISO format')
+
+    latest = queries.add_parser('latest', help='the latest reading of devices (default: all)')
+    latest.add_argument('--devices', type=_device_ids, default=None, help='comma separated device_ids')
+    latest.add_argument('--type', default=None, help='the devices of this type')
+    latest.add_argument('--manufacturer', default=None, help='the devices of this manufacturer')
+
+    daily_report = queries.add_parser('report', help='the daily reports of a device')
+    daily_report.add_argument('device_id')
+    daily_report.add_argument('date', type=_datetime, help='the date of the report, ISO format')
+    daily_report.add_argument('--to', type=_datetime, default=None, help='the last date of a range of reports')
+
+    export = commands.add_parser('export', help='export a table to a file')
+    export.add_argument('file', help='file to write - .csv, .ndjson or .wdc, optionally with .gz, .bz2 or .xz')
+    export.add_argument('--table', choices=TRANSFER_TABLES, default='weather_data')
+    export.add_argument('--format', choices=['csv', 'ndjson', 'columnar'], default=None,
+                        help='file format (default: from the file extension)')
+    export.add_argument('--devices', type=_device_ids, default=None, help='comma separated device_ids (default: all)')
+    export.add_argument('--start', type=_datetime, default=None, help='export the rows from this time on, ISO format')
+    export.add_argument('--end', type=_datetime, default=None, help='export the rows before this time, ISO format')
+    export.add_argument('--chunk-size', type=int, default=10000, help='rows read from the database at a time')
+    export.set_defaults(run=run_export)
+
+    return parser
+
+def main(args=None):
+    args = build_parser().parse_args(args)
+    return args.run(args, load_db_config(args.config))
+
+if __name__ == '__main__':
+    sys.exit(main())
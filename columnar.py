@@ -0,0 +1,236 @@
+import datetime
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+#############################################################################################################
+# An optional, in-memory columnar copy of the weather_data table, for repeated analytical queries.
+#
+# The readings of each loaded device are kept in contiguous NumPy arrays, sorted by timestamp:
+#   ids - int32 (the weather_data id column)
+#   timestamps - int64 seconds since the epoch (the naive data_timestamp values, taken as UTC)
+#   values - float64, or float32 to halve the memory again
+# which takes 16 to 20 bytes per reading, instead of a row tuple holding Decimal and datetime objects. Time
+# ranges are found with a binary search (searchsorted) and aggregated with vectorized reductions.
+#
+# It needs NumPy, which is not a dependency of the rest of the project - constructing a ColumnarStore
+# without it raises an ImportError.
+#
+# Devices are loaded explicitly (load_device), and new readings are added with append - the models do this
+# by themselves for the devices already loaded, when a store is attached to them (see the columnar_store
+# property of WeatherDataModel): the value lookups, time range reads and aggregates of those devices are then
+# answered from memory. Queries about devices that are not loaded are left to the database. The store only
+# answers queries about readings - the daily reports are always read from the daily_report table.
+#############################################################################################################
+
+class ColumnarStore:
+    WD_ID_COL = 0
+    WD_VALUE_COL = 2
+    WD_TIMESTAMP_COL = 3
+
+    def __init__(self, weather_data_model, value_dtype='float64'):
+        if (np is None):
+            raise ImportError('The columnar store needs NumPy (pip install numpy)')
+
+        self._weather_data_model = weather_data_model
+        self._value_dtype = np.dtype(value_dtype)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def is_loaded(self, device_id):
+        return device_id in self._series
+
+    def device_ids(self):
+        return list(self._series.keys())
+
+    def nbytes(self):
+        return sum(series.nbytes() for series in self._series.values())
+
+#############################################################################################################
+# A function to load (or reload) all the readings of a device from the database - page by page, so that the
+# row tuples of only one page are alive at a time. It returns the number of readings loaded.
+#
+# The device is unloaded first: the model reads a loaded device from the store, and a reload has to read it
+# from the database.
+#############################################################################################################
+
+    def load_device(self, device_id, page_size=None):
+        kwargs = {} if page_size is None else {'page_size': page_size}
+        self.unload_device(device_id)
+
+        chunks = []
+        page = []
+        for row in self._weather_data_model.iter_by_device_id(device_id, **kwargs):
+            page.append(row)
+            if (len(page) >= 10000):
+                chunks.append(self._to_arrays(page))
+                page = []
+        if (page):
+            chunks.append(self._to_arrays(page))
+
+        series = _DeviceSeries(self._value_dtype)
+        if (chunks):
+            series.extend(np.concatenate([chunk[0] for chunk in chunks]),
+                          np.concatenate([chunk[1] for chunk in chunks]),
+                          np.concatenate([chunk[2] for chunk in chunks]))
+
+        with self._lock:
+            self._series[device_id] = series
+
+        return len(series)
+
+    def unload_device(self, device_id):
+        with self._lock:
+            self._series.pop(device_id, None)
+
+    def _to_arrays(self, rows):
+        ids = np.fromiter((row[ColumnarStore.WD_ID_COL] for row in rows), dtype=np.int32, count=len(rows))
+        timestamps = np.array([row[ColumnarStore.WD_TIMESTAMP_COL] for row in rows], dtype='datetime64[s]').astype(np.int64)
+        values = np.fromiter((row[ColumnarStore.WD_VALUE_COL] for row in rows), dtype=self._value_dtype, count=len(rows))
+        return ids, timestamps, values
+
+#############################################################################################################
+# A function to add a new reading of a loaded device, with its weather_data id (readings of devices that are
+# not loaded are ignored). A reading for a timestamp the device already has is ignored too, as the database
+# would ignore it. It returns True if the reading was added.
+#############################################################################################################
+
+    def append(self, device_id, value, timestamp, id):
+        series = self._series.get(device_id)
+        if (series is None):
+            return False
+
+        with self._lock:
+            return series.add(id, _to_epoch(timestamp), value)
+
+#############################################################################################################
+# Functions to query the readings of a loaded device, between start (inclusive) and end (exclusive) -
+# either end can be None, for an open range.
+#   range - the (ids, timestamps, values) arrays of the readings (views, not copies)
+#   rows - the readings as (id, device_id, data_value, data_timestamp) rows in timestamp order, like
+#          WeatherDataModel.iter_by_device_id - data_value being a float here
+#   aggregate - a dictionary of the count, sum, mean, min, max and (population) standard deviation
+#############################################################################################################
+
+    def range(self, device_id, start=None, end=None):
+        series = self._series[device_id]
+        low, high = series.bounds(start and _to_epoch(start), end and _to_epoch(end))
+        return series.ids[low:high], series.timestamps[low:high], series.values[low:high]
+
+    def rows(self, device_id, start=None, end=None):
+        ids, timestamps, values = self.range(device_id, start, end)
+        return [(id, device_id, value, _from_epoch(timestamp))
+                for id, timestamp, value in zip(ids.tolist(), timestamps.tolist(), values.tolist())]
+
+    def aggregate(self, device_id, start=None, end=None):
+        _, _, values = self.range(device_id, start, end)
+
+        if (not len(values)):
+            return {'count': 0, 'sum': 0.0, 'mean': None, 'min': None, 'max': None, 'stddev': None}
+
+        return {
+            'count': int(len(values)),
+            'sum': float(values.sum(dtype=np.float64)),
+            'mean': float(values.mean(dtype=np.float64)),
+            'min': float(values.min()),
+            'max': float(values.max()),
+            'stddev': float(values.std(dtype=np.float64))
+        }
+
+#############################################################################################################
+# A function to find the first reading (in timestamp order) of a loaded device with a value between
+# low_value and high_value - both non-inclusive. Like WeatherDataModel.find_by_device_id_and_value, it
+# returns an (id, device_id, data_value, data_timestamp) row, or None - data_value being a float here.
+#############################################################################################################
+
+    def find_by_value(self, device_id, low_value, high_value):
+        series = self._series[device_id]
+        values = series.values
+
+        matches = np.flatnonzero((values > low_value) & (values < high_value))
+        if (not len(matches)):
+            return None
+
+        index = matches[0]
+        return (int(series.ids[index]), device_id, float(values[index]), _from_epoch(series.timestamps[index]))
+
+#############################################################################################################
+# The arrays of a single device. They are allocated with spare capacity, so that appending a reading is
+# amortized O(1); the public ids, timestamps and values attributes are views of the filled part.
+#############################################################################################################
+
+class _DeviceSeries:
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, value_dtype):
+        self._length = 0
+        self._ids = np.empty(_DeviceSeries.INITIAL_CAPACITY, dtype=np.int32)
+        self._timestamps = np.empty(_DeviceSeries.INITIAL_CAPACITY, dtype=np.int64)
+        self._values = np.empty(_DeviceSeries.INITIAL_CAPACITY, dtype=value_dtype)
+        self._refresh_views()
+
+    def __len__(self):
+        return self._length
+
+    def nbytes(self):
+        return self._ids.nbytes + self._timestamps.nbytes + self._values.nbytes
+
+    def bounds(self, start, end):
+        low = 0 if start is None else int(np.searchsorted(self.timestamps, start, side='left'))
+        high = self._length if end is None else int(np.searchsorted(self.timestamps, end, side='left'))
+        return low, max(low, high)
+
+    def extend(self, ids, timestamps, values):
+        order = np.argsort(timestamps, kind='stable')
+        self._reserve(self._length + len(ids))
+
+        end = self._length + len(ids)
+        self._ids[self._length:end] = ids[order]
+        self._timestamps[self._length:end] = timestamps[order]
+        self._values[self._length:end] = values[order]
+        self._length = end
+        self._refresh_views()
+
+    def add(self, id, timestamp, value):
+        position = int(np.searchsorted(self.timestamps, timestamp, side='left'))
+        if (position < self._length and self._timestamps[position] == timestamp):
+            return False
+
+        self._reserve(self._length + 1)
+
+        if (position < self._length):
+            self._ids[position + 1:self._length + 1] = self._ids[position:self._length]
+            self._timestamps[position + 1:self._length + 1] = self._timestamps[position:self._length]
+            self._values[position + 1:self._length + 1] = self._values[position:self._length]
+
+        self._ids[position] = id
+        self._timestamps[position] = timestamp
+        self._values[position] = value
+        self._length += 1
+        self._refresh_views()
+        return True
+
+    def _reserve(self, capacity):
+        if (capacity <= len(self._ids)):
+            return
+
+        capacity = max(capacity, 2 * len(self._ids))
+        self._ids = np.resize(self._ids, capacity)
+        self._timestamps = np.resize(self._timestamps, capacity)
+        self._values = np.resize(self._values, capacity)
+
+    def _refresh_views(self):
+        self.ids = self._ids[:self._length]
+        self.timestamps = self._timestamps[:self._length]
+        self.values = self._values[:self._length]
+
+def _to_epoch(timestamp):
+    return int((timestamp - EPOCH).total_seconds())
+
+def _from_epoch(seconds):
+    return EPOCH + datetime.timedelta(seconds=int(seconds))
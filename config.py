@@ -0,0 +1,49 @@
+import json
+import os
+
+CONFIG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__),'..', 'config'))
+DB_CONFIG_FILE_PATH = os.path.join(CONFIG_PATH, 'db.json')
+
+CONFIG_FILE_VARIABLE = 'WDM_CONFIG'
+
+#######################################################################################
+# The environment variables that override the keys of the db.json configuration, and
+# the type of each key - so that a container or a cron job can point the tools at a
+# database without a configuration file of its own.
+#######################################################################################
+
+ENVIRONMENT_OVERRIDES = {
+    'WDM_DB_BACKEND': ('backend', str),
+    'WDM_DB_PATH': ('path', str),
+    'WDM_DB_HOST': ('host', str),
+    'WDM_DB_PORT': ('port', int),
+    'WDM_DB_USERNAME': ('username', str),
+    'WDM_DB_PASSWORD': ('password', str),
+    'WDM_DB_NAME': ('db_name', str),
+    'WDM_DB_POOL_SIZE': ('pool_size', int)
+}
+
+#######################################################################################
+# A function to load the database configuration - called when it is first needed,
+# rather than at import time.
+#
+# The configuration file is config_path if it is given, else the file named by the
+# WDM_CONFIG environment variable, else ../config/db.json. The WDM_DB_* environment
+# variables then override its keys. A missing default file is not an error, as long as
+# the environment supplies the configuration instead.
+#######################################################################################
+
+def load_db_config(config_path=None, environ=None):
+    environ = os.environ if environ is None else environ
+    path = config_path or environ.get(CONFIG_FILE_VARIABLE) or DB_CONFIG_FILE_PATH
+
+    db_config = {}
+    if (config_path or environ.get(CONFIG_FILE_VARIABLE) or os.path.exists(path)):
+        with open(path) as db_fh:
+            db_config = json.load(db_fh)
+
+    for variable, (key, value_type) in ENVIRONMENT_OVERRIDES.items():
+        if (variable in environ):
+            db_config[key] = value_type(environ[variable])
+
+    return db_config
@@ -0,0 +1,233 @@
+import mysql.connector
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+#############################################################################################################
+# The connection pool class, that hands out MySQL connections to the database layer.
+#
+# A single pool is shared by every Database object (and so every model) created for the same database
+# configuration in a process. Connections are opened lazily, up to pool_size of them, and are returned to
+# the pool after each use - so any number of threads can share the models, each checking out its own
+# connection for the duration of a statement (or of a transaction).
+#
+# The following optional db_config keys tune the pool:
+#   pool_size - the maximum number of open connections (default 5)
+#   pool_timeout - the number of seconds to wait for a free connection before giving up (default 30)
+#   pool_health_check_interval - connections idle for longer than this many seconds are pinged (and
+#                                replaced by a new connection if stale) before being handed out (default 30)
+#   allow_local_infile - lets the connections run LOAD DATA LOCAL INFILE (default false)
+#   statement_cache_size - the number of prepared statements kept open per connection (default 64)
+#############################################################################################################
+
+class ConnectionPool:
+    DEFAULT_POOL_SIZE = 5
+    DEFAULT_TIMEOUT = 30
+    DEFAULT_HEALTH_CHECK_INTERVAL = 30
+    DEFAULT_STATEMENT_CACHE_SIZE = 64
+
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, db_config, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL, statement_cache_size=DEFAULT_STATEMENT_CACHE_SIZE):
+        self._db_config = db_config
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._health_check_interval = health_check_interval
+        self._statement_cache_size = statement_cache_size
+
+        self._idle = []
+        self._created = 0
+        self._prepared = {}
+        self._condition = threading.Condition()
+
+    @property
+    def pool_size(self):
+        return self._pool_size
+
+#############################################################################################################
+# A function to get the shared pool for a database configuration, creating it on first use.
+#
+# Pools are keyed by the process id as well, so that a forked worker process never reuses the connections
+# of its parent.
+#############################################################################################################
+
+    @classmethod
+    def for_config(cls, db_config):
+        key = (os.getpid(), db_config['host'], db_config['port'], db_config['username'], db_config['db_name'],
+               db_config.get('allow_local_infile', False))
+
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if (pool is None):
+                pool = cls(db_config,
+                           db_config.get('pool_size', cls.DEFAULT_POOL_SIZE),
+                           db_config.get('pool_timeout', cls.DEFAULT_TIMEOUT),
+                           db_config.get('pool_health_check_interval', cls.DEFAULT_HEALTH_CHECK_INTERVAL),
+                           db_config.get('statement_cache_size', cls.DEFAULT_STATEMENT_CACHE_SIZE))
+                cls._pools[key] = pool
+
+        return pool
+
+#############################################################################################################
+# A context manager to check a connection out of the pool, and return it once the block exits.
+#
+# If the block fails with a connection level error (the server went away, the connection broke), the
+# connection is closed and dropped from the pool rather than handed out again.
+#############################################################################################################
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError):
+            self.release(connection, broken=True)
+            raise
+        except:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+#############################################################################################################
+# A function to check a connection out of the pool.
+#
+# An idle connection is reused if there is one (after a health check if it has been idle for a while), a
+# new one is opened if the pool is not full yet - otherwise it waits for a connection to be released, for
+# up to the pool timeout.
+#############################################################################################################
+
+    def acquire(self):
+        deadline = time.monotonic() + self._timeout
+        connection = None
+        last_used = None
+
+        with self._condition:
+            while True:
+                if (self._idle):
+                    connection, last_used = self._idle.pop()
+                    break
+
+                if (self._created < self._pool_size):
+                    self._created += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if (remaining <= 0):
+                    raise mysql.connector.errors.PoolError(
+                        f'No connection available within {self._timeout} seconds (pool size {self._pool_size})')
+                self._condition.wait(remaining)
+
+        try:
+            if (connection is None):
+                connection = self._connect()
+            elif (time.monotonic() - last_used > self._health_check_interval):
+                connection = self._check_health(connection)
+        except:
+            self._forget()
+            raise
+
+        return connection
+
+#############################################################################################################
+# A function to return a connection to the pool. Any transaction left open on it is rolled back first.
+# A broken connection is closed instead, freeing its slot for a new one.
+#############################################################################################################
+
+    def release(self, connection, broken=False):
+        if (not broken):
+            try:
+                if (connection.in_transaction):
+                    connection.rollback()
+            except mysql.connector.Error:
+                broken = True
+
+        if (broken):
+            self._close_quietly(connection)
+            self._forget()
+            return
+
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+#############################################################################################################
+# A function to get the prepared statement cursor for an SQL text, on a checked out connection.
+#
+# Each connection keeps up to statement_cache_size prepared statements, by SQL text - the least recently 
+# used one is closed (deallocated on the server) to make room for a new one. The statement is prepared on
+# the server by the first execute of a new cursor, and only executed by the later ones.
+#############################################################################################################
+
+    def prepared_cursor(self, connection, sql):
+        with self._condition:
+            statements = self._prepared.setdefault(id(connection), OrderedDict())
+
+        cursor = statements.get(sql)
+        if (cursor is not None):
+            statements.move_to_end(sql)
+            return cursor
+
+        cursor = connection.cursor(prepared=True)
+        statements[sql] = cursor
+
+        if (len(statements) > self._statement_cache_size):
+            _, evicted = statements.popitem(last=False)
+            try:
+                evicted.close()
+            except mysql.connector.Error:
+                pass
+
+        return cursor
+
+#############################################################################################################
+# A function to close all the idle connections of the pool. Connections currently checked out are closed
+# when they are released broken, or stay open until the process exits.
+#############################################################################################################
+
+    def close_all(self):
+        with self._condition:
+            idle = self._idle
+            self._idle = []
+            self._created -= len(idle)
+            self._condition.notify_all()
+
+        for connection, _ in idle:
+            self._close_quietly(connection)
+
+    def _connect(self):
+        return mysql.connector.connect(
+                user=self._db_config['username'],
+                password=self._db_config['password'],
+                host=self._db_config['host'],
+                port=self._db_config['port'],
+                database=self._db_config['db_name'],
+                allow_local_infile=self._db_config.get('allow_local_infile', False),
+                autocommit=True
+            )
+
+    def _check_health(self, connection):
+        try:
+            connection.ping()
+            return connection
+        except mysql.connector.Error:
+            self._close_quietly(connection)
+            return self._connect()
+
+    def _forget(self):
+        with self._condition:
+            self._created -= 1
+            self._condition.notify()
+
+    def _close_quietly(self, connection):
+        with self._condition:
+            self._prepared.pop(id(connection), None)
+
+        try:
+            connection.close()
+        except mysql.connector.Error:
+            pass
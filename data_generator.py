@@ -0,0 +1,199 @@
+import argparse
+import csv
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta
+
+from config import CONFIG_PATH, load_db_config
+from database import Database
+from model import WeatherDataModel
+
+DEVICES_FILE_PATH = os.path.join(CONFIG_PATH, 'devices.csv')
+
+DEVICE_TABLE = 'devices'
+WEATHER_DATA_TABLE = 'weather_data'
+
+DEVICE_COLUMNS = ['device_id', 'description', 'device_type', 'manufacturer']
+WEATHER_DATA_COLUMNS = ['device_id', 'data_value', 'data_timestamp']
+
+METHOD_INSERT = 'insert'
+METHOD_INFILE = 'infile'
+
+DEFAULT_BATCH_SIZE = 10000
+
+#######################################################################################
+# The value distribution of each device type, as (kind, parameter 1, parameter 2):
+#   ('normal', mean, standard deviation) or ('uniform', low, high)
+#######################################################################################
+
+DEFAULT_DISTRIBUTIONS = {
+    'temperature': ('normal', 24, 2.2),
+    'humidity': ('normal', 45, 3)
+}
+
+#######################################################################################
+# A function to read the devices from a devices.csv style file - one
+# device_id,description,device_type,manufacturer row per line
+#######################################################################################
+
+def read_devices(file_path):
+    devices = []
+
+    with open(file_path, 'r') as device_fh:
+        for row in device_fh:
+            row = row.rstrip()
+
+            if row:
+                device_id, desc, type, manufacturer = row.split(',')
+                devices.append((device_id, desc, type, manufacturer))
+
+    return devices
+
+#######################################################################################
+# A function to make up device_count synthetic devices, alternating between
+# temperature (DTnnnnnn) and humidity (DHnnnnnn) sensors
+#######################################################################################
+
+def generate_devices(device_count):
+    devices = []
+
+    for number in range(1, device_count + 1):
+        if (number % 2):
+            devices.append((f'DT{number:06d}', 'Temperature Sensor', 'Temperature', 'Acme'))
+        else:
+            devices.append((f'DH{number:06d}', 'Humidity Sensor', 'Humidity', 'Acme'))
+
+    return devices
+
+#######################################################################################
+# A generator of randomized weather_data rows, for every device - one reading every
+# interval, from start (inclusive) to end (exclusive).
+#
+# The rows are (device_id, data_value, data_timestamp) tuples, with the timestamp
+# already formatted for the database, ordered by device and then by time - which
+# is also the order of the (device_id, data_timestamp) key, so loading them keeps
+# the index appends sequential. The same seed always produces the same rows.
+#######################################################################################
+
+def generate_readings(devices, start, end, interval, seed=None, distributions=DEFAULT_DISTRIBUTIONS):
+    rng = random.Random(seed)
+
+    timestamps = []
+    timestamp = start
+    while timestamp < end:
+        timestamps.append(timestamp.strftime('%Y-%m-%d %H:%M:%S'))
+        timestamp += interval
+
+    for device_id, _, type, _ in devices:
+        kind, param_1, param_2 = distributions[type.lower()]
+
+        if (kind == 'normal'):
+            draw = rng.normalvariate
+        elif (kind == 'uniform'):
+            draw = rng.uniform
+        else:
+            raise ValueError(f'Unknown value distribution {kind} for device type {type}')
+
+        for val_timestamp in timestamps:
+            yield (device_id, round(draw(param_1, param_2), 1), val_timestamp)
+
+#######################################################################################
+# A function to load rows into a table, batch_size rows at a time, each batch being
+# committed on its own. Rows that already exist are skipped. It returns the number
+# of rows inserted.
+#
+# method selects how each batch is sent:
+#   METHOD_INSERT - a multi-row INSERT statement
+#   METHOD_INFILE - a LOAD DATA LOCAL INFILE of a temporary CSV file (the database
+#                   must allow local_infile)
+#######################################################################################
+
+def load_rows(db, table, columns, rows, batch_size=DEFAULT_BATCH_SIZE, method=METHOD_INSERT):
+    row_count = 0
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if (len(batch) >= batch_size):
+            row_count += _load_batch(db, table, columns, batch, method)
+            batch = []
+
+    if (batch):
+        row_count += _load_batch(db, table, columns, batch, method)
+
+    return row_count
+
+def _load_batch(db, table, columns, batch, method):
+    if (method == METHOD_INSERT):
+        return db.insert_multiple_data(table, columns, batch, ignore_duplicates=True)
+
+    if (method != METHOD_INFILE):
+        raise ValueError(f'Unknown load method {method}')
+
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as batch_fh:
+        csv.writer(batch_fh, lineterminator='\n').writerows(batch)
+
+    try:
+        return db.load_data_file(table, columns, batch_fh.name)
+    finally:
+        os.remove(batch_fh.name)
+
+#######################################################################################
+# The command line entry point - generates a dataset and bulk loads it into the
+# (already created) database tables
+#######################################################################################
+
+def _parse_distribution(text):
+    type, kind, param_1, param_2 = text.split(':')
+    return type.lower(), (kind, float(param_1), float(param_2))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Generate and bulk load a synthetic weather dataset')
+    parser.add_argument('--devices', type=int,
+                        help='number of synthetic devices to generate (default: load the devices.csv devices)')
+    parser.add_argument('--start', type=datetime.fromisoformat, default=datetime(2021, 12, 1, 0, 30),
+                        help='timestamp of the first reading, ISO format (default: 2021-12-01T00:30)')
+    parser.add_argument('--days', type=float, default=5, help='time span of the readings, in days (default: 5)')
+    parser.add_argument('--interval', type=float, default=3600,
+                        help='sampling interval, in seconds (default: 3600)')
+    parser.add_argument('--distribution', type=_parse_distribution, action='append', default=[],
+                        metavar='TYPE:KIND:P1:P2',
+                        help='value distribution of a device type, e.g. temperature:normal:24:2.2 or humidity:uniform:30:60')
+    parser.add_argument('--seed', type=int, default=None, help='random seed, to reproduce a dataset')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='rows per batch (and commit)')
+    parser.add_argument('--method', choices=[METHOD_INSERT, METHOD_INFILE], default=METHOD_INSERT,
+                        help='multi-row INSERT statements, or LOAD DATA LOCAL INFILE of temporary files')
+    parser.add_argument('--config', default=None,
+                        help='path of the db.json configuration file (default: $WDM_CONFIG, or ../config/db.json)')
+    args = parser.parse_args(args)
+
+    db_config = load_db_config(args.config)
+
+    if (args.method == METHOD_INFILE):
+        db_config = dict(db_config, allow_local_infile=True)
+
+    distributions = dict(DEFAULT_DISTRIBUTIONS)
+    distributions.update(args.distribution)
+
+    if (args.devices):
+        devices = generate_devices(args.devices)
+    else:
+        devices = read_devices(DEVICES_FILE_PATH)
+
+    db = Database(db_config)
+
+    device_count = load_rows(db, DEVICE_TABLE, DEVICE_COLUMNS, devices, args.batch_size)
+    print(f'Devices loaded: {device_count}')
+
+    readings = generate_readings(devices, args.start, args.start + timedelta(days=args.days),
+                                 timedelta(seconds=args.interval), args.seed, distributions)
+    reading_count = load_rows(db, WEATHER_DATA_TABLE, WEATHER_DATA_COLUMNS, readings, args.batch_size, args.method)
+    print(f'Readings loaded: {reading_count}')
+
+    # The bulk load bypasses the model, which keeps the latest_reading table up to date
+
+    WeatherDataModel(db_config, db).rebuild_latest_readings()
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,161 @@
-import mysql.connector
+import csv
+import threading
+import time
+from contextlib import contextmanager
+from backends import backend_for_config
+from instrumentation import InstrumentedCursor, installed as installed_instrumentation
+from query import Query
 
 #############################################################################################################
 # The database later class, that exposes utility functions that are generic 
 # These functions are called by the different Models in the model layer
+#
+# It holds no connection of its own: every function checks a connection out of the connection pool shared by
+# all Database objects for the same configuration, and returns it when done. A Database object can therefore
+# be shared by several models, and used from several threads at once.
+#
+# The pool, and the parts of the SQL that differ between database engines, come from the storage backend
+# selected by the configuration (see backends.py) - the dialect property gives the models access to the
+# latter, for the SQL expressions they build themselves.
+#
+# An optional Instrumentation (see instrumentation.py) times every statement and connection wait - the one
+# given here, or else the one installed for the process, if any.
+#
+# The backend is only looked up on first use - so creating a Database (and the models that hold one) neither
+# imports a driver nor connects, and short-lived commands that never reach the database pay nothing for it.
 #############################################################################################################
 
 class Database:
 
-    def __init__(self, db_config):
-        self.db_handle = mysql.connector.connect(
-                user=db_config['username'],
-                password=db_config['password'],
-                host=db_config['host'],
-                port=db_config['port'],
-                database=db_config['db_name']
-            )
-        
-        self.mycursor = self.db_handle.cursor(buffered=True)
+    def __init__(self, db_config, instrumentation=None):
+        self._db_config = db_config
+        self._backend_instance = None
+        self._local = threading.local()
+        self._instrumentation = instrumentation or installed_instrumentation()
+
+    @property
+    def _backend(self):
+        if (self._backend_instance is None):
+            self._backend_instance = backend_for_config(self._db_config)
+        return self._backend_instance
+
+    @property
+    def _pool(self):
+        return self._backend.pool
+
+    @property
+    def dialect(self):
+        return self._backend
+
+    @property
+    def instrumentation(self):
+        return self._instrumentation
+
+    @instrumentation.setter
+    def instrumentation(self, instrumentation):
+        self._instrumentation = instrumentation
+
+#############################################################################################################
+# A context manager that groups the statements run inside it into a single transaction.
+#
+# Outside of a transaction() block every statement is committed on its own (the pooled connections run in
+# autocommit mode). Inside it, the calling thread keeps one connection checked out for the whole block, 
+# which is committed when the block exits, or rolled back if it raises. Nested blocks join the outer one.
+#############################################################################################################
+
+    @contextmanager
+    def transaction(self):
+        if (getattr(self._local, 'connection', None) is not None):
+            yield self
+            return
+
+        with self._pooled_connection() as connection:
+            connection.start_transaction()
+            self._local.connection = connection
+            try:
+                yield self
+                connection.commit()
+            except:
+                connection.rollback()
+                raise
+            finally:
+                self._local.connection = None
+
+#############################################################################################################
+# Helper context managers that provide a connection (the calling thread's transaction connection, if it is
+# inside a transaction() block - a pooled one otherwise), and a cursor on such a connection - both timed by
+# the instrumentation, if there is one.
+#############################################################################################################
+
+    @contextmanager
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if (connection is not None):
+            yield connection
+            return
+
+        with self._pooled_connection() as connection:
+            yield connection
+
+    def _pooled_connection(self):
+        if (self._instrumentation is None):
+            return self._pool.connection()
+
+        return self._timed_pooled_connection()
+
+    @contextmanager
+    def _timed_pooled_connection(self):
+        started = time.perf_counter()
+        with self._pool.connection() as connection:
+            self._instrumentation.record_wait(time.perf_counter() - started)
+            yield connection
+
+    @contextmanager
+    def _cursor(self):
+        with self._connection() as connection:
+            cursor = self._instrumented(connection.cursor(buffered=True))
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def _instrumented(self, cursor):
+        if (self._instrumentation is None):
+            return cursor
+
+        return InstrumentedCursor(cursor, self._instrumentation, self._instrumentation.caller())
+
+#############################################################################################################
+# Functions to run a SELECT query built with the query builder (see query.py), and return the first
+# matching row (None if there is none) - or all the matching rows.
+#
+# Logic:
+#  The query runs as a server side prepared statement. The SQL text of a query only depends on its shape, 
+#  and each pooled connection keeps its prepared statements by SQL text - so a repeated lookup is neither
+#  rebuilt on the client nor parsed again by the server, only its parameter values are sent.
+#############################################################################################################
+
+    def fetch_one(self, query):
+        result = self.fetch_all(query)
+        if (result):
+            return result[0]
+
+        return None
+
+    def fetch_all(self, query):
+        sql, val = query.to_sql()
+        return self._run_prepared(sql, val)
+
+    def _run_prepared(self, sql, val):
+        with self._connection() as connection:
+            cursor = self._instrumented(self._pool.prepared_cursor(connection, sql))
+            cursor.execute(sql, val)
+            result = cursor.fetchall()
+
+            if (self._instrumentation is not None):
+                cursor.finish()
+
+        return result
 
 #############################################################################################################
 # A function to retrieve a single row from the specified table (the first such row encountered, in case 
@@ -25,26 +164,19 @@ class Database:
 # Function parameters:
 # 1. table: The table to be queried
 # 2. query_columns_dict: A dictionary that specifies the SELECT query matching clauses
-#                        One of several comparison types can be specified (=, <, >, <=, or >=)
-#                        for each column, along with the match value for that column.
+#                        One of several comparison types can be specified (=, <, >, <=, >=, IN, or BETWEEN)
+#                        for each column, along with the match value for that column. A list of such 
+#                        (comparison, value) tuples can be given for a column, to match all of them.
 # 
 # Logic:
-#  The function dynamically constructs an SQL SELECT query with a WHERE clause, using the columns, comparison
-#  type, and the value to compare for each column - and queries the MySQL database.
+#  The function builds an SQL SELECT query with a WHERE clause, using the columns, comparison type, and the
+#  value to compare for each column - and queries the MySQL database (through fetch_one).
 #  The first such matching row is returned.
 #############################################################################################################
 
     def get_single_data(self, table, query_columns_dict):
-        selection_list = " AND ".join([
-                                        f"{column_name} {query_columns_dict[column_name][0]} %s" 
-                                        for column_name in sorted(query_columns_dict.keys())
-                                        ])
-        sql = f"SELECT * FROM {table} WHERE {selection_list}"
-        
-        val = tuple(query_columns_dict[column_name][1] for column_name in sorted(query_columns_dict.keys()))
-
-        self.mycursor.execute(sql, val)
-        result = self.mycursor.fetchone()
+        query = Query(table).where_dict(query_columns_dict).limit(1)
+        result = self.fetch_one(query)
 
         return result
 
@@ -54,35 +186,97 @@ class Database:
 # Function parameters:
 # 1. table: The table to be queried
 # 2. query_columns_dict: A dictionary that specifies the SELECT query matching clauses
-#                        One of several comparison types can be specified (=, <, >, <=, or >=)
-#                        for each column, along with the match value for that column.
+#                        One of several comparison types can be specified (=, <, >, <=, >=, IN, or BETWEEN)
+#                        for each column, along with the match value for that column. A list of such 
+#                        (comparison, value) tuples can be given for a column, to match all of them.
 # 
 # Logic:
-#  The function dynamically constructs an SQL SELECT query with a WHERE clause, using the columns, comparison
-#  type, and the value to compare for each column - and queries the MySQL database.
+#  The function builds an SQL SELECT query with a WHERE clause, using the columns, comparison type, and the
+#  value to compare for each column - and queries the MySQL database (through fetch_all).
 #  All matching rows are returned.
 #
 # If an empty parameter for query_columns_dict is passed in, then all the rows in the table are returned.
 #############################################################################################################
 
     def get_multiple_data(self, table, query_columns_dict):
-        if query_columns_dict == None:
-            sql = f"SELECT * FROM {table}"
-            self.mycursor.execute(sql)
-        else:
-            selection_list = " AND ".join([
-                                            f"{column_name} {query_columns_dict[column_name][0]} %s" 
-                                            for column_name in sorted(query_columns_dict.keys())
-                                            ])
-            sql = f"SELECT * FROM {table} WHERE {selection_list}"
-            
-            val = tuple(query_columns_dict[column_name][1] for column_name in sorted(query_columns_dict.keys()))
-            self.mycursor.execute(sql, val)
+        query = Query(table).where_dict(query_columns_dict)
+        result = self.fetch_all(query)
 
-        result = self.mycursor.fetchall()
+        return result
+
+#############################################################################################################
+# A function to retrieve aggregated rows from the specified table
+# 
+# Function parameters:
+# 1. table: The table to be queried
+# 2. select_expressions: An array of SQL expressions computed for each group, e.g. 'device_id' or 'MAX(id)'
+# 3. group_by_expressions: An array of SQL expressions the rows are grouped by. If it is empty, the whole
+#                          (matching) table is a single group.
+# 4. query_columns_dict: A dictionary that restricts the rows, in the same format as for get_multiple_data.
+#                        If it is empty (or None), the whole table is aggregated.
+# 
+# Logic:
+#  The function dynamically constructs an SQL SELECT ... GROUP BY query - and queries the MySQL database.
+#  One row per group is returned.
+#############################################################################################################
+
+    def get_aggregated_data(self, table, select_expressions, group_by_expressions, query_columns_dict):
+        select_list = ",".join(select_expressions)
+        where_clause, val = self._build_where_clause(query_columns_dict)
+        sql = f"SELECT {select_list} FROM {table}{where_clause}"
+        if (group_by_expressions):
+            sql += f" GROUP BY {','.join(group_by_expressions)}"
+
+        with self._cursor() as cursor:
+            cursor.execute(sql, val)
+            result = cursor.fetchall()
 
         return result
 
+#############################################################################################################
+# A function to stream all matching rows from the specified table, in chunks, without holding the whole
+# result set in memory.
+# 
+# Function parameters:
+# 1. table: The table to be queried
+# 2. query_columns_dict: Same as for get_multiple_data (None returns all the rows in the table)
+# 3. chunk_size: The maximum number of rows handed back in each chunk
+# 4. columns: An optional array of the columns (or SQL expressions) to select - all the columns by default
+# 
+# Logic:
+#  The query runs on an unbuffered cursor, so the MySQL server streams the result set and the client only 
+#  ever holds chunk_size rows at a time (fetchmany). This is a generator - each chunk is yielded as a list
+#  of row tuples. The connection stays checked out until the generator is exhausted or closed early - then
+#  the cursor is closed (and any unread rows discarded) and the connection returned.
+#############################################################################################################
+
+    def get_multiple_data_chunked(self, table, query_columns_dict, chunk_size, columns=()):
+        sql, val = Query(table).select(*columns).where_dict(query_columns_dict).to_sql()
+
+        with self._connection() as connection:
+            cursor = self._instrumented(connection.cursor(buffered=False))
+            exhausted = False
+            try:
+                cursor.execute(sql, val)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        exhausted = True
+                        break
+                    yield rows
+            finally:
+                if not exhausted:
+                    connection.consume_results()
+                cursor.close()
+
+#############################################################################################################
+# A helper function that builds the WHERE clause (with a leading space), and its parameter values, from the
+# query_columns_dict format described above. An empty or None query_columns_dict gives no WHERE clause.
+#############################################################################################################
+
+    def _build_where_clause(self, query_columns_dict):
+        return Query(None).where_dict(query_columns_dict).where_clause()
+
 #############################################################################################################
 # A function to insert a single row into the specified table
 # 
@@ -103,10 +297,11 @@ class Database:
 
         val = tuple(query_columns_dict[column_name] for column_name in sorted(query_columns_dict.keys()))
 
-        self.mycursor.execute(sql, val)
-        self.db_handle.commit()
+        with self._cursor() as cursor:
+            cursor.execute(sql, val)
+            row_count = cursor.rowcount
 
-        return self.mycursor.rowcount
+        return row_count
 
 #############################################################################################################
 # A function to insert multiple rows into the specified table
@@ -120,14 +315,263 @@ class Database:
 # Logic:
 #  The function dynamically constructs an SQL INSERT query using the column names, and passes in the array 
 #  of tuples to be inserted as rows - and runs it with the MySQL database.
+#
+#  If ignore_duplicates is set, a single multi-row INSERT IGNORE statement is run instead: rows that clash 
+#  with an existing row on a unique key are skipped rather than failing the statement. The number of rows
+#  actually inserted is returned.
 #############################################################################################################
 
-    def insert_multiple_data(self, table, columns, multiple_data):
+    def insert_multiple_data(self, table, columns, multiple_data, ignore_duplicates=False):
         column_names = ",".join(columns)
         column_holders = ",".join([f"%s" for column_name in columns])
+
+        if (ignore_duplicates):
+            return self._insert_multi_row(self._backend.insert_ignore(table, column_names), '', columns, multiple_data)
+
         sql = f"INSERT INTO {table} ({column_names}) VALUES ({column_holders})"
 
-        self.mycursor.executemany(sql, multiple_data)
-        self.db_handle.commit()
+        with self._cursor() as cursor:
+            cursor.executemany(sql, multiple_data)
+            row_count = cursor.rowcount
+
+        return row_count
+
+#############################################################################################################
+# A function to bulk load a CSV file into the specified table
+# 
+# Function parameters:
+# 1. table: The table to be loaded into
+# 2. columns: An array that specifies the table column names, in the order of the CSV fields.
+# 3. file_path: The path of the (client side) CSV file - comma separated fields, one row per line.
+# 
+# Logic:
+#  The function runs a LOAD DATA LOCAL INFILE statement, which needs the allow_local_infile configuration.
+#  Rows that clash with an existing row on a unique key are skipped. The number of rows loaded is returned.
+#
+#  A backend without LOAD DATA (SQLite) reads the file itself, and inserts its rows in batches with
+#  insert_multiple_data, skipping duplicates the same way - inside one transaction.
+#############################################################################################################
+
+    LOAD_BATCH_ROWS = 5000
+
+    def load_data_file(self, table, columns, file_path):
+        if (not self._backend.supports_load_data_file):
+            return self._load_data_file_in_batches(table, columns, file_path)
+
+        column_names = ",".join(columns)
+        sql = (f"LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE {table} "
+               f"FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' LINES TERMINATED BY '\\n' ({column_names})")
+
+        with self._cursor() as cursor:
+            cursor.execute(sql, (file_path,))
+            row_count = cursor.rowcount
+
+        return row_count
+
+    def _load_data_file_in_batches(self, table, columns, file_path):
+        row_count = 0
+
+        with open(file_path, newline='') as data_fh, self.transaction():
+            rows = []
+            for row in csv.reader(data_fh):
+                rows.append(row)
+                if (len(rows) >= Database.LOAD_BATCH_ROWS):
+                    row_count += self.insert_multiple_data(table, columns, rows, ignore_duplicates=True)
+                    rows = []
+
+            row_count += self.insert_multiple_data(table, columns, rows, ignore_duplicates=True)
+
+        return row_count
+
+#############################################################################################################
+# A function to update all matching rows of the specified table
+# 
+# Function parameters:
+# 1. table: The table to be updated
+# 2. update_columns_dict: A dictionary of the column names to be set, along with their new values.
+# 3. query_columns_dict: A dictionary that specifies the UPDATE query matching clauses, in the same format
+#                        as for get_multiple_data.
+# 
+# Logic:
+#  The function dynamically constructs an SQL UPDATE query - and runs it with the MySQL database.
+#  The number of rows updated is returned.
+#############################################################################################################
+
+    def update_data(self, table, update_columns_dict, query_columns_dict):
+        set_list = ",".join([f"{column_name} = %s" for column_name in sorted(update_columns_dict.keys())])
+        where_clause, where_val = self._build_where_clause(query_columns_dict)
+        sql = f"UPDATE {table} SET {set_list}{where_clause}"
+
+        val = tuple(update_columns_dict[column_name] for column_name in sorted(update_columns_dict.keys())) + where_val
+
+        with self._cursor() as cursor:
+            cursor.execute(sql, val)
+            row_count = cursor.rowcount
+
+        return row_count
+
+#############################################################################################################
+# A function to delete all matching rows from the specified table
+# 
+# Function parameters:
+# 1. table: The table to be deleted from
+# 2. query_columns_dict: A dictionary that specifies the DELETE query matching clauses, in the same format
+#                        as for get_multiple_data. If it is empty (or None), all the rows are deleted.
+#############################################################################################################
+
+    def delete_data(self, table, query_columns_dict):
+        where_clause, val = self._build_where_clause(query_columns_dict)
+        sql = f"DELETE FROM {table}{where_clause}"
+
+        with self._cursor() as cursor:
+            cursor.execute(sql, val)
+            row_count = cursor.rowcount
+
+        return row_count
+
+#############################################################################################################
+# A function to aggregate rows of one table, and insert the aggregated rows into another - all inside the
+# database, without moving the source rows to the client.
+# 
+# Function parameters:
+# 1. table: The table to be inserted into
+# 2. columns: An array that specifies the INSERT query matching column names.
+# 3. source_table: The table to be aggregated
+# 4. select_expressions: An array of SQL expressions (one per column) computed for each group,
+#                        e.g. 'device_id' or 'MAX(data_value)'
+# 5. group_by_expressions: An array of SQL expressions the source rows are grouped by
+# 6. query_columns_dict: A dictionary that restricts the source rows, in the same format as for 
+#                        get_multiple_data. If it is empty (or None), the whole source table is aggregated.
+# 7. update_columns: An optional array of column names. If given, an aggregated row that clashes with an 
+#                    existing row on a unique key overwrites these columns of it, instead of failing.
+# 
+# Logic:
+#  The function dynamically constructs an INSERT INTO ... SELECT ... GROUP BY query and runs it with the
+#  MySQL database. The number of rows inserted is returned.
+#############################################################################################################
+
+    def insert_aggregated_data(self, table, columns, source_table, select_expressions, group_by_expressions, 
+                               query_columns_dict, update_columns=None):
+        column_names = ",".join(columns)
+        select_list = ",".join(select_expressions)
+        group_by_list = ",".join(group_by_expressions)
+        where_clause, val = self._build_where_clause(query_columns_dict)
+        sql = (f"INSERT INTO {table} ({column_names}) "
+               f"SELECT {select_list} FROM {source_table}{where_clause} GROUP BY {group_by_list}")
+
+        if (update_columns):
+            sql += self._backend.upsert_clause(update_columns)
+
+        with self._cursor() as cursor:
+            cursor.execute(sql, val)
+            row_count = cursor.rowcount
+
+        return row_count
+
+#############################################################################################################
+# A helper function that inserts rows with multi-row statements - the INSERT prefix, the VALUES lists, and an
+# optional suffix (an upsert clause). A backend may cap the parameters of a statement: the rows are then split
+# into as few statements as it allows. The number of rows affected is returned.
+#############################################################################################################
+
+    def _insert_multi_row(self, insert_sql, suffix_sql, columns, multiple_data):
+        if (not multiple_data):
+            return 0
+
+        column_holders = ",".join([f"%s" for column_name in columns])
+
+        rows_per_statement = len(multiple_data)
+        if (self._backend.max_parameters is not None):
+            rows_per_statement = max(1, self._backend.max_parameters // len(columns))
+
+        row_count = 0
+        with self._cursor() as cursor:
+            for start in range(0, len(multiple_data), rows_per_statement):
+                rows = multiple_data[start:start + rows_per_statement]
+                row_holders = ",".join([f"({column_holders})" for _ in rows])
+                sql = f"{insert_sql} VALUES {row_holders}{suffix_sql}"
+                val = tuple(value for data in rows for value in data)
+
+                cursor.execute(sql, val)
+                row_count += cursor.rowcount
+
+        return row_count
+
+#############################################################################################################
+# A function to insert a single row into the specified table, or update it if it already exists
+# 
+# Function parameters:
+# 1. table: The table to be inserted into
+# 2. query_columns_dict: A dictionary that specifies the column names, along with the values to be inserted 
+#                        as a row - one value for each matching column name.
+# 3. update_columns: An array of the column names that are overwritten with the new values, when a row
+#                    with the same primary (or unique) key already exists.
+# 
+# Logic:
+#  The function dynamically constructs an SQL INSERT ... ON DUPLICATE KEY UPDATE query - and runs it with 
+#  the MySQL database.
+#############################################################################################################
+
+    def upsert_single_data(self, table, query_columns_dict, update_columns):
+        column_names = ",".join([f"{column_name}" for column_name in sorted(query_columns_dict.keys())])
+        column_holders = ",".join([f"%s" for column_name in sorted(query_columns_dict.keys())])
+        sql = f"INSERT INTO {table} ({column_names}) VALUES ({column_holders}){self._backend.upsert_clause(update_columns)}"
+
+        val = tuple(query_columns_dict[column_name] for column_name in sorted(query_columns_dict.keys()))
+
+        with self._cursor() as cursor:
+            cursor.execute(sql, val)
+            row_count = cursor.rowcount
+
+        return row_count
+
+#############################################################################################################
+# A function to insert multiple rows into the specified table, or update the ones that already exist - with
+# multi-row statements (see _insert_multi_row).
+# 
+# Function parameters:
+# 1. table: The table to be inserted into
+# 2. columns: An array of the column names, in the order of the values of each row
+# 3. multiple_data: An array of tuples, one per row
+# 4. update_columns: An array of the column names that are overwritten with the new values, when a row
+#                    with the same primary (or unique) key already exists.
+# 5. newer_column: If given, an existing row is only updated if the new row has a greater value in this 
+#                  column (e.g. a later timestamp) - so that concurrent or out of order writers never move 
+#                  it backwards.
+#############################################################################################################
+
+    def upsert_multiple_data(self, table, columns, multiple_data, update_columns, newer_column=None):
+        column_names = ",".join(columns)
+
+        if (newer_column is None):
+            upsert_clause = self._backend.upsert_clause(update_columns)
+        else:
+            upsert_clause = self._backend.upsert_newer_clause(table, update_columns, newer_column)
+
+        return self._insert_multi_row(f"INSERT INTO {table} ({column_names})", upsert_clause, columns, multiple_data)
+
+#############################################################################################################
+# Functions to run a raw SQL statement - for schema management (migrations) and other statements that the
+# table oriented functions above cannot express.
+#
+# run_query returns all the rows of the result (and the result column names, if with_column_names is set). 
+# run_statement returns the number of rows affected.
+#############################################################################################################
+
+    def run_query(self, sql, val=(), with_column_names=False):
+        with self._cursor() as cursor:
+            cursor.execute(sql, val)
+            result = cursor.fetchall()
+            column_names = cursor.column_names
+
+        if (with_column_names):
+            return result, column_names
+
+        return result
+
+    def run_statement(self, sql, val=()):
+        with self._cursor() as cursor:
+            cursor.execute(sql, val)
+            row_count = cursor.rowcount
 
-        return self.mycursor.rowcount
+        return row_count
@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import random
+import socket
+import sys
+import time
+from datetime import datetime, timedelta
+
+from data_generator import generate_devices
+from ingest_server import DEFAULT_TCP_PORT, DEFAULT_UDP_PORT
+
+#######################################################################################
+# A load generator for the ingestion server.
+#
+# It simulates device_count devices (the DTnnnnnn / DHnnnnnn devices of
+# data_generator.generate_devices - load them first with data_generator.py --devices N,
+# or the readings are rejected), spread over a number of TCP connections (or UDP
+# sockets). Every device sends a reading per round, and the reading timestamps advance
+# by interval seconds each round, starting from start - so every reading is new to the
+# database. rate caps the total readings sent per second (0 - as fast as possible).
+#
+# It prints the readings sent, and the achieved rate.
+#######################################################################################
+
+SEND_BATCH_LINES = 500
+
+async def _send_tcp(host, port, device_ids, rounds, start, interval, pacer, seed):
+    _, writer = await asyncio.open_connection(host, port)
+    sent = await _send_lines(device_ids, rounds, start, interval, pacer, seed, writer.write, writer.drain)
+
+    writer.close()
+    await writer.wait_closed()
+    return sent
+
+async def _send_udp(host, port, device_ids, rounds, start, interval, pacer, seed):
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.connect((host, port))
+
+    async def no_drain():
+        pass
+
+    # Keep datagrams well below the usual MTU - 20 lines of about 35 bytes
+
+    def send(data):
+        lines = data.splitlines(keepends=True)
+        for i in range(0, len(lines), 20):
+            udp_socket.send(b''.join(lines[i:i + 20]))
+
+    try:
+        return await _send_lines(device_ids, rounds, start, interval, pacer, seed, send, no_drain)
+    finally:
+        udp_socket.close()
+
+async def _send_lines(device_ids, rounds, start, interval, pacer, seed, send, drain):
+    rand = random.Random(seed)
+    sent = 0
+    lines = []
+
+    for round_number in range(rounds):
+        timestamp = (start + interval * round_number).strftime('%Y-%m-%d %H:%M:%S')
+
+        for device_id in device_ids:
+            lines.append(f'{device_id},{rand.gauss(24, 2.2):.2f},{timestamp}\n')
+
+            if (len(lines) >= SEND_BATCH_LINES):
+                await pacer.wait(len(lines))
+                send(''.join(lines).encode())
+                await drain()
+                sent += len(lines)
+                lines = []
+
+    if (lines):
+        await pacer.wait(len(lines))
+        send(''.join(lines).encode())
+        await drain()
+        sent += len(lines)
+
+    return sent
+
+#######################################################################################
+# A helper class that spaces out the sends of all the connections, to keep the total
+# rate at most rate readings per second.
+#######################################################################################
+
+class _Pacer:
+
+    def __init__(self, rate):
+        self._rate = rate
+        self._next_time = time.monotonic()
+
+    async def wait(self, count):
+        if (not self._rate):
+            await asyncio.sleep(0)
+            return
+
+        now = time.monotonic()
+        send_time = max(self._next_time, now)
+        self._next_time = send_time + count / self._rate
+
+        if (send_time > now):
+            await asyncio.sleep(send_time - now)
+
+async def run_load(host, port, device_count, connections, rounds, start, interval, rate=0, udp=False, seed=None):
+    device_ids = [device[0] for device in generate_devices(device_count)]
+    pacer = _Pacer(rate)
+    send = _send_udp if udp else _send_tcp
+
+    senders = []
+    for number in range(connections):
+        connection_seed = None if seed is None else seed + number
+        senders.append(send(host, port, device_ids[number::connections], rounds, start, interval, pacer, connection_seed))
+
+    return sum(await asyncio.gather(*senders))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Send synthetic readings to the ingestion server')
+    parser.add_argument('--host', default='127.0.0.1', help='address of the ingestion server')
+    parser.add_argument('--port', type=int, default=None, help='port of the ingestion server')
+    parser.add_argument('--udp', action='store_true', help='send over UDP instead of TCP')
+    parser.add_argument('--devices', type=int, default=1000, help='number of simulated devices')
+    parser.add_argument('--connections', type=int, default=10, help='number of concurrent connections')
+    parser.add_argument('--rounds', type=int, default=100, help='readings sent by each device')
+    parser.add_argument('--start', type=datetime.fromisoformat, default=datetime(2022, 1, 1),
+                        help='timestamp of the first reading, ISO format (default: 2022-01-01)')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between the readings of a device')
+    parser.add_argument('--rate', type=float, default=0, help='total readings per second (0 - unlimited)')
+    parser.add_argument('--seed', type=int, default=None, help='random seed, to reproduce the values')
+    args = parser.parse_args(args)
+
+    port = args.port or (DEFAULT_UDP_PORT if args.udp else DEFAULT_TCP_PORT)
+    connections = max(1, min(args.connections, args.devices))
+
+    started = time.perf_counter()
+    sent = asyncio.run(run_load(args.host, port, args.devices, connections, args.rounds, args.start,
+                                timedelta(seconds=args.interval), args.rate, args.udp, args.seed))
+    elapsed = time.perf_counter() - started
+
+    print(f'Sent {sent} readings in {elapsed:.2f}s ({sent / elapsed:.0f} readings/s)')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,401 @@
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import signal
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+from cache import LRUCache
+from config import load_db_config
+from database import Database
+from model import DeviceModel, WeatherDataModel
+from rolling import RollingStats
+from spool import Spool, SpoolReplayer
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_TCP_PORT = 7070
+DEFAULT_UDP_PORT = 7071
+
+#######################################################################################
+# The ingestion service: a long-running asyncio server that takes device readings and
+# writes them to the weather_data table in micro-batches.
+#
+# Readings are sent one per line, as device_id,value,timestamp - e.g.
+#   DT001,24.5,2021-12-01 10:30:00
+# over TCP (a connection can carry any number of lines), or over UDP (a datagram can
+# carry several lines). Malformed lines are counted and skipped.
+#
+# The readings are put on bounded queues, one per writer task. The writers take them
+# off in batches of up to batch_size readings - or whatever arrived within
+# flush_interval seconds of the first reading of a batch - and write each batch with
+# WeatherDataModel.insert_many in a thread pool, so the event loop never waits on the
+# database. insert_many checks the devices against the registry (through a DeviceModel
+# with a cache), and the unique key on (device_id, data_timestamp) drops repeated
+# readings.
+#
+# The readings of a device always go to the same queue (by a hash of the device_id),
+# so they are written - and added to the rolling statistics - in the order they
+# arrived: batches of different writers can finish in any order, and the rolling
+# windows would take the readings of an older batch that finishes last for late ones.
+#
+# Backpressure: when the database falls behind, the queues fill up, and the TCP
+# handlers stop reading from their sockets until there is room again - so the senders
+# are slowed down by TCP flow control instead of the server buffering without bound.
+# UDP has no flow control: readings that arrive while their queue is full are dropped
+# (and counted).
+#
+# With a spool directory, the batches are appended to a durable local spool (see
+# spool.py) instead, and a SpoolReplayer writes them to the database in the background
+# - the queue then drains at the speed of the local disk, whatever the database does.
+#
+# With a rolling statistics snapshot file, the server keeps rolling-window statistics
+# of every device (see rolling.py) as it writes the readings - restored from the
+# snapshot at startup if it exists, warmed up from the database otherwise - and saves
+# the snapshot again when it stops. They are exposed by the rolling_stats property.
+#
+# On SIGINT or SIGTERM the server stops accepting readings, writes out everything
+# already queued, and exits.
+#######################################################################################
+
+class IngestServer:
+    DEFAULT_QUEUE_SIZE = 100000
+    DEFAULT_BATCH_SIZE = 5000
+    DEFAULT_FLUSH_INTERVAL = 0.2
+    DEFAULT_WRITERS = 2
+
+    WRITE_ATTEMPTS = 8
+    RETRY_INTERVAL = 0.1
+    MAX_RETRY_INTERVAL = 30
+
+    DEVICE_CACHE_TTL = 300
+    DEVICE_CACHE_NEGATIVE_TTL = 30
+
+    def __init__(self, db_config, host=DEFAULT_HOST, tcp_port=DEFAULT_TCP_PORT, udp_port=DEFAULT_UDP_PORT,
+                 queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 writers=DEFAULT_WRITERS, spool_directory=None, rolling_snapshot=None,
+                 rolling_windows=RollingStats.DEFAULT_WINDOWS):
+        self._host = host
+        self._tcp_port = tcp_port
+        self._udp_port = udp_port
+        self._queue_size = queue_size
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._writers = writers
+
+        self._db = Database(db_config)
+        device_cache = LRUCache(ttl=IngestServer.DEVICE_CACHE_TTL, negative_ttl=IngestServer.DEVICE_CACHE_NEGATIVE_TTL)
+        device_model = DeviceModel(db_config, self._db, device_cache)
+        self._weather_data_model = WeatherDataModel(db_config, self._db, device_model)
+
+        self._rolling_snapshot = rolling_snapshot
+        if (rolling_snapshot is not None):
+            if (os.path.exists(rolling_snapshot)):
+                rolling_stats = RollingStats.load(rolling_snapshot)
+            else:
+                rolling_stats = RollingStats(rolling_windows)
+                rolling_stats.warm_up(self._weather_data_model)
+            self._weather_data_model.rolling_stats = rolling_stats
+
+        self._spool = None
+        self._replayer = None
+        if (spool_directory is not None):
+            self._spool = Spool(spool_directory)
+            self._replayer = SpoolReplayer(self._spool, self._weather_data_model, self._db, batch_size)
+
+        self._queues = None
+        self._executor = ThreadPoolExecutor(max_workers=writers)
+        self._stopping = None
+        self._connections = set()
+
+        self._counts = {
+            'received': 0,
+            'malformed': 0,
+            'dropped': 0,
+            'inserted': 0,
+            'duplicate': 0,
+            'rejected': 0,
+            'failed': 0,
+            'retries': 0,
+            'spooled': 0,
+            'batches': 0
+        }
+
+    def stats(self):
+        stats = dict(self._counts)
+        stats['queued'] = sum(queue.qsize() for queue in self._queues) if self._queues is not None else 0
+        if (self._replayer is not None):
+            stats['spool'] = self._replayer.stats()
+        if (self.rolling_stats is not None):
+            stats['rolling'] = self.rolling_stats.counts()
+        return stats
+
+    @property
+    def rolling_stats(self):
+        return self._weather_data_model.rolling_stats
+
+#######################################################################################
+# A function to run the server until stop is called (or a SIGINT / SIGTERM arrives).
+# A udp_port of None runs the TCP listener only.
+#######################################################################################
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self._queues = [asyncio.Queue(maxsize=max(1, self._queue_size // self._writers)) for _ in range(self._writers)]
+        self._stopping = asyncio.Event()
+
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        tcp_server = await asyncio.start_server(self._handle_connection, self._host, self._tcp_port)
+
+        udp_transport = None
+        if (self._udp_port is not None):
+            udp_transport, _ = await loop.create_datagram_endpoint(lambda: _DatagramProtocol(self),
+                                                                   local_addr=(self._host, self._udp_port))
+
+        if (self._replayer is not None):
+            self._replayer.start()
+
+        writer_tasks = [asyncio.create_task(self._write_batches(queue)) for queue in self._queues]
+        print(f'Ingesting on TCP {self._host}:{self._tcp_port}' +
+              (f' and UDP {self._host}:{self._udp_port}' if udp_transport else ''))
+
+        await self._stopping.wait()
+
+        # Stop taking readings, then let the writers drain the queues
+
+        tcp_server.close()
+        if (udp_transport is not None):
+            udp_transport.close()
+        for connection in list(self._connections):
+            connection.cancel()
+        await asyncio.gather(*list(self._connections), return_exceptions=True)
+        await tcp_server.wait_closed()
+
+        for queue in self._queues:
+            await queue.join()
+        for task in writer_tasks:
+            task.cancel()
+        await asyncio.gather(*writer_tasks, return_exceptions=True)
+
+        self._executor.shutdown(wait=True)
+
+        if (self._replayer is not None):
+            await loop.run_in_executor(None, self._replayer.stop)
+            self._spool.close()
+
+        if (self._rolling_snapshot is not None):
+            self.rolling_stats.save(self._rolling_snapshot)
+
+        print(f'Ingestion stopped: {self.stats()}')
+
+    def stop(self):
+        if (self._stopping is not None):
+            self._stopping.set()
+
+#######################################################################################
+# The TCP connection handler. queue.put waits while the queue is full - and the
+# handler stops reading from the socket meanwhile, which is the backpressure.
+#######################################################################################
+
+    def _queue_for(self, device_id):
+        return self._queues[zlib.crc32(device_id.encode()) % len(self._queues)]
+
+    async def _handle_connection(self, reader, writer):
+        self._connections.add(asyncio.current_task())
+        try:
+            while True:
+                line = await reader.readline()
+                if (not line):
+                    break
+
+                reading = self._parse(line)
+                if (reading is not None):
+                    await self._queue_for(reading[0]).put(reading)
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            self._connections.discard(asyncio.current_task())
+            writer.close()
+
+    def _handle_datagram(self, data):
+        for line in data.splitlines():
+            reading = self._parse(line)
+            if (reading is None):
+                continue
+
+            try:
+                self._queue_for(reading[0]).put_nowait(reading)
+            except asyncio.QueueFull:
+                self._counts['dropped'] += 1
+
+#######################################################################################
+# A helper function that parses a device_id,value,timestamp line into a reading for
+# insert_many - or returns None (and counts it) if the line is malformed. A value that
+# Decimal takes but that is not a finite number (nan, inf, snan) is malformed too.
+# Blank lines are skipped silently.
+#######################################################################################
+
+    def _parse(self, line):
+        line = line.strip()
+        if (not line):
+            return None
+
+        self._counts['received'] += 1
+
+        try:
+            device_id, value, timestamp = line.decode().split(',')
+            value = Decimal(value)
+            if (not value.is_finite()):
+                raise ValueError(f'Value {value} is not a finite number')
+            return (device_id.strip(), value, datetime.datetime.fromisoformat(timestamp.strip()))
+        except (ValueError, InvalidOperation, UnicodeDecodeError):
+            self._counts['malformed'] += 1
+            return None
+
+#######################################################################################
+# The writer task of a queue: it waits for a first reading, gathers more until the
+# batch is full or flush_interval has passed, and writes the batch (or appends it to
+# the spool) in the thread pool - one batch at a time, so that the readings of each
+# device are written in order.
+#
+# The readings are already acknowledged, so a batch that fails with a transient error
+# (a deadlock or a lock wait timeout - expected with several writers upserting the
+# latest_reading rows - or a lost connection, see is_transient_error in backends.py) is
+# written again, waiting twice as long each time, up to WRITE_ATTEMPTS attempts. Every
+# write is a single transaction of a batch whose duplicates are ignored, so writing it
+# again is safe. A batch that fails otherwise, or too many times, is counted, logged
+# and dropped - the server keeps going.
+#######################################################################################
+
+    async def _write_batches(self, queue):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self._flush_interval
+
+            while (len(batch) < self._batch_size):
+                try:
+                    batch.append(queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+
+                timeout = deadline - loop.time()
+                if (timeout <= 0):
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self._write_batch(loop, batch)
+            finally:
+                self._counts['batches'] += 1
+                for _ in batch:
+                    queue.task_done()
+
+    async def _write_batch(self, loop, batch):
+        retry_interval = IngestServer.RETRY_INTERVAL
+
+        for attempt in range(1, IngestServer.WRITE_ATTEMPTS + 1):
+            try:
+                if (self._spool is not None):
+                    await loop.run_in_executor(self._executor, self._spool.append_many, batch)
+                    self._counts['spooled'] += len(batch)
+                else:
+                    counts = await loop.run_in_executor(self._executor, self._weather_data_model.insert_many,
+                                                        batch, self._batch_size)
+                    for name in ('inserted', 'duplicate', 'rejected'):
+                        self._counts[name] += counts[name]
+                return
+            except Exception as error:
+                if (self._spool is None and attempt < IngestServer.WRITE_ATTEMPTS
+                        and self._db.dialect.is_transient_error(error)):
+                    self._counts['retries'] += 1
+                    logger.warning('Failed to write a batch of %d readings, retrying in %.1fs: %s',
+                                   len(batch), retry_interval, error)
+                    await asyncio.sleep(retry_interval)
+                    retry_interval = min(retry_interval * 2, IngestServer.MAX_RETRY_INTERVAL)
+                    continue
+
+                self._counts['failed'] += len(batch)
+                logger.error('Dropped a batch of %d readings after %d attempts: %s', len(batch), attempt, error)
+                return
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        self._server = server
+
+    def datagram_received(self, data, addr):
+        self._server._handle_datagram(data)
+
+#######################################################################################
+# The command line entry point:
+#   python ingest_server.py [--tcp-port PORT] [--udp-port PORT] [--batch-size N] ...
+#######################################################################################
+
+async def _report_stats(server, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print(json.dumps(server.stats()))
+
+async def _run(server, stats_interval):
+    reporter = None
+    if (stats_interval):
+        reporter = asyncio.create_task(_report_stats(server, stats_interval))
+
+    try:
+        await server.serve()
+    finally:
+        if (reporter is not None):
+            reporter.cancel()
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run the weather data ingestion server')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on')
+    parser.add_argument('--tcp-port', type=int, default=DEFAULT_TCP_PORT, help='TCP port for line-delimited readings')
+    parser.add_argument('--udp-port', type=int, default=DEFAULT_UDP_PORT, help='UDP port for readings (0 to disable)')
+    parser.add_argument('--queue-size', type=int, default=IngestServer.DEFAULT_QUEUE_SIZE,
+                        help='readings buffered (across the writer queues) before the senders are slowed down')
+    parser.add_argument('--batch-size', type=int, default=IngestServer.DEFAULT_BATCH_SIZE, help='readings per write')
+    parser.add_argument('--flush-interval', type=float, default=IngestServer.DEFAULT_FLUSH_INTERVAL,
+                        help='seconds a reading waits at most for its batch to fill')
+    parser.add_argument('--writers', type=int, default=IngestServer.DEFAULT_WRITERS, help='concurrent batch writes (each device is written by one of them)')
+    parser.add_argument('--spool', default=None, metavar='DIRECTORY',
+                        help='write the readings to a durable local spool first, and replay it into the database')
+    parser.add_argument('--rolling-snapshot', default=None, metavar='FILE',
+                        help='keep rolling-window statistics of the devices, saved to (and restored from) this file')
+    parser.add_argument('--rolling-windows', type=lambda text: [int(window) for window in text.split(',')],
+                        default=list(RollingStats.DEFAULT_WINDOWS), help='comma separated rolling window lengths, in seconds')
+    parser.add_argument('--stats-interval', type=float, default=10, help='seconds between stats lines (0 to disable)')
+    parser.add_argument('--config', default=None,
+                        help='path of the db.json configuration file (default: $WDM_CONFIG, or ../config/db.json)')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    db_config = load_db_config(args.config)
+
+    server = IngestServer(db_config, args.host, args.tcp_port, args.udp_port or None, args.queue_size,
+                          args.batch_size, args.flush_interval, args.writers, args.spool, args.rolling_snapshot,
+                          args.rolling_windows)
+    asyncio.run(_run(server, args.stats_interval))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
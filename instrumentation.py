@@ -0,0 +1,356 @@
+import bisect
+import collections
+import datetime
+import functools
+import json
+import math
+import re
+import sys
+import threading
+import time
+
+#############################################################################################################
+# Query instrumentation for the database layer.
+#
+# Once an Instrumentation is attached to a Database (or installed for the whole process, with install), every
+# statement the Database runs is timed - the execute and the fetches of its result together - and recorded
+# under its query shape (the SQL text, with the value lists of multi-row INSERTs and IN clauses collapsed)
+# and the model method that issued it, e.g. WeatherDataModel.find_by_device_id_and_timestamp. For each
+# (shape, caller) pair it keeps a latency histogram, the number of statements, and the rows returned and
+# affected. The time spent waiting for a pooled connection is recorded too.
+#
+# Statements slower than slow_query_threshold seconds also go to the slow query log: the latest ones are kept
+# in memory (slow_queries), and each is written as a JSON line to slow_query_stream, if one is given.
+#
+# snapshot gives the statistics as a dictionary; to_json and to_prometheus render it, and write_snapshot
+# writes it to a file (in the Prometheus text exposition format, or JSON).
+#
+# Without an Instrumentation, the Database only checks for one - the overhead is a None check per call.
+# Finding the caller walks the stack, so it can be turned off (attribute_callers) to make instrumentation
+# itself cheaper.
+#############################################################################################################
+
+class Instrumentation:
+    # Upper bounds of the latency histogram buckets, in seconds (the Prometheus convention - the last bucket
+    # is unbounded)
+
+    LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    DEFAULT_SLOW_QUERY_LOG_SIZE = 100
+
+    METRIC_PREFIX = 'weather_db'
+
+    def __init__(self, slow_query_threshold=None, slow_query_stream=None, slow_query_log_size=DEFAULT_SLOW_QUERY_LOG_SIZE,
+                 attribute_callers=True):
+        self._slow_query_threshold = slow_query_threshold
+        self._slow_query_stream = slow_query_stream
+        self._attribute_callers = attribute_callers
+
+        self._lock = threading.Lock()
+        self._statements = {}
+        self._wait = _Histogram()
+        self._slow_queries = collections.deque(maxlen=slow_query_log_size)
+        self._slow_query_count = 0
+        self._started = time.time()
+
+    @property
+    def slow_queries(self):
+        with self._lock:
+            return list(self._slow_queries)
+
+    def reset(self):
+        with self._lock:
+            self._statements = {}
+            self._wait = _Histogram()
+            self._slow_queries.clear()
+            self._slow_query_count = 0
+            self._started = time.time()
+
+#############################################################################################################
+# Functions the database layer reports to: a statement that ran (its SQL and parameters, how long it took
+# in all, and the rows it returned and affected), and a wait for a pooled connection.
+#############################################################################################################
+
+    def caller(self):
+        if (not self._attribute_callers):
+            return None
+
+        return _find_caller(sys._getframe(1))
+
+    def record_statement(self, sql, val, seconds, rows_returned, rows_affected, caller):
+        shape = query_shape(sql)
+        slow = self._slow_query_threshold is not None and seconds >= self._slow_query_threshold
+
+        with self._lock:
+            statistics = self._statements.get((shape, caller))
+            if (statistics is None):
+                statistics = self._statements[(shape, caller)] = _StatementStatistics()
+            statistics.add(seconds, rows_returned, rows_affected)
+
+            if (not slow):
+                return
+
+            entry = {
+                'time': datetime.datetime.now().isoformat(sep=' ', timespec='milliseconds'),
+                'seconds': seconds,
+                'caller': caller,
+                'statement': shape,
+                'parameters': _truncate(repr(tuple(val)), 200),
+                'rows_returned': rows_returned,
+                'rows_affected': rows_affected
+            }
+            self._slow_queries.append(entry)
+            self._slow_query_count += 1
+
+            if (self._slow_query_stream is not None):
+                self._slow_query_stream.write(json.dumps(entry) + '\n')
+                self._slow_query_stream.flush()
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self._wait.add(seconds)
+
+#############################################################################################################
+# Functions to get the statistics: snapshot gives a dictionary (one entry per shape and caller, slowest in
+# total first), to_json and to_prometheus render it as text, and write_snapshot writes it to a file.
+#############################################################################################################
+
+    def snapshot(self):
+        with self._lock:
+            statements = [dict(statistics.as_dict(), statement=shape, caller=caller)
+                          for (shape, caller), statistics in self._statements.items()]
+            snapshot = {
+                'since': datetime.datetime.fromtimestamp(self._started).isoformat(sep=' ', timespec='seconds'),
+                'statements': sorted(statements, key=lambda statistics: statistics['seconds'], reverse=True),
+                'connection_wait': self._wait.as_dict(),
+                'slow_queries': self._slow_query_count
+            }
+
+        return snapshot
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        prefix = Instrumentation.METRIC_PREFIX
+        lines = []
+
+        lines.append(f'# HELP {prefix}_query_seconds Time spent running statements, by query shape and caller')
+        lines.append(f'# TYPE {prefix}_query_seconds histogram')
+        for statistics in snapshot['statements']:
+            labels = f'statement="{_escape_label(statistics["statement"])}",caller="{_escape_label(statistics["caller"] or "")}"'
+            _histogram_lines(lines, f'{prefix}_query_seconds', labels, statistics)
+
+        for name, help_text in [('rows_returned', 'Rows returned by statements'), ('rows_affected', 'Rows affected by statements')]:
+            lines.append(f'# HELP {prefix}_query_{name}_total {help_text}, by query shape and caller')
+            lines.append(f'# TYPE {prefix}_query_{name}_total counter')
+            for statistics in snapshot['statements']:
+                labels = f'statement="{_escape_label(statistics["statement"])}",caller="{_escape_label(statistics["caller"] or "")}"'
+                lines.append(f'{prefix}_query_{name}_total{{{labels}}} {statistics[name]}')
+
+        lines.append(f'# HELP {prefix}_connection_wait_seconds Time spent waiting for a pooled connection')
+        lines.append(f'# TYPE {prefix}_connection_wait_seconds histogram')
+        _histogram_lines(lines, f'{prefix}_connection_wait_seconds', '', snapshot['connection_wait'])
+
+        lines.append(f'# HELP {prefix}_slow_queries_total Statements slower than the slow query threshold')
+        lines.append(f'# TYPE {prefix}_slow_queries_total counter')
+        lines.append(f'{prefix}_slow_queries_total {snapshot["slow_queries"]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write_snapshot(self, file_path, format='prometheus'):
+        text = self.to_prometheus() if format == 'prometheus' else self.to_json() + '\n'
+
+        with open(file_path, 'w') as snapshot_fh:
+            snapshot_fh.write(text)
+
+#############################################################################################################
+# Functions to install an Instrumentation for the whole process - every Database created afterwards, without
+# an instrumentation of its own, uses it - and to get the installed one (None if there is none).
+#############################################################################################################
+
+_installed = None
+
+def install(instrumentation):
+    global _installed
+    _installed = instrumentation
+    return instrumentation
+
+def installed():
+    return _installed
+
+#############################################################################################################
+# The statistics of one (shape, caller) pair, and a latency histogram.
+#############################################################################################################
+
+class _Histogram:
+
+    def __init__(self):
+        self.buckets = [0] * (len(Instrumentation.LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(Instrumentation.LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def percentile(self, fraction):
+        # The upper bound of the bucket the percentile falls in
+
+        rank = math.ceil(fraction * self.count)
+        seen = 0
+        for index, count in enumerate(self.buckets[:-1]):
+            seen += count
+            if (seen >= rank):
+                return Instrumentation.LATENCY_BUCKETS[index]
+
+        return self.max_seconds
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'seconds': self.seconds,
+            'max_seconds': self.max_seconds,
+            'p50_seconds': self.percentile(0.5) if self.count else None,
+            'p99_seconds': self.percentile(0.99) if self.count else None,
+            'buckets': list(self.buckets)
+        }
+
+class _StatementStatistics(_Histogram):
+
+    def __init__(self):
+        super().__init__()
+        self.rows_returned = 0
+        self.rows_affected = 0
+
+    def add(self, seconds, rows_returned, rows_affected):
+        super().add(seconds)
+        self.rows_returned += rows_returned
+        self.rows_affected += rows_affected
+
+    def as_dict(self):
+        return dict(super().as_dict(), rows_returned=self.rows_returned, rows_affected=self.rows_affected)
+
+#############################################################################################################
+# A cursor wrapper that times a statement - its execute, and every fetch of its result - and reports it to
+# the Instrumentation once the next statement runs, or the cursor is finished (finish leaves the underlying
+# cursor open, for the pooled prepared cursors) or closed.
+#############################################################################################################
+
+class InstrumentedCursor:
+
+    def __init__(self, cursor, instrumentation, caller):
+        self._cursor = cursor
+        self._instrumentation = instrumentation
+        self._caller = caller
+        self._statement = None
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def column_names(self):
+        return self._cursor.column_names
+
+    def execute(self, sql, val=()):
+        self.finish()
+
+        started = time.perf_counter()
+        self._cursor.execute(sql, val)
+        self._statement = [sql, val, time.perf_counter() - started, 0, _is_query(sql)]
+
+    def executemany(self, sql, multiple_data):
+        self.finish()
+
+        started = time.perf_counter()
+        self._cursor.executemany(sql, multiple_data)
+        self._statement = [sql, (), time.perf_counter() - started, 0, False]
+
+    def fetchone(self):
+        return self._fetched(self._cursor.fetchone, None, single=True)
+
+    def fetchall(self):
+        return self._fetched(self._cursor.fetchall)
+
+    def fetchmany(self, size):
+        return self._fetched(self._cursor.fetchmany, size)
+
+    def _fetched(self, fetch, size=None, single=False):
+        started = time.perf_counter()
+        result = fetch() if size is None else fetch(size)
+        if (self._statement is not None):
+            self._statement[2] += time.perf_counter() - started
+            self._statement[3] += (result is not None) if single else len(result)
+
+        return result
+
+    def finish(self):
+        if (self._statement is None):
+            return
+
+        sql, val, seconds, rows_returned, is_query = self._statement
+        self._statement = None
+
+        rows_affected = 0
+        if (not is_query):
+            rows_affected = max(self._cursor.rowcount or 0, 0)
+
+        self._instrumentation.record_statement(sql, val, seconds, rows_returned, rows_affected, self._caller)
+
+    def close(self):
+        self.finish()
+        self._cursor.close()
+
+#############################################################################################################
+# Helper functions: the query shape of an SQL text, whether it returns rows, the model method that issued a
+# statement (the first frame outside the database layer), and the Prometheus text rendering.
+#############################################################################################################
+
+_VALUE_LISTS = re.compile(r'(\((?:%s|\?)(?:\s*,\s*(?:%s|\?))*\))(?:\s*,\s*\1)+')
+_IN_LISTS = re.compile(r'\bIN\s*\((?:%s|\?)(?:\s*,\s*(?:%s|\?))*\)', re.IGNORECASE)
+
+@functools.lru_cache(maxsize=1024)
+def query_shape(sql):
+    shape = _VALUE_LISTS.sub(r'\1, ...', sql)
+    return _IN_LISTS.sub('IN (...)', shape)
+
+def _is_query(sql):
+    return sql.lstrip()[:7].upper().startswith(('SELECT', 'WITH', 'EXPLAIN', 'PRAGMA', 'SHOW'))
+
+_DATABASE_LAYER_MODULES = {'database', 'instrumentation', 'backends', 'connection_pool', 'contextlib'}
+
+def _find_caller(frame):
+    while (frame is not None):
+        if (frame.f_globals.get('__name__') not in _DATABASE_LAYER_MODULES):
+            code = frame.f_code
+            instance = frame.f_locals.get('self')
+            if (instance is not None):
+                return f'{type(instance).__name__}.{code.co_name}'
+            return getattr(code, 'co_qualname', code.co_name)
+        frame = frame.f_back
+
+    return None
+
+def _truncate(text, length):
+    return text if len(text) <= length else text[:length - 3] + '...'
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _histogram_lines(lines, name, labels, statistics):
+    separator = ',' if labels else ''
+
+    cumulative = 0
+    for bound, count in zip(Instrumentation.LATENCY_BUCKETS, statistics['buckets']):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {statistics["count"]}')
+
+    label_set = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{label_set} {statistics["seconds"]}')
+    lines.append(f'{name}_count{label_set} {statistics["count"]}')
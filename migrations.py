@@ -0,0 +1,295 @@
+import argparse
+import datetime
+import sys
+from contextlib import contextmanager
+
+from backends import SQLITE
+from config import load_db_config
+from database import Database
+from model import DeviceModel, WeatherDataModel, DailyReportModel
+from partitions import PartitionModel
+
+
+SCHEMA_VERSION_TABLE = 'schema_version'
+
+#######################################################################################
+# The schema migrations.
+#
+# Each migration is a (version, description, function) entry - the function takes a
+# Database and changes the schema in place. Migrations are applied in version order,
+# and each applied version is recorded in the schema_version table, so only the
+# pending ones run. MySQL commits DDL statements implicitly, so a migration is not
+# atomic: every migration checks the current state first, and can be re-run safely
+# after a failure.
+#
+# Where the SQL of the storage backends differs (see backends.py), a migration has a
+# statement per backend - the SQLite schema has the same tables, keys and indexes.
+#
+# New migrations are only ever appended, with the next version number.
+#######################################################################################
+
+def _create_base_tables(db):
+    if (db.dialect.name == SQLITE):
+        db.run_statement('CREATE TABLE IF NOT EXISTS devices (id INTEGER PRIMARY KEY AUTOINCREMENT, device_id VARCHAR(15) NOT NULL UNIQUE, description VARCHAR(127), device_type VARCHAR(31) NOT NULL, manufacturer VARCHAR(63))')
+        db.run_statement('CREATE TABLE IF NOT EXISTS weather_data (id INTEGER PRIMARY KEY AUTOINCREMENT, device_id VARCHAR(31) NOT NULL, data_value DECIMAL(6,2), data_timestamp DATETIME, FOREIGN KEY (device_id) REFERENCES devices(device_id))')
+        db.run_statement('CREATE TABLE IF NOT EXISTS daily_report (id INTEGER PRIMARY KEY AUTOINCREMENT, device_id VARCHAR(31) NOT NULL, avg_value DECIMAL(6,2), min_value DECIMAL(6,2), max_value DECIMAL(6,2), report_date DATETIME, FOREIGN KEY (device_id) REFERENCES devices(device_id))')
+        return
+
+    db.run_statement('CREATE TABLE IF NOT EXISTS devices (id INT NOT NULL AUTO_INCREMENT, device_id VARCHAR(15) NOT NULL UNIQUE, description VARCHAR(127), device_type VARCHAR(31) NOT NULL, manufacturer VARCHAR(63), PRIMARY KEY (id))')
+    db.run_statement('CREATE TABLE IF NOT EXISTS weather_data (id INT NOT NULL AUTO_INCREMENT, device_id VARCHAR(31) NOT NULL, data_value DECIMAL(6,2), data_timestamp DATETIME, PRIMARY KEY (id), FOREIGN KEY (device_id) REFERENCES devices(device_id))')
+    db.run_statement('CREATE TABLE IF NOT EXISTS daily_report (id INT NOT NULL AUTO_INCREMENT, device_id VARCHAR(31) NOT NULL, avg_value DECIMAL(6,2), min_value DECIMAL(6,2), max_value DECIMAL(6,2), report_date DATETIME, PRIMARY KEY (id), FOREIGN KEY (device_id) REFERENCES devices(device_id))')
+
+def _create_report_watermark_table(db):
+    db.run_statement('CREATE TABLE IF NOT EXISTS report_watermark (name VARCHAR(63) NOT NULL, last_id BIGINT NOT NULL, PRIMARY KEY (name))')
+
+def _add_weather_data_key(db):
+    if (_has_index(db, 'weather_data', ['device_id', 'data_timestamp'], unique=True)):
+        return
+
+    # Keep the first reading of a device at a given timestamp, drop the later duplicates
+
+    if (db.dialect.name == SQLITE):
+        db.run_statement('DELETE FROM weather_data WHERE id NOT IN (SELECT MIN(id) FROM weather_data GROUP BY device_id, data_timestamp)')
+        db.run_statement('CREATE UNIQUE INDEX uq_weather_data_device_timestamp ON weather_data (device_id, data_timestamp)')
+        return
+
+    db.run_statement('DELETE newer FROM weather_data newer JOIN weather_data older ON newer.device_id = older.device_id AND newer.data_timestamp = older.data_timestamp AND newer.id > older.id')
+    db.run_statement('ALTER TABLE weather_data ADD UNIQUE KEY uq_weather_data_device_timestamp (device_id, data_timestamp)')
+
+def _add_daily_report_key(db):
+    if (_has_index(db, 'daily_report', ['device_id', 'report_date'], unique=True)):
+        return
+
+    # Keep the most recently generated report of a device for a given date
+
+    if (db.dialect.name == SQLITE):
+        db.run_statement('DELETE FROM daily_report WHERE id NOT IN (SELECT MAX(id) FROM daily_report GROUP BY device_id, report_date)')
+        db.run_statement('CREATE UNIQUE INDEX uq_daily_report_device_date ON daily_report (device_id, report_date)')
+        return
+
+    db.run_statement('DELETE older FROM daily_report older JOIN daily_report newer ON older.device_id = newer.device_id AND older.report_date = newer.report_date AND older.id < newer.id')
+    db.run_statement('ALTER TABLE daily_report ADD UNIQUE KEY uq_daily_report_device_date (device_id, report_date)')
+
+def _create_rollup_tables(db):
+    for table in ['rollup_hourly', 'rollup_daily', 'rollup_weekly', 'rollup_monthly']:
+        db.run_statement(f'CREATE TABLE IF NOT EXISTS {table} (device_id VARCHAR(31) NOT NULL, bucket_start DATETIME NOT NULL, sample_count INT NOT NULL, value_sum DECIMAL(16,2), value_sum_sq DECIMAL(24,4), min_value DECIMAL(6,2), max_value DECIMAL(6,2), sketch TEXT, PRIMARY KEY (device_id, bucket_start))')
+
+def _partition_weather_data(db):
+    # SQLite has no partitions - the retention deletes by data_timestamp, through an index of its own
+
+    if (db.dialect.name == SQLITE):
+        db.run_statement('CREATE INDEX IF NOT EXISTS ix_weather_data_timestamp ON weather_data (data_timestamp)')
+        return
+
+    PartitionModel(None, db).partition_table()
+
+def _create_latest_reading_table(db):
+    db.run_statement('CREATE TABLE IF NOT EXISTS latest_reading (device_id VARCHAR(31) NOT NULL, data_value DECIMAL(6,2), data_timestamp DATETIME NOT NULL, PRIMARY KEY (device_id))')
+
+    # The multi-device lookups select the devices by type or manufacturer
+
+    for column in ['device_type', 'manufacturer']:
+        if (not _has_index(db, 'devices', [column])):
+            db.run_statement(f'CREATE INDEX ix_devices_{column} ON devices ({column})')
+
+    WeatherDataModel(None, db).rebuild_latest_readings()
+
+MIGRATIONS = [
+    (1, 'Create the devices, weather_data and daily_report tables', _create_base_tables),
+    (2, 'Create the report_watermark table', _create_report_watermark_table),
+    (3, 'Add the unique (device_id, data_timestamp) key to weather_data', _add_weather_data_key),
+    (4, 'Add the unique (device_id, report_date) key to daily_report', _add_daily_report_key),
+    (5, 'Create the rollup_hourly, rollup_daily, rollup_weekly and rollup_monthly tables', _create_rollup_tables),
+    (6, 'Partition weather_data by month', _partition_weather_data),
+    (7, 'Create the latest_reading table, and backfill it from weather_data', _create_latest_reading_table),
+]
+
+#######################################################################################
+# A helper function that tells whether a table has an index on exactly the given
+# columns, in that order (optionally, a unique one).
+#######################################################################################
+
+def _has_index(db, table, columns, unique=False):
+    return db.dialect.has_index(db, table, columns, unique)
+
+#######################################################################################
+# A function to get the current schema version - 0 for a database that was never
+# migrated.
+#######################################################################################
+
+def current_version(db):
+    db.run_statement(f'CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (version INT NOT NULL, description VARCHAR(255), applied_at DATETIME, PRIMARY KEY (version))')
+
+    result = db.run_query(f'SELECT MAX(version) FROM {SCHEMA_VERSION_TABLE}')
+    return result[0][0] or 0
+
+#######################################################################################
+# A function to apply the pending migrations, in order - up to target_version if it
+# is given, or up to the latest one. It returns the list of the versions applied.
+#######################################################################################
+
+def migrate(db, target_version=None):
+    version = current_version(db)
+    applied = []
+
+    for migration_version, description, apply in MIGRATIONS:
+        if (migration_version <= version):
+            continue
+        if (target_version is not None and migration_version > target_version):
+            break
+
+        print(f'Applying migration {migration_version}: {description}')
+        apply(db)
+
+        db.insert_single_data(SCHEMA_VERSION_TABLE, {
+            'version': migration_version,
+            'description': description,
+            'applied_at': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        })
+        applied.append(migration_version)
+
+    return applied
+
+#######################################################################################
+# The query plan check.
+#
+# It runs the model lookups against an ExplainDatabase - a Database that, instead of
+# executing each statement, records the EXPLAIN output of it. Any lookup whose plan
+# falls back to a full table scan (access type ALL on MySQL, a SCAN step without an
+# index on SQLite) is reported. The find_all functions read whole tables by design,
+# and are not checked.
+#
+# Note the optimizer may prefer a full scan of a nearly empty table, so the check is
+# meant to run against a populated database.
+#######################################################################################
+
+class _ExplainCursor:
+
+    def __init__(self, cursor, db):
+        self._cursor = cursor
+        self._db = db
+        self.rowcount = 0
+
+    def execute(self, sql, val=()):
+        self._cursor.execute(self._db.dialect.explain(sql), val)
+        rows = self._cursor.fetchall()
+        plan = [dict(zip(self._cursor.column_names, row)) for row in rows]
+        self._db.plans.append((self._db.current_check, sql, plan))
+
+    def executemany(self, sql, multiple_data):
+        pass
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+class ExplainDatabase(Database):
+
+    def __init__(self, db_config):
+        super().__init__(db_config)
+        self.plans = []
+        self.current_check = None
+
+    @contextmanager
+    def _cursor(self):
+        with super()._cursor() as cursor:
+            yield _ExplainCursor(cursor, self)
+
+    def _run_prepared(self, sql, val):
+        with self._cursor() as cursor:
+            cursor.execute(sql, val)
+            return cursor.fetchall()
+
+QUERY_PLAN_CHECKS = [
+    ('DeviceModel.find_by_device_id',
+        lambda models: models['device'].find_by_device_id('DT001')),
+    ('WeatherDataModel.find_multiple_by_device_id',
+        lambda models: models['weather_data'].find_multiple_by_device_id('DT001')),
+    ('WeatherDataModel.find_by_device_id_and_timestamp',
+        lambda models: models['weather_data'].find_by_device_id_and_timestamp('DT001', datetime.datetime(2021, 12, 2, 13, 30))),
+    ('WeatherDataModel.iter_by_device_id',
+        lambda models: list(models['weather_data'].iter_by_device_id('DT001', datetime.datetime(2021, 12, 2), datetime.datetime(2021, 12, 4)))),
+    ('WeatherDataModel.find_latest_by_device_id',
+        lambda models: models['weather_data'].find_latest_by_device_id('DT001', 10)),
+    ('WeatherDataModel.find_multiple_by_device_ids',
+        lambda models: models['weather_data'].find_multiple_by_device_ids(['DT001', 'DH001'], datetime.datetime(2021, 12, 2), datetime.datetime(2021, 12, 3))),
+    ('WeatherDataModel.find_latest_by_device_ids',
+        lambda models: models['weather_data'].find_latest_by_device_ids(['DT001', 'DH001'])),
+    ('WeatherDataModel.find_latest_by_device_ids (by device_type)',
+        lambda models: models['weather_data'].find_latest_by_device_ids(device_type='Temperature')),
+    ('WeatherDataModel.find_by_device_id_and_value',
+        lambda models: models['weather_data'].find_by_device_id_and_value('DT001', 22, 26)),
+    ('DailyReportModel.find_by_device_id_and_date',
+        lambda models: models['daily_report'].find_by_device_id_and_date('DT001', datetime.datetime(2021, 12, 2))),
+    ('DailyReportModel.find_by_device_ids_and_date',
+        lambda models: models['daily_report'].find_by_device_ids_and_date(['DT001', 'DH001'], datetime.datetime(2021, 12, 2))),
+    ('DailyReportModel.find_by_device_id_and_date_range',
+        lambda models: models['daily_report'].find_by_device_id_and_date_range('DT001', datetime.datetime(2021, 12, 2), datetime.datetime(2021, 12, 4))),
+    ('DailyReportModel.get_watermark',
+        lambda models: models['daily_report'].get_watermark()),
+    ('DailyReportModel.aggregate_data_in_database (scoped)',
+        lambda models: models['daily_report'].aggregate_data_in_database('DT001', datetime.date(2021, 12, 2))),
+]
+
+def check_query_plans(db_config):
+    db = ExplainDatabase(db_config)
+    models = {
+        'device': DeviceModel(db_config, db),
+        'weather_data': WeatherDataModel(db_config, db),
+        'daily_report': DailyReportModel(db_config, db)
+    }
+
+    for name, check in QUERY_PLAN_CHECKS:
+        db.current_check = name
+        check(models)
+
+    failures = []
+    for name, sql, plan in db.plans:
+        for table in db.dialect.full_scans(plan):
+            failures.append((name, sql, table))
+
+    return failures
+
+#######################################################################################
+# The command line entry point:
+#   python migrations.py migrate [--to VERSION]  - apply the pending migrations
+#   python migrations.py status                  - show the current schema version
+#   python migrations.py check                   - fail if a model query does a full scan
+#######################################################################################
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Manage the database schema')
+    parser.add_argument('command', choices=['migrate', 'status', 'check'])
+    parser.add_argument('--to', type=int, default=None, help='migrate up to this version only')
+    parser.add_argument('--config', default=None,
+                        help='path of the db.json configuration file (default: $WDM_CONFIG, or ../config/db.json)')
+    args = parser.parse_args(args)
+
+    db_config = load_db_config(args.config)
+
+    db = Database(db_config)
+
+    if (args.command == 'migrate'):
+        applied = migrate(db, args.to)
+        print(f'Schema version {current_version(db)} ({len(applied)} migrations applied)')
+        return 0
+
+    if (args.command == 'status'):
+        version = current_version(db)
+        print(f'Schema version {version} (latest {MIGRATIONS[-1][0]})')
+        return 0
+
+    failures = check_query_plans(db_config)
+    for name, sql, table in failures:
+        print(f'Full scan of {table} in {name}: {sql}')
+
+    if (failures):
+        return 1
+
+    print('No model query falls back to a full table scan')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
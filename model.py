@@ -1,29 +1,43 @@
 from sys import settrace
+from cache import ReportCache
 from database import Database
+from query import Query
+from rows import Device, Reading, DailyReport, LatestReading, DECODE_SCALED, DECODE_FLOAT, as_rows, decode_readings, epoch_day_to_date, scaled_to_decimal, SECONDS_PER_DAY, VALUE_DIGITS
 import datetime
 import math
+from decimal import Decimal, ROUND_HALF_UP
 
 column_compare = {
     'EQUAL_TO': '=',
     'GREATER_THAN': '>',
     'GREATER_THAN_OR_EQUAL_TO': '>=',
     'LESSER_THAN': '<',
-    'LESSER_THAN_OR_EQUAL_TO': '<='
+    'LESSER_THAN_OR_EQUAL_TO': '<=',
+    'IN': 'IN'
 }
 
+WATERMARK_HOLDBACK = 100000
+
 #############################################################################################################
 # The model layer class that interfaces with the devices table in the MySQl database.
 # It provides functions that takes in data values used for CRUD operations on the table.
 # The data values are then passed on to the database layer, with additional table-specific and query-
 # specific information - to dynamically construct queries, and execute them.
+#
+# All the models take an optional db parameter, so that several models can share one Database object. Models
+# built without one still share connections, through the connection pool of their configuration.
 #############################################################################################################
 
 class DeviceModel:
     DEVICE_TABLE = 'devices'
 
-    def __init__(self, db_config):
+    DEVICE_ID_COL = 1
+
+    def __init__(self, db_config, db=None, cache=None, typed_rows=False):
         self._db_config = db_config
-        self._db = Database(db_config)
+        self._db = db or Database(db_config)
+        self._cache = cache
+        self._row_type = Device if typed_rows else None
         self._latest_error = ''
 
     @property
@@ -34,6 +48,10 @@ class DeviceModel:
     def latest_error(self, latest_error):
         self._latest_error = latest_error
 
+    @property
+    def cache(self):
+        return self._cache
+
 #############################################################################################################
 # A function to retrieve a single (unique) devices table entry for a particular device_id.
 #
@@ -42,15 +60,100 @@ class DeviceModel:
 #   value: a tuple consisting of - (Comparison operator, value to match)
 #
 # It invokes the appropriate function exposed by the database layer
+#
+# If the model was given a cache (an LRUCache - see cache.py), the lookup reads through it: the device row,
+# or the fact that there is no such device (a negative entry), is kept in the cache, and later lookups of the
+# same device_id don't reach the database.
 #############################################################################################################
 
     def find_by_device_id(self, device_id):
+        if (self._cache is not None):
+            found, result = self._cache.get(device_id)
+            if (found):
+                return as_rows(self._row_type, result)
+
         query_columns_dict = {
             'device_id': (column_compare['EQUAL_TO'], device_id)
         }
 
         result = self._db.get_single_data(DeviceModel.DEVICE_TABLE, query_columns_dict)
-        return result
+
+        if (self._cache is not None):
+            self._cache.put(device_id, result)
+
+        return as_rows(self._row_type, result)
+
+#############################################################################################################
+# A function to find which of several device_ids exist in the devices table - it returns them as a set.
+#
+# Cached devices are answered from the cache, and all the others are looked up with a single query.
+#############################################################################################################
+
+    def find_existing_device_ids(self, device_ids):
+        existing_device_ids = set()
+        missing_device_ids = []
+
+        for device_id in set(device_ids):
+            found, result = self._cache.get(device_id) if self._cache is not None else (False, None)
+            if (not found):
+                missing_device_ids.append(device_id)
+            elif (result):
+                existing_device_ids.add(device_id)
+
+        if (missing_device_ids):
+            query_columns_dict = {
+                'device_id': (column_compare['IN'], missing_device_ids)
+            }
+
+            rows = {row[DeviceModel.DEVICE_ID_COL]: row for row in self._db.get_multiple_data(DeviceModel.DEVICE_TABLE, query_columns_dict)}
+            existing_device_ids.update(rows.keys())
+
+            if (self._cache is not None):
+                for device_id in missing_device_ids:
+                    self._cache.put(device_id, rows.get(device_id))
+
+        return existing_device_ids
+
+#############################################################################################################
+# A function to load the whole devices table into the cache, with a single query. It returns the number of
+# devices loaded.
+#############################################################################################################
+
+    def preload(self):
+        if (self._cache is None):
+            return 0
+
+        rows = self._db.get_multiple_data(DeviceModel.DEVICE_TABLE, None)
+        for row in rows:
+            self._cache.put(row[DeviceModel.DEVICE_ID_COL], row)
+
+        return len(rows)
+
+#############################################################################################################
+# A helper function that restricts a query on a table with a device_id column to a set of devices - the given
+# device_ids, and/or the devices of a device_type and/or manufacturer, selected by a subquery of the devices
+# table (so the whole query still runs as one statement). It returns the query, or None if no device can
+# match (an empty device_ids list).
+#############################################################################################################
+
+    @staticmethod
+    def where_devices(query, device_ids=None, device_type=None, manufacturer=None):
+        if (device_ids is not None):
+            device_ids = list(device_ids)
+            if (not device_ids):
+                return None
+            query.where_in('device_id', device_ids)
+
+        if (device_type is not None or manufacturer is not None):
+            devices_query = Query(DeviceModel.DEVICE_TABLE).select('device_id')
+            if (device_type is not None):
+                devices_query.where('device_type', column_compare['EQUAL_TO'], device_type)
+            if (manufacturer is not None):
+                devices_query.where('manufacturer', column_compare['EQUAL_TO'], manufacturer)
+
+            query.where_in_query('device_id', devices_query)
+
+        return query
 
 #############################################################################################################
 # A function to insert a single row into the devices table.
@@ -61,11 +164,24 @@ class DeviceModel:
 # It populates a query_columns_dict dictionary with key and value as follows:
 #   key: The column name relevant to the query
 #   value: a tuple consisting of - (Comparison operator, value to match)
+#
+# A device found in the cache is known to exist without a round trip. Otherwise the existence check goes to 
+# the database (a possibly stale negative cache entry is not trusted for a write), and the cache entry of the
+# device is invalidated once it is inserted.
 #############################################################################################################
 
     def insert(self, device_id, desc, type, manufacturer):
         self.latest_error = ''
-        result = self.find_by_device_id(device_id)
+
+        result = None
+        if (self._cache is not None):
+            _, result = self._cache.get(device_id)
+
+        if (not result):
+            query_columns_dict = {
+                'device_id': (column_compare['EQUAL_TO'], device_id)
+            }
+            result = self._db.get_single_data(DeviceModel.DEVICE_TABLE, query_columns_dict)
 
         if (result):
             self.latest_error = f'Device id {device_id} already exists!'
@@ -79,6 +195,40 @@ class DeviceModel:
         }
 
         row_count = self._db.insert_single_data(DeviceModel.DEVICE_TABLE, query_columns_dict)
+
+        if (self._cache is not None):
+            self._cache.invalidate(device_id)
+
+        return row_count
+
+#############################################################################################################
+# A function to update the description, type and/or manufacturer of a device (the ones not given are left 
+# unchanged). It returns the number of rows updated, and invalidates the cache entry of the device.
+#############################################################################################################
+
+    def update(self, device_id, desc=None, type=None, manufacturer=None):
+        self.latest_error = ''
+
+        update_columns_dict = {}
+        if (desc is not None):
+            update_columns_dict['description'] = desc
+        if (type is not None):
+            update_columns_dict['device_type'] = type
+        if (manufacturer is not None):
+            update_columns_dict['manufacturer'] = manufacturer
+
+        if (not update_columns_dict):
+            return 0
+
+        query_columns_dict = {
+            'device_id': (column_compare['EQUAL_TO'], device_id)
+        }
+
+        row_count = self._db.update_data(DeviceModel.DEVICE_TABLE, update_columns_dict, query_columns_dict)
+
+        if (self._cache is not None):
+            self._cache.invalidate(device_id)
+
         return row_count
 
 #############################################################################################################
@@ -90,10 +240,24 @@ class DeviceModel:
 
 class WeatherDataModel:
     WEATHER_DATA_TABLE = 'weather_data'
+    LATEST_READING_TABLE = 'latest_reading'
+
+    LATEST_READING_COLUMNS = ['device_id', 'data_value', 'data_timestamp']
 
-    def __init__(self, db_config):
+    DEFAULT_BATCH_SIZE = 1000
+    DEFAULT_PAGE_SIZE = 1000
+
+    WD_ID_COL = 0
+    WD_TIMESTAMP_COL = 3
+
+    def __init__(self, db_config, db=None, device_model=None, typed_rows=False):
         self._db_config = db_config
-        self._db = Database(db_config)
+        self._db = db or Database(db_config)
+        self._device_model = device_model or DeviceModel(db_config, self._db)
+        self._row_type = Reading if typed_rows else None
+        self._latest_row_type = LatestReading if typed_rows else None
+        self._columnar_store = None
+        self._rolling_stats = None
         self._latest_error = ''
         
     @property
@@ -103,24 +267,198 @@ class WeatherDataModel:
     @latest_error.setter
     def latest_error(self, latest_error):
         self._latest_error = latest_error
+
+#############################################################################################################
+# A helper function that gives the SELECT list of a decode mode of find_all_chunked - the values scaled to
+# integers (exact, for the DECIMAL(6,2) column) or as floats, and the timestamps as seconds since the epoch,
+# in the SQL dialect of the database.
+#############################################################################################################
+
+    def _decode_columns(self, decode):
+        dialect = self._db.dialect
+        if (decode == DECODE_SCALED):
+            value_expression = dialect.scaled_integer_expression('data_value', VALUE_DIGITS)
+        else:
+            value_expression = dialect.float_expression('data_value')
+
+        return ('id', 'device_id', value_expression, dialect.epoch_seconds_expression('data_timestamp'))
+
+#############################################################################################################
+# An optional in-memory columnar store (a ColumnarStore - see columnar.py). Once attached, lookups of the 
+# devices loaded into it (find_by_device_id_and_value, iter_by_device_id and aggregate_by_device_id) are
+# answered from memory, and the readings inserted through this model are appended to it - with the ids the
+# database gave them, read back after the insert.
+#############################################################################################################
+
+    @property
+    def columnar_store(self):
+        return self._columnar_store
+
+    @columnar_store.setter
+    def columnar_store(self, columnar_store):
+        self._columnar_store = columnar_store
+
+#############################################################################################################
+# An optional rolling-window statistics engine (a RollingStats - see rolling.py). Once attached, the readings
+# inserted through this model are added to it, after their transaction commits.
+#############################################################################################################
+
+    @property
+    def rolling_stats(self):
+        return self._rolling_stats
+
+    @rolling_stats.setter
+    def rolling_stats(self, rolling_stats):
+        self._rolling_stats = rolling_stats
     
 #############################################################################################################
-# A function to retrieve multiple weather_data table entries that match a particular device_id.
-#
-# It populates a query_columns_dict dictionary with key and value as follows:
-#   key: The column name relevant to the query
-#   value: a tuple consisting of - (Comparison operator, value to match)
+# A function to retrieve multiple weather_data table entries that match a particular device_id, in timestamp
+# order.
 #
-# It invokes the appropriate function exposed by the database layer
+# It builds the query with the query builder, and invokes the appropriate function exposed by the database 
+# layer
 #############################################################################################################
 
     def find_multiple_by_device_id(self, device_id):
+        query = (Query(WeatherDataModel.WEATHER_DATA_TABLE)
+                    .where('device_id', column_compare['EQUAL_TO'], device_id)
+                    .order_by('data_timestamp'))
+
+        result = self._db.fetch_all(query)
+        return as_rows(self._row_type, result)
+
+#############################################################################################################
+# A generator of the weather_data table entries of a particular device_id, in timestamp order - optionally
+# restricted to a time window, from start (inclusive) to end (exclusive).
+#
+# The entries are read page_size rows at a time, with keyset pagination: each page query asks for the rows
+# after the last (data_timestamp, id) of the previous page, rather than using an OFFSET. Every page is then
+# a short range scan of the (device_id, data_timestamp) index - memory stays bounded, and a page deep into 
+# the history of a device costs as much as the first one.
+#
+# A device loaded in the columnar store is read from it instead, with binary searches for the window.
+#############################################################################################################
+
+    def iter_by_device_id(self, device_id, start=None, end=None, page_size=DEFAULT_PAGE_SIZE):
+        if (self._columnar_store is not None and self._columnar_store.is_loaded(device_id)):
+            yield from as_rows(self._row_type, self._columnar_store.rows(device_id, start, end))
+            return
+
+        last_row = None
+
+        while True:
+            query = Query(WeatherDataModel.WEATHER_DATA_TABLE).where('device_id', column_compare['EQUAL_TO'], device_id)
+
+            if (start is not None):
+                query.where('data_timestamp', column_compare['GREATER_THAN_OR_EQUAL_TO'], start.strftime('%Y-%m-%d %H:%M:%S'))
+            if (end is not None):
+                query.where('data_timestamp', column_compare['LESSER_THAN'], end.strftime('%Y-%m-%d %H:%M:%S'))
+            if (last_row is not None):
+                query.where_after('data_timestamp', last_row[WeatherDataModel.WD_TIMESTAMP_COL], 
+                                  'id', last_row[WeatherDataModel.WD_ID_COL])
+
+            query.order_by('data_timestamp').order_by('id').limit(page_size)
+
+            rows = self._db.fetch_all(query)
+            for row in as_rows(self._row_type, rows):
+                yield row
+
+            if (len(rows) < page_size):
+                return
+
+            last_row = rows[-1]
+
+#############################################################################################################
+# A function to aggregate the readings of a particular device_id, optionally restricted to a time window
+# from start (inclusive) to end (exclusive). It returns a dictionary of the count, sum, mean, min, max and
+# (population) standard deviation of the values, as floats (None but for the count and sum, without
+# readings) - from the columnar store if the device is loaded in it, with a single query otherwise.
+#############################################################################################################
+
+    def aggregate_by_device_id(self, device_id, start=None, end=None):
+        if (self._columnar_store is not None and self._columnar_store.is_loaded(device_id)):
+            return self._columnar_store.aggregate(device_id, start, end)
+
         query_columns_dict = {
             'device_id': (column_compare['EQUAL_TO'], device_id)
         }
+        timestamp_predicates = []
+        if (start is not None):
+            timestamp_predicates.append((column_compare['GREATER_THAN_OR_EQUAL_TO'], start.strftime('%Y-%m-%d %H:%M:%S')))
+        if (end is not None):
+            timestamp_predicates.append((column_compare['LESSER_THAN'], end.strftime('%Y-%m-%d %H:%M:%S')))
+        if (timestamp_predicates):
+            query_columns_dict['data_timestamp'] = timestamp_predicates
+
+        count, value_sum, value_sum_sq, min_value, max_value = self._db.get_aggregated_data(
+            WeatherDataModel.WEATHER_DATA_TABLE,
+            ['COUNT(data_value)', 'SUM(data_value)', 'SUM(data_value * data_value)', 'MIN(data_value)', 'MAX(data_value)'],
+            [], query_columns_dict)[0]
+
+        if (not count):
+            return {'count': 0, 'sum': 0.0, 'mean': None, 'min': None, 'max': None, 'stddev': None}
+
+        mean = float(value_sum) / count
+        return {
+            'count': count,
+            'sum': float(value_sum),
+            'mean': mean,
+            'min': float(min_value),
+            'max': float(max_value),
+            'stddev': math.sqrt(max(float(value_sum_sq) / count - mean * mean, 0.0))
+        }
+
+#############################################################################################################
+# A function to retrieve the latest count weather_data table entries of a particular device_id (returned in
+# timestamp order) - a single backwards range scan of the (device_id, data_timestamp) index.
+#############################################################################################################
+
+    def find_latest_by_device_id(self, device_id, count):
+        query = (Query(WeatherDataModel.WEATHER_DATA_TABLE)
+                    .where('device_id', column_compare['EQUAL_TO'], device_id)
+                    .order_by('data_timestamp', descending=True)
+                    .order_by('id', descending=True)
+                    .limit(count))
+
+        result = self._db.fetch_all(query)
+        return as_rows(self._row_type, list(reversed(result)))
 
-        result = self._db.get_multiple_data(WeatherDataModel.WEATHER_DATA_TABLE, query_columns_dict)
-        return result
+#############################################################################################################
+# A function to retrieve the weather_data table entries of several devices - in device_id, then timestamp 
+# order - with a single query, optionally restricted to a time window, from start (inclusive) to end 
+# (exclusive). The devices are given as a list of device_ids, and/or selected by device_type and/or 
+# manufacturer (see DeviceModel.where_devices) - all the devices if none of them is given.
+#############################################################################################################
+
+    def find_multiple_by_device_ids(self, device_ids=None, start=None, end=None, device_type=None, manufacturer=None):
+        query = DeviceModel.where_devices(Query(WeatherDataModel.WEATHER_DATA_TABLE), device_ids, device_type, manufacturer)
+        if (query is None):
+            return []
+
+        if (start is not None):
+            query.where('data_timestamp', column_compare['GREATER_THAN_OR_EQUAL_TO'], start.strftime('%Y-%m-%d %H:%M:%S'))
+        if (end is not None):
+            query.where('data_timestamp', column_compare['LESSER_THAN'], end.strftime('%Y-%m-%d %H:%M:%S'))
+
+        query.order_by('device_id').order_by('data_timestamp')
+
+        result = self._db.fetch_all(query)
+        return as_rows(self._row_type, result)
+
+#############################################################################################################
+# A function to retrieve the latest reading of several devices (selected as for find_multiple_by_device_ids),
+# in device_id order - as (device_id, data_value, data_timestamp) rows of the latest_reading table, which 
+# holds one row per device, kept up to date by the inserts of this model. It is a single primary key read,
+# however long the history of the devices.
+#############################################################################################################
+
+    def find_latest_by_device_ids(self, device_ids=None, device_type=None, manufacturer=None):
+        query = DeviceModel.where_devices(Query(WeatherDataModel.LATEST_READING_TABLE), device_ids, device_type, manufacturer)
+        if (query is None):
+            return []
+
+        result = self._db.fetch_all(query.order_by('device_id'))
+        return as_rows(self._latest_row_type, result)
 
 #############################################################################################################
 # A function to retrieve a single weather_data table entry that matches both: 
@@ -143,7 +481,7 @@ class WeatherDataModel:
         }
 
         result = self._db.get_single_data(WeatherDataModel.WEATHER_DATA_TABLE, query_columns_dict)
-        return result
+        return as_rows(self._row_type, result)
         
 #############################################################################################################
 # A function to retrieve a single weather_data table entry that matches both: 
@@ -152,20 +490,27 @@ class WeatherDataModel:
 #
 # It populates a query_columns_dict dictionary with key and value as follows:
 #   key: The column name relevant to the query
-#   value: a tuple consisting of - (Comparison operator, value to match)
+#   value: a tuple consisting of - (Comparison operator, value to match) - or a list of such tuples, when
+#          the column has several predicates (here, both ends of the data_value range)
 #
-# It invokes the appropriate function exposed by the database layer
+# It invokes the appropriate function exposed by the database layer - unless the device is loaded in the 
+# columnar store, which answers instead.
 #############################################################################################################
 
     def find_by_device_id_and_value(self, device_id, low_value, high_value):
+        if (self._columnar_store is not None and self._columnar_store.is_loaded(device_id)):
+            return as_rows(self._row_type, self._columnar_store.find_by_value(device_id, low_value, high_value))
+
         query_columns_dict = {
             'device_id': (column_compare['EQUAL_TO'], device_id),
-            'data_value': (column_compare['GREATER_THAN'], low_value),
-            'data_value': (column_compare['LESSER_THAN'], high_value)
+            'data_value': [
+                (column_compare['GREATER_THAN'], low_value),
+                (column_compare['LESSER_THAN'], high_value)
+            ]
         }
 
         result = self._db.get_single_data(WeatherDataModel.WEATHER_DATA_TABLE, query_columns_dict)
-        return result
+        return as_rows(self._row_type, result)
 
 #############################################################################################################
 # A function to retrieve all the rows of the weather_data table.
@@ -176,13 +521,35 @@ class WeatherDataModel:
 
     def find_all(self):
         results = self._db.get_multiple_data(WeatherDataModel.WEATHER_DATA_TABLE, None)
-        return results
+        return as_rows(self._row_type, results)
+
+#############################################################################################################
+# A function to stream all the rows of the weather_data table, chunk_size rows at a time.
+#
+# Unlike find_all, the rows are never materialised as one list - this is a generator that yields lists of
+#   at most chunk_size rows, read from the database layer's unbuffered (server streamed) cursor.
+#
+# If decode is given (rows.DECODE_SCALED or rows.DECODE_FLOAT), each chunk is yielded as a ReadingBatch
+#   instead - the database converts the values and timestamps to plain numbers (see _decode_columns).
+#############################################################################################################
+
+    def find_all_chunked(self, chunk_size, decode=None, query_columns_dict=None):
+        columns = self._decode_columns(decode) if decode else ()
+
+        for rows in self._db.get_multiple_data_chunked(WeatherDataModel.WEATHER_DATA_TABLE, query_columns_dict, 
+                                                       chunk_size, columns):
+            if (decode):
+                yield decode_readings(rows, decode)
+            else:
+                yield as_rows(self._row_type, rows)
     
 #############################################################################################################
 # A function to insert a single row into the weather_data table.
 #
 # It takes the values corresponding to a single row in the table, and invokes the appropriate function 
 # exposed by the database layer - only if the entry does not exist already (by matching device_id and timestamp)
+# and the device exists (through the device model - the weather_data table of a partitioned MySQL database has
+# no foreign key to check it). A value that is not a finite number (NaN, or an infinity) is refused.
 # 
 # It populates a query_columns_dict dictionary with key and value as follows:
 #   key: The column name relevant to the query
@@ -198,6 +565,14 @@ class WeatherDataModel:
             self.latest_error = f'Data for timestamp {timestamp} for device id {device_id} already exists'
             return -1
 
+        if (value is not None and not _is_finite(value)):
+            self.latest_error = f'Value {value} for device id {device_id} is not a finite number'
+            return -1
+
+        if (device_id not in self._device_model.find_existing_device_ids([device_id])):
+            self.latest_error = f'Device id {device_id} does not exist'
+            return -1
+
         val_timestamp = timestamp.strftime('%Y-%m-%d %H:%M:%S')
         
         query_columns_dict = {
@@ -206,20 +581,175 @@ class WeatherDataModel:
             'data_timestamp': val_timestamp
         }
 
-        row_count = self._db.insert_single_data(WeatherDataModel.WEATHER_DATA_TABLE, query_columns_dict)
+        with self._db.transaction():
+            row_count = self._db.insert_single_data(WeatherDataModel.WEATHER_DATA_TABLE, query_columns_dict)
+            self._update_latest_readings([(device_id, value, val_timestamp)])
+
+        if (self._columnar_store is not None):
+            self._append_to_columnar_store([(device_id, value, val_timestamp)])
+        if (self._rolling_stats is not None):
+            self._rolling_stats.add(device_id, value, timestamp)
+
         return row_count
 
+#############################################################################################################
+# A function to insert many rows into the weather_data table, in batches.
+#
+# It takes an iterable of (device_id, value, timestamp) readings, and writes them batch_size at a time - each
+# batch as one multi-row statement, in its own transaction. Deduplication is left to the database: the unique
+# key on (device_id, data_timestamp) makes readings that already exist (or repeat within the input) skip
+# rather than fail. Readings that are malformed (a value of NaN or an infinity included), or that belong to an
+# unknown device, are rejected up front (the devices are checked through the device model - and its cache, if
+# it has one).
+#
+# It returns a dictionary with the number of readings inserted, skipped as duplicates, and rejected.
+#############################################################################################################
+
+    def insert_many(self, readings, batch_size=DEFAULT_BATCH_SIZE):
+        self._latest_error = ''
+        counts = {'inserted': 0, 'duplicate': 0, 'rejected': 0}
+
+        batch = []
+        for reading in readings:
+            batch.append(reading)
+            if (len(batch) >= batch_size):
+                self._insert_batch(batch, counts)
+                batch = []
+
+        if (batch):
+            self._insert_batch(batch, counts)
+
+        if (counts['rejected']):
+            self.latest_error = f'{counts["rejected"]} readings were rejected'
+
+        return counts
+
+    def _insert_batch(self, batch, counts):
+        valid_readings = [reading for reading in batch if self._is_valid_reading(reading)]
+
+        known_device_ids = self._device_model.find_existing_device_ids([reading[0] for reading in valid_readings])
+
+        multiple_data = [
+            (device_id, value, timestamp.strftime('%Y-%m-%d %H:%M:%S')) 
+            for device_id, value, timestamp in valid_readings 
+            if device_id in known_device_ids
+        ]
+
+        query_columns = [
+            'device_id',
+            'data_value',
+            'data_timestamp'
+        ]
+
+        with self._db.transaction():
+            inserted = self._db.insert_multiple_data(WeatherDataModel.WEATHER_DATA_TABLE, query_columns, multiple_data, 
+                                                     ignore_duplicates=True)
+            self._update_latest_readings(multiple_data)
+
+        if (self._columnar_store is not None):
+            self._append_to_columnar_store(multiple_data)
+
+        # A duplicate of a reading the rolling statistics have seen is not newer than the latest one of its device,
+        # and is skipped
+
+        if (self._rolling_stats is not None):
+            self._rolling_stats.add_many([reading for reading in valid_readings if reading[0] in known_device_ids])
+
+        counts['inserted'] += inserted
+        counts['duplicate'] += len(multiple_data) - inserted
+        counts['rejected'] += len(batch) - len(multiple_data)
+
+#############################################################################################################
+# A helper function that appends the rows an insert wrote (as (device_id, value, 'YYYY-MM-DD HH:MM:SS')
+# tuples) to the columnar store, for the devices loaded in it. The ids are handed out by the database, so the
+# rows are read back - with one query over the time span of the batch.
+#############################################################################################################
+
+    def _append_to_columnar_store(self, multiple_data):
+        loaded_rows = [row for row in multiple_data if self._columnar_store.is_loaded(row[0])]
+        if (not loaded_rows):
+            return
+
+        written = {(row[0], row[2]) for row in loaded_rows}
+        query = (Query(WeatherDataModel.WEATHER_DATA_TABLE)
+                    .where_in('device_id', sorted({row[0] for row in loaded_rows}))
+                    .where_between('data_timestamp', min(row[2] for row in loaded_rows), max(row[2] for row in loaded_rows)))
+
+        for id, device_id, value, timestamp in self._db.fetch_all(query):
+            if (value is not None and (device_id, timestamp.strftime('%Y-%m-%d %H:%M:%S')) in written):
+                self._columnar_store.append(device_id, value, timestamp, id)
+
+    def _is_valid_reading(self, reading):
+        if (not isinstance(reading, (tuple, list)) or len(reading) != 3):
+            return False
+
+        device_id, value, timestamp = reading
+        return (isinstance(device_id, str) and device_id != '' and 
+                isinstance(value, (int, float, Decimal)) and not isinstance(value, bool) and 
+                _is_finite(value) and isinstance(timestamp, datetime.datetime))
+
+
+#############################################################################################################
+# Functions to maintain the latest_reading table - one row per device, holding its reading with the latest 
+# timestamp.
+#
+# _update_latest_readings is called by the inserts, in their transaction, with the rows they wrote (as
+# (device_id, value, 'YYYY-MM-DD HH:MM:SS') tuples): the latest row of each device in them is upserted, and
+# only replaces the stored one if it is newer - so late or out of order readings leave it alone. The devices
+# are written in device_id order, so that concurrent batches lock their rows in the same order.
+#
+# rebuild_latest_readings recomputes the table from weather_data, with a single INSERT ... SELECT - for the
+# rows written without this model (the bulk loads of data_generator.py). It returns the number of rows 
+# affected.
+#############################################################################################################
+
+    def _update_latest_readings(self, multiple_data):
+        latest = {}
+        for row in multiple_data:
+            if (row[0] not in latest or row[2] > latest[row[0]][2]):
+                latest[row[0]] = row
+
+        self._db.upsert_multiple_data(WeatherDataModel.LATEST_READING_TABLE, WeatherDataModel.LATEST_READING_COLUMNS,
+                                      [latest[device_id] for device_id in sorted(latest)], 
+                                      WeatherDataModel.LATEST_READING_COLUMNS[1:], 'data_timestamp')
+
+    def rebuild_latest_readings(self):
+        column_names = ",".join(WeatherDataModel.LATEST_READING_COLUMNS)
+        select_list = ",".join([f"w.{column_name}" for column_name in WeatherDataModel.LATEST_READING_COLUMNS])
+        upsert_clause = self._db.dialect.upsert_newer_clause(WeatherDataModel.LATEST_READING_TABLE, 
+                                                             WeatherDataModel.LATEST_READING_COLUMNS[1:], 'data_timestamp')
+
+        sql = (f"INSERT INTO {WeatherDataModel.LATEST_READING_TABLE} ({column_names}) "
+               f"SELECT {select_list} FROM {WeatherDataModel.WEATHER_DATA_TABLE} w, "
+               f"(SELECT device_id, MAX(data_timestamp) AS latest_timestamp FROM {WeatherDataModel.WEATHER_DATA_TABLE} GROUP BY device_id) latest "
+               f"WHERE w.device_id = latest.device_id AND w.data_timestamp = latest.latest_timestamp{upsert_clause}")
+
+        return self._db.run_statement(sql)
 
 class DailyReportModel:
     DAILY_REPORT_TABLE = 'daily_report'
+
+    WATERMARK_TABLE = 'report_watermark'
+    WATERMARK_NAME = 'daily_report'
+    GENERATION_NAME = 'daily_report_generation'
+
+    ENGINE_DATABASE = 'database'
+    ENGINE_PYTHON = 'python'
     
     WD_DEVICE_ID_COL = 1
     WD_VALUE_COL = 2
     WD_TIMESTAMP_COL = 3
 
-    def __init__(self, db_config):
+    WM_LAST_ID_COL = 1
+
+    PARTITIONS_PER_WORKER = 4
+    PARTITION_CHUNK_SIZE = 10000
+
+    def __init__(self, db_config, db=None, typed_rows=False, cache=None):
         self._db_config = db_config
-        self._db = Database(db_config)
+        self._db = db or Database(db_config)
+        self._row_type = DailyReport if typed_rows else None
+        self._cache = cache
         self._latest_error = ''
     
     @property
@@ -229,6 +759,77 @@ class DailyReportModel:
     @latest_error.setter
     def latest_error(self, latest_error):
         self._latest_error = latest_error
+
+#############################################################################################################
+# An optional result cache of the lookups (a ReportCache - see cache.py). With one, find_by_device_id_and_date 
+# and find_by_device_id_and_date_range read through it, and every function that writes reports invalidates
+# the cached lookups of the devices and dates it wrote.
+#
+# Reports are only ever written through this model, and every write also bumps the report generation - a 
+# counter in the report_watermark table. The lookups compare it with the generation of the cache (at most 
+# once per generation_check_interval of the cache), so reports written by other processes clear the cache
+# within that interval.
+#############################################################################################################
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def get_generation(self):
+        query_columns_dict = {
+            'name': (column_compare['EQUAL_TO'], DailyReportModel.GENERATION_NAME)
+        }
+
+        result = self._db.get_single_data(DailyReportModel.WATERMARK_TABLE, query_columns_dict)
+        if (result):
+            return result[DailyReportModel.WM_LAST_ID_COL]
+
+        return 0
+
+    def _bump_generation(self):
+        sql = f'UPDATE {DailyReportModel.WATERMARK_TABLE} SET last_id = last_id + 1 WHERE name = %s'
+
+        with self._db.transaction():
+            if (not self._db.run_statement(sql, (DailyReportModel.GENERATION_NAME,))):
+                self._db.insert_multiple_data(DailyReportModel.WATERMARK_TABLE, ['name', 'last_id'],
+                                              [(DailyReportModel.GENERATION_NAME, 0)], ignore_duplicates=True)
+                self._db.run_statement(sql, (DailyReportModel.GENERATION_NAME,))
+
+            return self.get_generation()
+
+#############################################################################################################
+# Helper functions for the cache: _cached looks a lookup up (checking the generation first, when it is due),
+# and returns whether it was found, the cached rows, and the stamp to cache the rows read from the database
+# with. _reports_changed is called after reports were written, with the (device_id, date) pairs written - 
+# None for all the devices, or all the dates: it bumps the generation, and invalidates the cached lookups.
+#############################################################################################################
+
+    def _cached(self, key):
+        if (self._cache is None):
+            return False, None, None
+
+        if (self._cache.generation_check_due()):
+            self._cache.check_generation(self.get_generation())
+
+        stamp = self._cache.stamp()
+        found, result = self._cache.get(key)
+        return found, result, stamp
+
+    def _reports_changed(self, scopes):
+        generation = self._bump_generation()
+
+        if (self._cache is not None):
+            self._invalidate_cached(scopes)
+            self._cache.advance_generation(generation)
+
+    def _invalidate_cached(self, scopes):
+        if (self._cache is None):
+            return
+
+        for device_id, date in scopes:
+            if (date is not None):
+                date = date[:10] + ' 00:00:00' if isinstance(date, str) else date.strftime('%Y-%m-%d 00:00:00')
+            self._cache.invalidate_report(device_id, date)
     
 #############################################################################################################
 # A function to retrieve a single daily_report table entry that matches both: 
@@ -244,6 +845,11 @@ class DailyReportModel:
 
     def find_by_device_id_and_date(self, device_id, date):
         val_date = date.strftime('%Y-%m-%d %H:%M:%S')
+
+        key = (ReportCache.DATE_KEY, device_id, val_date)
+        found, result, stamp = self._cached(key)
+        if (found):
+            return as_rows(self._row_type, result)
         
         query_columns_dict = {
             'device_id': (column_compare['EQUAL_TO'], device_id),
@@ -251,33 +857,60 @@ class DailyReportModel:
         }
 
         result = self._db.get_single_data(DailyReportModel.DAILY_REPORT_TABLE, query_columns_dict)
-        return result
+
+        if (self._cache is not None):
+            self._cache.put(key, result, stamp)
+
+        return as_rows(self._row_type, result)
     
 #############################################################################################################
-# A function to retrieve a single daily_report table entry that matches both: 
+# A function to retrieve the daily_report table entries of several devices for a specific date, in device_id
+# order, with a single query. The devices are given as a list of device_ids, and/or selected by device_type 
+# and/or manufacturer (see DeviceModel.where_devices) - all the devices if none of them is given. The lookup
+# goes to the database directly - the cache only holds the lookups of single devices.
+#############################################################################################################
+
+    def find_by_device_ids_and_date(self, device_ids, date, device_type=None, manufacturer=None):
+        query = DeviceModel.where_devices(Query(DailyReportModel.DAILY_REPORT_TABLE), device_ids, device_type, manufacturer)
+        if (query is None):
+            return []
+
+        query.where('report_date', column_compare['EQUAL_TO'], date.strftime('%Y-%m-%d 00:00:00')).order_by('device_id')
+
+        result = self._db.fetch_all(query)
+        return as_rows(self._row_type, result)
+
+#############################################################################################################
+# A function to retrieve the daily_report table entries that match both: 
 #    1. A particular device_id.
 #    2. All dates that lie in a specific range - between from_date and to_date - both inclusive.
+# The entries are returned in date order.
 #
-# It populates a query_columns_dict dictionary with key and value as follows:
-#   key: The column name relevant to the query
-#   value: a tuple consisting of - (Comparison operator, value to match)
-#
-# It invokes the appropriate function exposed by the database layer
+# It builds the query with the query builder, and invokes the appropriate function exposed by the database 
+# layer. The reports always come from daily_report - never from a columnar store - so that they are the ones
+# the aggregation engines built, with the same ids and the same (ROUND_HALF_UP) rounding.
 #############################################################################################################
 
     def find_by_device_id_and_date_range(self, device_id, from_date, to_date):
-
         val_from_date = from_date.strftime('%Y-%m-%d %H:%M:%S')
         val_to_date = to_date.strftime('%Y-%m-%d %H:%M:%S')
 
-        query_columns_dict = {
-            'device_id': (column_compare['EQUAL_TO'], device_id),
-            'report_date': (column_compare['GREATER_THAN_OR_EQUAL_TO'], val_from_date),
-            'report_date': (column_compare['LESSER_THAN_OR_EQUAL_TO'], val_to_date)
-        }
+        key = (ReportCache.RANGE_KEY, device_id, val_from_date, val_to_date)
+        found, results, stamp = self._cached(key)
+        if (found):
+            return as_rows(self._row_type, list(results))
+
+        query = (Query(DailyReportModel.DAILY_REPORT_TABLE)
+                    .where('device_id', column_compare['EQUAL_TO'], device_id)
+                    .where_between('report_date', val_from_date, val_to_date)
+                    .order_by('report_date'))
 
-        results = self._db.get_multiple_data(DailyReportModel.DAILY_REPORT_TABLE, query_columns_dict)
-        return results
+        results = self._db.fetch_all(query)
+
+        if (self._cache is not None):
+            self._cache.put(key, list(results), stamp)
+
+        return as_rows(self._row_type, results)
 
 #############################################################################################################
 # A function to retrieve all the rows of the daily_report table.
@@ -288,7 +921,7 @@ class DailyReportModel:
 
     def find_all(self):
         results = self._db.get_multiple_data(DailyReportModel.DAILY_REPORT_TABLE, None)
-        return results
+        return as_rows(self._row_type, results)
 
 #############################################################################################################
 # A function to insert multiple rows into the daily_report table.
@@ -297,9 +930,18 @@ class DailyReportModel:
 # exposed by the database layer.
 # 
 # It populates a query_columns array with the table column names.
+#
+# With ignore_duplicates, the reports that already exist (for the same device and date) are skipped instead of
+#   failing the insert - the row count then only counts the reports actually inserted.
 #############################################################################################################
 
-    def insert_multiple(self, daily_report_docs):
+    def insert_multiple(self, daily_report_docs, ignore_duplicates=False):
+        row_count = self._insert_reports(daily_report_docs, ignore_duplicates)
+        self._reports_changed([(doc[0], doc[4]) for doc in daily_report_docs])
+
+        return row_count
+
+    def _insert_reports(self, daily_report_docs, ignore_duplicates=False):
         query_columns = [
             'device_id',
             'avg_value',
@@ -308,7 +950,8 @@ class DailyReportModel:
             'report_date'
         ]
 
-        row_count = self._db.insert_multiple_data(DailyReportModel.DAILY_REPORT_TABLE, query_columns, daily_report_docs)
+        row_count = self._db.insert_multiple_data(DailyReportModel.DAILY_REPORT_TABLE, query_columns, daily_report_docs, 
+                                                  ignore_duplicates=ignore_duplicates)
         return row_count
 
 #################################################################################################################
@@ -319,14 +962,84 @@ class DailyReportModel:
 #  3. max_value
 #
 # This is done so that there is one entry corresponding per device, for each day - its daily report!
+#
+# If chunk_size is given, the aggregation runs in streaming mode: the weather_data rows are read chunk_size
+# at a time and folded into the running (device, date) accumulators, so peak memory depends on the number
+# of device-days rather than on the number of rows in the table. Otherwise the whole table is read at once.
+#
+# If workers is more than 1, the aggregation runs in parallel, in that many worker processes (see 
+# _aggregate_data_parallel) - the reports are the same as the serial ones.
+#
+# If fast is set, the rows are streamed (in chunks of chunk_size, or PARTITION_CHUNK_SIZE) as ReadingBatches
+# of scaled integers and epoch seconds (see rows.py), and accumulated with integer arithmetic - no Decimal or
+# datetime object is built per row. The reports are the same.
+#################################################################################################################
+
+    def aggregate_data(self, chunk_size=None, workers=1, fast=False):
+        if (workers and workers > 1):
+            return self._aggregate_data_parallel(chunk_size, workers, fast)
+
+        agg_data = {}
+
+        weather_data_model = WeatherDataModel(self._db_config, self._db)
+
+        if (fast):
+            scaled_data = {}
+            for batch in weather_data_model.find_all_chunked(chunk_size or DailyReportModel.PARTITION_CHUNK_SIZE, 
+                                                             DECODE_SCALED):
+                self._accumulate_scaled(scaled_data, batch)
+            agg_data = self._unscale(scaled_data)
+        elif (chunk_size):
+            for rows in weather_data_model.find_all_chunked(chunk_size):
+                self._accumulate(agg_data, rows)
+        else:
+            self._accumulate(agg_data, weather_data_model.find_all())
+
+        return self._build_report_data(agg_data)
+
 #################################################################################################################
+# A helper function that runs aggregate_data in worker processes.
+#
+# The device_ids found in the weather_data table are dealt round-robin into PARTITIONS_PER_WORKER partitions
+# per worker (more partitions than workers, so that a worker that gets the busier devices does not hold up
+# the rest). Each worker process opens its own connection, streams the readings of its partition with a
+# device_id IN (...) query, and sends back its accumulators. As the partitions share no device, the parent
+# only has to put the accumulators together before building the report rows.
+#
+# The workers are started with the spawn method, so they share no connection (or anything else) with the
+# parent process.
+#################################################################################################################
+
+    def _aggregate_data_parallel(self, chunk_size, workers, fast=False):
+        # Imported here - the process pool machinery is slow to import, and most callers never need it
+
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        device_rows = self._db.get_aggregated_data(WeatherDataModel.WEATHER_DATA_TABLE, ['device_id'], ['device_id'], None)
+        device_ids = sorted(row[0] for row in device_rows)
+
+        partition_count = min(len(device_ids), workers * DailyReportModel.PARTITIONS_PER_WORKER)
+        partitions = [device_ids[i::partition_count] for i in range(partition_count)]
 
-    def aggregate_data(self):
         agg_data = {}
+        if (partitions):
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                futures = [executor.submit(_aggregate_partition, self._db_config, partition, chunk_size, fast) 
+                           for partition in partitions]
+                for future in futures:
+                    agg_data.update(future.result())
+
+        return self._build_report_data(agg_data)
 
-        weather_data_model = WeatherDataModel(self._db_config)
+#################################################################################################################
+# A helper function that folds weather_data rows into the agg_data accumulators - a dictionary keyed by
+# device_id, holding a dictionary keyed by date, of running sum, count, min and max values.
+#################################################################################################################
 
-        for data in weather_data_model.find_all():
+    def _accumulate(self, agg_data, rows):
+        for data in rows:
             device_id = data[DailyReportModel.WD_DEVICE_ID_COL]
             date = data[DailyReportModel.WD_TIMESTAMP_COL].date()
             value = data[DailyReportModel.WD_VALUE_COL]
@@ -344,13 +1057,52 @@ class DailyReportModel:
             
             if (value > agg_data[device_id][date]['max']):
                 agg_data[device_id][date]['max'] = value
-        
+
+#################################################################################################################
+# Helper functions for the fast aggregation: _accumulate_scaled folds a ReadingBatch into scaled_data - a
+# dictionary keyed by (device_id, epoch day) of [sum, count, min, max] lists of scaled integers - and 
+# _unscale turns that into the agg_data accumulators, with the values back as Decimals.
+#################################################################################################################
+
+    def _accumulate_scaled(self, scaled_data, batch):
+        for device_id, value, timestamp in zip(batch.device_ids, batch.values, batch.timestamps):
+            key = (device_id, timestamp // SECONDS_PER_DAY)
+            accumulator = scaled_data.get(key)
+
+            if (accumulator is None):
+                scaled_data[key] = [value, 1, value, value]
+                continue
+
+            accumulator[0] += value
+            accumulator[1] += 1
+            if (value < accumulator[2]):
+                accumulator[2] = value
+            elif (value > accumulator[3]):
+                accumulator[3] = value
+
+    def _unscale(self, scaled_data):
+        agg_data = {}
+        for (device_id, day), (value_sum, count, min_value, max_value) in scaled_data.items():
+            agg_data.setdefault(device_id, {})[epoch_day_to_date(day)] = {
+                'sum': scaled_to_decimal(value_sum), 
+                'count': count, 
+                'min': scaled_to_decimal(min_value), 
+                'max': scaled_to_decimal(max_value)
+            }
+
+        return agg_data
+
+#################################################################################################################
+# A helper function that turns the agg_data accumulators into daily_report rows, ready for insert_multiple.
+#################################################################################################################
+
+    def _build_report_data(self, agg_data):
         report_data = []
         for device_id in agg_data:
             for date in agg_data[device_id]:
                 report_doc = (
                     device_id, 
-                    round(agg_data[device_id][date]['sum'] / agg_data[device_id][date]['count'], 2), 
+                    self._average(agg_data[device_id][date]['sum'], agg_data[device_id][date]['count']), 
                     agg_data[device_id][date]['min'], 
                     agg_data[device_id][date]['max'], 
                     datetime.datetime(date.year, date.month, date.day)
@@ -360,19 +1112,291 @@ class DailyReportModel:
         
         return report_data
 
+#################################################################################################################
+# A helper function that computes the rounded average value of a daily report.
+#
+# It rounds exactly the way MySQL evaluates ROUND(AVG(data_value), 2) on the DECIMAL data_value column: the
+# division is first rounded half-up to 4 extra digits (div_precision_increment), and then to 2 digits - so
+# the Python and the database aggregation engines produce identical reports.
+#################################################################################################################
+
+    def _average(self, value_sum, count):
+        average = (Decimal(value_sum) / count).quantize(Decimal('0.000001'), rounding=ROUND_HALF_UP)
+        return average.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+#################################################################################################################
+# A helper function that gives the data_timestamp predicates matching a whole day - as a range on the column
+# itself rather than on DATE(data_timestamp), so that the (device_id, data_timestamp) index can be used.
+#################################################################################################################
+
+    def _day_range(self, date):
+        day = datetime.datetime(date.year, date.month, date.day)
+
+        return [
+            (column_compare['GREATER_THAN_OR_EQUAL_TO'], day.strftime('%Y-%m-%d %H:%M:%S')),
+            (column_compare['LESSER_THAN'], (day + datetime.timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S'))
+        ]
+
+#################################################################################################################
+# A function to aggregate the weather_data table into the daily_report table inside the database itself, with
+# a single INSERT INTO daily_report ... SELECT ... GROUP BY query - no weather_data row is sent to the client.
+#
+# The aggregation can optionally be scoped to a single device_id and/or a single date. The existing reports
+# in that scope are deleted first, so that a scope can be regenerated. The number of reports created is returned.
+#################################################################################################################
+
+    def aggregate_data_in_database(self, device_id=None, date=None):
+        query_columns_dict = {}
+        report_columns_dict = {}
+
+        if (device_id is not None):
+            query_columns_dict['device_id'] = (column_compare['EQUAL_TO'], device_id)
+            report_columns_dict['device_id'] = (column_compare['EQUAL_TO'], device_id)
+
+        if (date is not None):
+            query_columns_dict['data_timestamp'] = self._day_range(date)
+            report_columns_dict['report_date'] = (column_compare['EQUAL_TO'], date.strftime('%Y-%m-%d 00:00:00'))
+
+        if (report_columns_dict):
+            self._db.delete_data(DailyReportModel.DAILY_REPORT_TABLE, report_columns_dict)
+
+        query_columns = [
+            'device_id',
+            'avg_value',
+            'min_value',
+            'max_value',
+            'report_date'
+        ]
+
+        report_date_expression = self._db.dialect.date_expression('data_timestamp')
+
+        select_expressions = [
+            'device_id',
+            'ROUND(AVG(data_value), 2)',
+            'MIN(data_value)',
+            'MAX(data_value)',
+            report_date_expression
+        ]
+
+        group_by_expressions = [
+            'device_id',
+            report_date_expression
+        ]
+
+        row_count = self._db.insert_aggregated_data(DailyReportModel.DAILY_REPORT_TABLE, query_columns, 
+                                                    WeatherDataModel.WEATHER_DATA_TABLE, select_expressions, 
+                                                    group_by_expressions, query_columns_dict)
+
+        self._reports_changed([(device_id, date)])
+        return row_count
+
+#################################################################################################################
+# A function to aggregate the weather_data rows of a single device_id and date in Python, replacing the
+# existing report for that device and date. It is the ENGINE_PYTHON counterpart of a scoped 
+# aggregate_data_in_database call.
+#################################################################################################################
+
+    def aggregate_data_in_python(self, device_id, date):
+        agg_data = {}
+
+        query_columns_dict = {
+            'device_id': (column_compare['EQUAL_TO'], device_id),
+            'data_timestamp': self._day_range(date)
+        }
+        self._accumulate(agg_data, self._db.get_multiple_data(WeatherDataModel.WEATHER_DATA_TABLE, query_columns_dict))
+
+        report_columns_dict = {
+            'device_id': (column_compare['EQUAL_TO'], device_id),
+            'report_date': (column_compare['EQUAL_TO'], date.strftime('%Y-%m-%d 00:00:00'))
+        }
+        self._db.delete_data(DailyReportModel.DAILY_REPORT_TABLE, report_columns_dict)
+
+        report_data = self._build_report_data(agg_data)
+        if (report_data):
+            self._insert_reports(report_data)
+
+        self._reports_changed([(device_id, date)])
+        return len(report_data)
+
+#################################################################################################################
+# Functions to read and record the report watermark - the highest weather_data id already aggregated into the
+# daily_report table. get_watermark returns None if the reports were never built.
+#################################################################################################################
+
+    def get_watermark(self):
+        query_columns_dict = {
+            'name': (column_compare['EQUAL_TO'], DailyReportModel.WATERMARK_NAME)
+        }
+
+        result = self._db.get_single_data(DailyReportModel.WATERMARK_TABLE, query_columns_dict)
+        if (result):
+            return result[DailyReportModel.WM_LAST_ID_COL]
+
+        return None
+
+    def _set_watermark(self, last_id):
+        query_columns_dict = {
+            'name': DailyReportModel.WATERMARK_NAME,
+            'last_id': last_id
+        }
+
+        self._db.upsert_single_data(DailyReportModel.WATERMARK_TABLE, query_columns_dict, ['last_id'])
+
+#################################################################################################################
+# A function to incrementally refresh the daily_report table.
+#
+# Only the weather_data rows above the watermark are looked at: the (device_id, date) pairs they touch are
+# found with one grouped query, and only the reports for those pairs are recomputed (from all the readings of
+# that device and day) and replaced. A late-arriving reading for an old day therefore fixes just that one 
+# report. The reports and the new watermark are written in a single transaction.
+#
+# The new watermark is held back below any gap in the ids, so that the readings of ingest transactions still
+# open during the refresh are picked up by a later one (see settled_watermark).
+#
+# The number of reports refreshed is returned.
+#################################################################################################################
+
+    def refresh_reports(self, engine=ENGINE_DATABASE):
+        watermark = self.get_watermark() or 0
+
+        query_columns_dict = {
+            'id': (column_compare['GREATER_THAN'], watermark)
+        }
+
+        report_date_expression = self._db.dialect.date_expression('data_timestamp')
+
+        touched = self._db.get_aggregated_data(WeatherDataModel.WEATHER_DATA_TABLE, 
+                                               ['device_id', report_date_expression, 'MAX(id)'], 
+                                               ['device_id', report_date_expression], 
+                                               query_columns_dict)
+        if (not touched):
+            return 0
+
+        with self._db.transaction():
+            for device_id, date, _ in touched:
+                if (engine == DailyReportModel.ENGINE_DATABASE):
+                    self.aggregate_data_in_database(device_id, date)
+                else:
+                    self.aggregate_data_in_python(device_id, date)
+
+            self._set_watermark(settled_watermark(self._db, watermark, max(row[2] for row in touched)))
+
+        # A lookup may have cached the old reports while the transaction was open
+
+        self._invalidate_cached([(device_id, date) for device_id, date, _ in touched])
+        return len(touched)
+
 #################################################################################################################
 # A function to trigger the aggregation procedure, and populate the daily_report table.
+#
+# The first run (no watermark recorded yet) rebuilds the whole daily_report table and records the watermark.
+# Every later run only refreshes the reports touched by new weather_data rows (see refresh_reports).
+#
+# engine selects where the aggregation runs:
+#   ENGINE_DATABASE - inside MySQL (aggregate_data_in_database), the default
+#   ENGINE_PYTHON - in Python (aggregate_data), the fallback. chunk_size, workers and fast are passed on
+#                   to aggregate_data (set them to stream the weather_data table in chunks, to aggregate
+#                   in that many processes, and to aggregate scaled integers instead of Decimals).
 #################################################################################################################
 
-    def create_reports(self):
-        daily_reports = self.find_all()
-        if (daily_reports):
-            print("Reports already created, skipping this step")
+    def create_reports(self, chunk_size=None, engine=ENGINE_DATABASE, workers=1, fast=False):
+        self.latest_error = ''
+
+        if (engine not in (DailyReportModel.ENGINE_DATABASE, DailyReportModel.ENGINE_PYTHON)):
+            self.latest_error = f'Unknown aggregation engine {engine}'
+            return False
+
+        if (self.get_watermark() is not None):
+            self.refresh_reports(engine)
             return True
 
-        self.latest_error = ''
+        high_water_mark = self._db.get_aggregated_data(WeatherDataModel.WEATHER_DATA_TABLE, ['MAX(id)'], [], None)[0][0]
+
+        with self._db.transaction():
+            self._db.delete_data(DailyReportModel.DAILY_REPORT_TABLE, None)
 
-        report_data = self.aggregate_data()
+            if (engine == DailyReportModel.ENGINE_DATABASE):
+                self.aggregate_data_in_database()
+            else:
+                report_data = self.aggregate_data(chunk_size, workers, fast)
+                self._insert_reports(report_data)
+                self._reports_changed([(None, None)])
 
-        self.insert_multiple(report_data)        
+            self._set_watermark(settled_watermark(self._db, 0, high_water_mark))
+
+        self._invalidate_cached([(None, None)])
         return True
+
+#################################################################################################################
+# The worker process side of DailyReportModel._aggregate_data_parallel: it aggregates the readings of a
+# partition of device_ids, and returns the accumulators. It is a module level function, so that the spawned
+# worker processes can import it.
+#################################################################################################################
+
+def _aggregate_partition(db_config, device_ids, chunk_size, fast=False):
+    daily_report_model = DailyReportModel(db_config)
+    weather_data_model = WeatherDataModel(db_config, daily_report_model._db)
+
+    query_columns_dict = {
+        'device_id': (column_compare['IN'], device_ids)
+    }
+    chunk_size = chunk_size or DailyReportModel.PARTITION_CHUNK_SIZE
+
+    if (fast):
+        scaled_data = {}
+        for batch in weather_data_model.find_all_chunked(chunk_size, DECODE_SCALED, query_columns_dict):
+            daily_report_model._accumulate_scaled(scaled_data, batch)
+        return daily_report_model._unscale(scaled_data)
+
+    agg_data = {}
+    for rows in weather_data_model.find_all_chunked(chunk_size, None, query_columns_dict):
+        daily_report_model._accumulate(agg_data, rows)
+
+    return agg_data
+
+#################################################################################################################
+# A helper function that tells whether a reading value is a finite number - NaN and the infinities (which
+# Decimal and float both accept) would poison the sums, means and extremes of every aggregate they reach.
+#################################################################################################################
+
+def _is_finite(value):
+    if (isinstance(value, Decimal)):
+        return value.is_finite()
+    if (isinstance(value, float)):
+        return math.isfinite(value)
+    return True
+
+#################################################################################################################
+# A function to give the watermark a refresh can safely record, after aggregating the rows up to
+# high_water_mark (the MAX(id) it read) above the previous watermark. It is shared by the daily reports and the
+# rollups (see rollup.py), which both refresh from the weather_data ids above a watermark.
+#
+# AUTO_INCREMENT ids are handed out at insert time, not at commit time: a concurrent ingest transaction that
+# has inserted a row but not committed it yet leaves a gap in the ids the refresh sees, and commits that id
+# later - below MAX(id). So the watermark is held back to just below the first missing id above the previous
+# watermark, and the next refresh scans from there again: the rows after the gap are aggregated twice (which
+# is harmless - a report is always rebuilt from all the readings of its day), and the row that filled the gap
+# is aggregated once it is committed.
+#
+# Ids can also go missing for good (rolled back transactions, the ids that INSERT IGNORE used for duplicates),
+# so the watermark is held back by at most WATERMARK_HOLDBACK ids. A transaction that stays uncommitted while
+# that many more ids are handed out can still have a reading missed.
+#################################################################################################################
+
+def settled_watermark(db, watermark, high_water_mark):
+    if (high_water_mark is None or high_water_mark <= watermark):
+        return watermark
+
+    floor = max(watermark, high_water_mark - WATERMARK_HOLDBACK)
+    table = WeatherDataModel.WEATHER_DATA_TABLE
+
+    if (not db.run_query(f'SELECT id FROM {table} WHERE id = %s', (floor + 1,))):
+        return floor
+
+    result = db.run_query(f'SELECT MIN(id) FROM {table} AS t WHERE id > %s AND id < %s '
+                          f'AND NOT EXISTS (SELECT 1 FROM {table} AS u WHERE u.id = t.id + 1)',
+                          (floor, high_water_mark))
+    if (result and result[0][0] is not None):
+        return result[0][0]
+
+    return high_water_mark
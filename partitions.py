@@ -0,0 +1,257 @@
+import argparse
+import datetime
+import sys
+
+from config import load_db_config
+from database import Database
+from model import WeatherDataModel, column_compare
+from rollup import RollupModel
+
+
+#############################################################################################################
+# The model layer class that manages the monthly partitions of the weather_data table, and its retention.
+#
+# On MySQL, weather_data is partitioned by RANGE COLUMNS (data_timestamp), one partition per month - named
+# pYYYYMM after the month it holds - plus a MAXVALUE partition, pfuture, that catches rows beyond the last
+# month. The model queries bounded in time compare data_timestamp itself, so MySQL only reads the partitions
+# of the months they cover (partition pruning).
+#
+# MySQL requires every unique key of a partitioned table to include the partitioning column, and does not
+# support foreign keys on it: the primary key is (id, data_timestamp), and the device_id foreign key is
+# dropped - WeatherDataModel checks the devices itself before inserting readings (in insert and insert_many).
+#
+# ensure_partitions creates the partitions of the months ahead, so that new readings never fall into
+# pfuture. apply_retention purges the months older than the retention period: each expired partition is first
+# archived into the rollups (see RollupModel.archive), so the long-term summaries and the daily reports
+# survive, and then dropped - which takes the same time however many rows it holds. Run both periodically
+# (python partitions.py maintain), and the size of weather_data stays bounded.
+#
+# SQLite has no partitions: the expired months are archived and deleted a month at a time instead.
+#############################################################################################################
+
+class PartitionModel:
+    FUTURE_PARTITION = 'pfuture'
+    DEFAULT_MONTHS_AHEAD = 3
+
+    PARTITION_BOUND_COL = 1
+
+    def __init__(self, db_config, db=None, months_ahead=DEFAULT_MONTHS_AHEAD, rollup_model=None):
+        self._db_config = db_config
+        self._db = db or Database(db_config)
+        self._months_ahead = months_ahead
+        self._rollup_model = rollup_model or RollupModel(db_config, self._db)
+        self._latest_error = ''
+
+    @property
+    def latest_error(self):
+        return self._latest_error
+
+    @latest_error.setter
+    def latest_error(self, latest_error):
+        self._latest_error = latest_error
+
+#############################################################################################################
+# Helper functions that give the start of the month a timestamp falls in, a month some months later (or
+# earlier), and the name of the partition of a month.
+#############################################################################################################
+
+    @staticmethod
+    def month_start(timestamp):
+        return datetime.datetime(timestamp.year, timestamp.month, 1)
+
+    @staticmethod
+    def add_months(month, count):
+        month_index = month.year * 12 + month.month - 1 + count
+        return datetime.datetime(month_index // 12, month_index % 12 + 1, 1)
+
+    @staticmethod
+    def partition_name(month):
+        return month.strftime('p%Y%m')
+
+    def _partition_clause(self, month):
+        bound = PartitionModel.add_months(month, 1).strftime('%Y-%m-%d %H:%M:%S')
+        return f"PARTITION {PartitionModel.partition_name(month)} VALUES LESS THAN ('{bound}')"
+
+    def _future_clause(self):
+        return f"PARTITION {PartitionModel.FUTURE_PARTITION} VALUES LESS THAN (MAXVALUE)"
+
+    def _oldest_timestamp(self, end=None):
+        query_columns_dict = None
+        if (end is not None):
+            query_columns_dict = {'data_timestamp': (column_compare['LESSER_THAN'], end.strftime('%Y-%m-%d %H:%M:%S'))}
+
+        result = self._db.get_aggregated_data(WeatherDataModel.WEATHER_DATA_TABLE, ['MIN(data_timestamp)'], [],
+                                              query_columns_dict)
+        return result[0][0] if result else None
+
+#############################################################################################################
+# A function to list the partitions of weather_data, as (name, upper bound, approximate row count) tuples in
+# order - the upper bound (exclusive) is None for pfuture. It is empty while the table is not partitioned.
+#############################################################################################################
+
+    def list_partitions(self):
+        return self._db.dialect.list_partitions(self._db, WeatherDataModel.WEATHER_DATA_TABLE)
+
+#############################################################################################################
+# A function to partition the (unpartitioned) weather_data table - one partition per month from the oldest
+# reading to months_ahead months from now. It is run by the schema migrations, and does nothing if the table
+# is partitioned already, or on a backend without partitions.
+#
+# Readings without a timestamp cannot be placed in a partition, and are deleted.
+#############################################################################################################
+
+    def partition_table(self, now=None):
+        if (not self._db.dialect.supports_partitioning or self.list_partitions()):
+            return False
+
+        table = WeatherDataModel.WEATHER_DATA_TABLE
+        now = now or datetime.datetime.now()
+
+        self._db.run_statement(f'DELETE FROM {table} WHERE data_timestamp IS NULL')
+
+        foreign_keys = self._db.run_query('SELECT constraint_name FROM information_schema.referential_constraints '
+                                          'WHERE constraint_schema = DATABASE() AND table_name = %s', (table,))
+        for (constraint_name,) in foreign_keys:
+            self._db.run_statement(f'ALTER TABLE {table} DROP FOREIGN KEY {constraint_name}')
+
+        if (not self._db.dialect.has_index(self._db, table, ['id', 'data_timestamp'], unique=True)):
+            self._db.run_statement(f'ALTER TABLE {table} MODIFY data_timestamp DATETIME NOT NULL, '
+                                   f'DROP PRIMARY KEY, ADD PRIMARY KEY (id, data_timestamp)')
+
+        oldest = self._oldest_timestamp()
+        month = PartitionModel.month_start(oldest or now)
+        last_month = PartitionModel.add_months(PartitionModel.month_start(now), self._months_ahead)
+
+        clauses = []
+        while (month <= last_month):
+            clauses.append(self._partition_clause(month))
+            month = PartitionModel.add_months(month, 1)
+        clauses.append(self._future_clause())
+
+        self._db.run_statement(f'ALTER TABLE {table} PARTITION BY RANGE COLUMNS (data_timestamp) ({", ".join(clauses)})')
+        return True
+
+#############################################################################################################
+# A function to create the partitions of the months up to months_ahead months from now that do not exist yet,
+# by splitting them off pfuture. It returns the names of the partitions created.
+#############################################################################################################
+
+    def ensure_partitions(self, now=None):
+        self.latest_error = ''
+        partitions = self.list_partitions()
+        if (not partitions):
+            return []
+
+        bounds = [partition[PartitionModel.PARTITION_BOUND_COL] for partition in partitions
+                  if partition[PartitionModel.PARTITION_BOUND_COL] is not None]
+        month = max(bounds)
+        last_month = PartitionModel.add_months(PartitionModel.month_start(now or datetime.datetime.now()), self._months_ahead)
+
+        created = []
+        clauses = []
+        while (month <= last_month):
+            clauses.append(self._partition_clause(month))
+            created.append(PartitionModel.partition_name(month))
+            month = PartitionModel.add_months(month, 1)
+
+        if (clauses):
+            clauses.append(self._future_clause())
+            self._db.run_statement(f'ALTER TABLE {WeatherDataModel.WEATHER_DATA_TABLE} REORGANIZE PARTITION '
+                                   f'{PartitionModel.FUTURE_PARTITION} INTO ({", ".join(clauses)})')
+
+        return created
+
+#############################################################################################################
+# A function to purge the readings older than retention_months whole months before the current one - e.g.
+# with 12 months, in October 2026, the readings before October 2025. Each expired month is archived into the
+# rollups, then dropped (deleted on SQLite). It returns a dictionary of the months purged ('YYYY-MM') and the
+# number of (device, hour) rollup buckets archived.
+#
+# A month is only ever purged after it is archived, so an interrupted run is simply run again.
+#############################################################################################################
+
+    def apply_retention(self, retention_months, now=None):
+        self.latest_error = ''
+
+        if (retention_months < 1):
+            self.latest_error = 'The retention period must be at least one month'
+            return False
+
+        cutoff = PartitionModel.add_months(PartitionModel.month_start(now or datetime.datetime.now()), -retention_months)
+        purged = {'months': [], 'archived': 0}
+
+        if (self._db.dialect.supports_partitioning and self.list_partitions()):
+            for partition_name, bound, _ in self.list_partitions():
+                if (bound is None or bound > cutoff):
+                    break
+
+                # The oldest partition also holds any reading older than its month
+
+                purged['archived'] += self._rollup_model.archive(None, bound)
+                self._db.run_statement(f'ALTER TABLE {WeatherDataModel.WEATHER_DATA_TABLE} DROP PARTITION {partition_name}')
+                purged['months'].append(PartitionModel.add_months(bound, -1).strftime('%Y-%m'))
+
+            return purged
+
+        oldest = self._oldest_timestamp(cutoff)
+        month = PartitionModel.month_start(oldest) if oldest is not None else cutoff
+
+        while (month < cutoff):
+            end = PartitionModel.add_months(month, 1)
+            purged['archived'] += self._rollup_model.archive(None, end)
+
+            self._db.delete_data(WeatherDataModel.WEATHER_DATA_TABLE, {
+                'data_timestamp': (column_compare['LESSER_THAN'], end.strftime('%Y-%m-%d %H:%M:%S'))
+            })
+            purged['months'].append(month.strftime('%Y-%m'))
+            month = end
+
+        return purged
+
+#############################################################################################################
+# The command line entry point:
+#   python partitions.py status                                   - list the partitions of weather_data
+#   python partitions.py maintain [--retention-months N] [--months-ahead N] [--sketches]
+#                                                                 - create the partitions ahead, and purge the
+#                                                                   months beyond the retention period
+#############################################################################################################
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Manage the partitions and the retention of weather_data')
+    parser.add_argument('command', choices=['status', 'maintain'])
+    parser.add_argument('--retention-months', type=int, default=None,
+                        help='purge the readings older than this many months (default: keep everything)')
+    parser.add_argument('--months-ahead', type=int, default=PartitionModel.DEFAULT_MONTHS_AHEAD,
+                        help='create the partitions of this many months ahead')
+    parser.add_argument('--sketches', action='store_true', help='archive the quantile sketches of the rollups too')
+    parser.add_argument('--config', default=None,
+                        help='path of the db.json configuration file (default: $WDM_CONFIG, or ../config/db.json)')
+    args = parser.parse_args(args)
+
+    db_config = load_db_config(args.config)
+
+    db = Database(db_config)
+    partition_model = PartitionModel(db_config, db, args.months_ahead, RollupModel(db_config, db, args.sketches))
+
+    if (args.command == 'status'):
+        partitions = partition_model.list_partitions()
+        if (not partitions):
+            print('weather_data is not partitioned')
+        for name, bound, table_rows in partitions:
+            print(f'{name:10} {"MAXVALUE" if bound is None else bound} {table_rows} rows')
+        return 0
+
+    created = partition_model.ensure_partitions()
+    print(f'Created {len(created)} partitions {created}')
+
+    if (args.retention_months is not None):
+        purged = partition_model.apply_retention(args.retention_months)
+        if (purged is False):
+            print(partition_model.latest_error)
+            return 1
+        print(f'Purged {len(purged["months"])} months {purged["months"]} ({purged["archived"]} hourly buckets archived)')
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+import functools
+
+#############################################################################################################
+# The query builder class, used by the database layer to construct SELECT queries (and the WHERE clauses of
+# other statements).
+#
+# A query is built up with chained calls, e.g.
+#   Query('weather_data').select('data_value', 'data_timestamp')
+#                        .where('device_id', '=', 'DT001')
+#                        .where_between('data_timestamp', from_timestamp, to_timestamp)
+#                        .order_by('data_timestamp').limit(100)
+#
+# Any number of predicates can be given for the same column, and they are all ANDed together. Values are
+# always passed as statement parameters (never in the SQL text) - so the SQL text only depends on the shape
+# of the query (the table, columns, predicate operators, ordering, and whether there is a limit). The text
+# is generated once per shape and cached, and the database layer keeps a prepared statement per text.
+#
+# An IN list would give a new shape for every length, so it is padded (with copies of its last value, which
+# match nothing new) to the next power of two - lists of 1 to 512 values share 10 shapes. Longer lists are
+# not padded, so that padding never takes a statement past the parameter limit of the backend.
+#############################################################################################################
+
+class Query:
+    COMPARISONS = ('=', '!=', '<', '>', '<=', '>=')
+    IN_PADDING_LIMIT = 512
+
+    def __init__(self, table):
+        self._table = table
+        self._columns = ()
+        self._predicates = []
+        self._values = []
+        self._order_by = []
+        self._limit = None
+
+    @property
+    def table(self):
+        return self._table
+
+    def select(self, *columns):
+        self._columns = tuple(columns)
+        return self
+
+#############################################################################################################
+# Functions to add predicates to the WHERE clause:
+#   where - a single comparison (=, !=, <, >, <=, >=), or 'IN' with a list of values, or 'BETWEEN' with a
+#           (low, high) tuple - both ends inclusive
+#   where_in, where_between - shorthands for the last two
+#   where_in_query - 'IN' with a subquery (another Query, selecting a single column) instead of a list of values
+#   where_after - a keyset pagination predicate (see below)
+#   where_dict - the query_columns_dict format of the database layer: a dictionary keyed by column name, of
+#                (comparison, value) tuples - or lists of such tuples, for several predicates on a column
+#############################################################################################################
+
+    def where(self, column, compare, value):
+        compare = compare.upper()
+
+        if (compare == 'IN'):
+            value = list(value)
+            if (value):
+                value.extend([value[-1]] * (_padded_length(len(value)) - len(value)))
+            self._predicates.append((column, compare, len(value)))
+            self._values.extend(value)
+        elif (compare == 'BETWEEN'):
+            low, high = value
+            self._predicates.append((column, compare, 2))
+            self._values.extend((low, high))
+        elif (compare in Query.COMPARISONS):
+            self._predicates.append((column, compare, 1))
+            self._values.append(value)
+        else:
+            raise ValueError(f'Unknown comparison {compare} for column {column}')
+
+        return self
+
+    def where_in(self, column, values):
+        return self.where(column, 'IN', values)
+
+    def where_between(self, column, low, high):
+        return self.where(column, 'BETWEEN', (low, high))
+
+    def where_in_query(self, column, query):
+        _, values = query.to_sql()
+        self._predicates.append((column, 'IN_QUERY', query.shape()))
+        self._values.extend(values)
+        return self
+
+#############################################################################################################
+# A function to add a keyset pagination predicate - matching the rows that come strictly after the row with
+# the given (column, tie_column) values, in (column, tie_column) order. It is written as
+#   column >= value AND (column > value OR tie_column > tie_value)
+# so that an index on column can serve it as a range scan.
+#############################################################################################################
+
+    def where_after(self, column, value, tie_column, tie_value):
+        self._predicates.append(((column, tie_column), 'AFTER', 3))
+        self._values.extend((value, value, tie_value))
+        return self
+
+    def where_dict(self, query_columns_dict):
+        if (not query_columns_dict):
+            return self
+
+        for column_name in sorted(query_columns_dict.keys()):
+            predicates = query_columns_dict[column_name]
+            if (isinstance(predicates, tuple)):
+                predicates = [predicates]
+
+            for compare, value in predicates:
+                self.where(column_name, compare, value)
+
+        return self
+
+    def order_by(self, column, descending=False):
+        self._order_by.append((column, descending))
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+#############################################################################################################
+# Functions to get the SQL text and its parameter values - for the whole SELECT query, or for the WHERE
+# clause only (with a leading space, or empty if there are no predicates).
+#############################################################################################################
+
+    def shape(self):
+        return (self._table, self._columns, tuple(self._predicates), tuple(self._order_by), self._limit is not None)
+
+    def to_sql(self):
+        sql = _select_sql(self.shape())
+
+        if (self._limit is not None):
+            return sql, tuple(self._values) + (self._limit,)
+
+        return sql, tuple(self._values)
+
+    def where_clause(self):
+        return _where_sql(tuple(self._predicates)), tuple(self._values)
+
+def _padded_length(count):
+    if (count > Query.IN_PADDING_LIMIT):
+        return count
+
+    return 1 << (count - 1).bit_length()
+
+@functools.lru_cache(maxsize=1024)
+def _where_sql(predicates):
+    if (not predicates):
+        return ''
+
+    selection = []
+    for column, compare, arity in predicates:
+        if (compare == 'AFTER'):
+            column, tie_column = column
+            selection.append(f"{column} >= %s AND ({column} > %s OR {tie_column} > %s)")
+        elif (compare == 'IN'):
+            selection.append(f"{column} IN ({','.join(['%s'] * arity)})")
+        elif (compare == 'IN_QUERY'):
+            # The subquery predicate carries the shape of the subquery in place of an arity
+            selection.append(f"{column} IN ({_select_sql(arity)})")
+        elif (compare == 'BETWEEN'):
+            selection.append(f"{column} BETWEEN %s AND %s")
+        else:
+            selection.append(f"{column} {compare} %s")
+
+    return f" WHERE {' AND '.join(selection)}"
+
+@functools.lru_cache(maxsize=1024)
+def _select_sql(shape):
+    table, columns, predicates, order_by, has_limit = shape
+
+    column_list = ",".join(columns) if columns else "*"
+    sql = f"SELECT {column_list} FROM {table}{_where_sql(predicates)}"
+
+    if (order_by):
+        sql += " ORDER BY " + ",".join([f"{column} DESC" if descending else column for column, descending in order_by])
+
+    if (has_limit):
+        sql += " LIMIT %s"
+
+    return sql
@@ -0,0 +1,288 @@
+import json
+import math
+import os
+import threading
+from collections import deque
+
+from rows import EPOCH, epoch_to_datetime
+
+#############################################################################################################
+# An in-process engine of rolling-window statistics per device - the count, mean, (population) standard
+# deviation, min and max of the readings of the last hour, day, ... of each device - kept up to date as the
+# readings are ingested, so that reading the current statistics of a window takes constant time instead of a
+# range query on weather_data.
+#
+# Each (device, window) keeps:
+#   the readings inside the window, in timestamp order - as they fall out of the window, they are removed
+#   the count, mean and sum of squared deviations (Welford's algorithm), updated when a reading enters or
+#     leaves the window
+#   two monotonic deques, of the readings that can still become the min (increasing values) and the max
+#     (decreasing values) of the window - the min and max are at their fronts
+# so every reading costs O(1) (amortized) per window, however many readings the window holds.
+#
+# A window ends at the latest reading of its device - or at the now passed to stats, which expires the older
+# readings first. Readings must arrive in timestamp order per device: a reading that is not newer than the
+# latest one of its device (a duplicate, or a late arrival) is not added, and is counted as late.
+#
+# Constructor parameters:
+# 1. windows: The window lengths, in seconds (or timedeltas) - the last hour and the last day by default
+# 2. device_windows: An optional dictionary of the window lengths of particular devices, instead of windows
+#
+# The engine is fed by a WeatherDataModel it is attached to (see its rolling_stats property), and can be
+# saved to a snapshot file and restored from it, or warmed up from the database (see warm_up).
+#############################################################################################################
+
+class RollingStats:
+    DEFAULT_WINDOWS = (3600, 86400)
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, windows=DEFAULT_WINDOWS, device_windows=None):
+        self._windows = _window_seconds(windows)
+        self._device_windows = {device_id: _window_seconds(windows) for device_id, windows in (device_windows or {}).items()}
+
+        self._devices = {}
+        self._late = 0
+        self._lock = threading.Lock()
+
+    def windows(self, device_id=None):
+        return list(self._device_windows.get(device_id, self._windows))
+
+    def device_ids(self):
+        with self._lock:
+            return list(self._devices.keys())
+
+#############################################################################################################
+# A function to add a reading of a device (a value, and a datetime timestamp). It returns False if the
+# reading was not added (it is not newer than the latest reading of the device, or has no value).
+#############################################################################################################
+
+    def add(self, device_id, value, timestamp):
+        if (value is None):
+            return False
+
+        seconds = (timestamp - EPOCH).total_seconds()
+
+        with self._lock:
+            device = self._devices.get(device_id)
+            if (device is None):
+                device = self._devices[device_id] = _DeviceWindows(self._device_windows.get(device_id, self._windows))
+
+            if (not device.add(seconds, float(value))):
+                self._late += 1
+                return False
+
+        return True
+
+    def add_many(self, readings):
+        added = 0
+        for device_id, value, timestamp in sorted(readings, key=lambda reading: reading[2]):
+            added += self.add(device_id, value, timestamp)
+
+        return added
+
+    def reset(self, device_id=None):
+        with self._lock:
+            if (device_id is None):
+                self._devices.clear()
+                self._late = 0
+            else:
+                self._devices.pop(device_id, None)
+
+#############################################################################################################
+# A function to get the statistics of a window (in seconds, or a timedelta) of a device - a dictionary of the
+# count, mean, stddev, min and max of its readings, and the timestamp of the latest one. The window ends at
+# now (a datetime) if it is given, and at the latest reading of the device otherwise. It returns None for a
+# device without readings, or a window it does not keep.
+#
+# stats_all gives the statistics of a window for every device, as a dictionary keyed by device_id.
+#############################################################################################################
+
+    def stats(self, device_id, window, now=None):
+        window = _window_seconds([window])[0]
+        now_seconds = None if now is None else (now - EPOCH).total_seconds()
+
+        with self._lock:
+            device = self._devices.get(device_id)
+            if (device is None or window not in device.windows):
+                return None
+
+            return device.windows[window].stats(now_seconds, device.latest)
+
+    def stats_all(self, window, now=None):
+        return {device_id: stats for device_id in self.device_ids()
+                for stats in [self.stats(device_id, window, now)] if stats is not None}
+
+    def counts(self):
+        with self._lock:
+            return {
+                'devices': len(self._devices),
+                'readings': sum(len(window.readings) for device in self._devices.values() for window in device.windows.values()),
+                'late': self._late
+            }
+
+#############################################################################################################
+# Functions to save the engine to a snapshot, and to restore it. A snapshot holds the window configuration,
+# and the readings of the longest window of each device (which hold those of the shorter ones) - restoring
+# replays them, so a restored engine is the same as the one saved. save writes a JSON file atomically (to a
+# temporary file first, renamed over the old snapshot), and load builds an engine from such a file.
+#############################################################################################################
+
+    def snapshot(self):
+        with self._lock:
+            devices = {}
+            for device_id, device in self._devices.items():
+                longest = device.windows[max(device.windows)]
+                devices[device_id] = {
+                    'latest': device.latest,
+                    'readings': [[seconds, value] for seconds, value in longest.readings]
+                }
+
+            return {
+                'version': RollingStats.SNAPSHOT_VERSION,
+                'windows': self._windows,
+                'device_windows': self._device_windows,
+                'late': self._late,
+                'devices': devices
+            }
+
+    @classmethod
+    def restore(cls, snapshot):
+        if (snapshot.get('version') != RollingStats.SNAPSHOT_VERSION):
+            raise ValueError(f'Unsupported rolling statistics snapshot version {snapshot.get("version")}')
+
+        rolling_stats = cls(snapshot['windows'], snapshot['device_windows'])
+        rolling_stats._late = snapshot['late']
+
+        for device_id, data in snapshot['devices'].items():
+            device = _DeviceWindows(rolling_stats.windows(device_id))
+            for seconds, value in data['readings']:
+                device.add(seconds, value)
+            device.latest = data['latest']
+            rolling_stats._devices[device_id] = device
+
+        return rolling_stats
+
+    def save(self, path):
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, 'w') as snapshot_fh:
+            json.dump(self.snapshot(), snapshot_fh, separators=(',', ':'))
+            snapshot_fh.flush()
+            os.fsync(snapshot_fh.fileno())
+
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as snapshot_fh:
+            return cls.restore(json.load(snapshot_fh))
+
+#############################################################################################################
+# A function to warm the engine up from the database, at startup: the readings of the longest window before
+# the latest reading of each device (all the devices of the latest_reading table, or the given device_ids)
+# are read back, page by page, through the given WeatherDataModel. It returns the number of readings added.
+#############################################################################################################
+
+    def warm_up(self, weather_data_model, device_ids=None):
+        added = 0
+
+        for device_id, _, latest_timestamp in weather_data_model.find_latest_by_device_ids(device_ids):
+            self.reset(device_id)
+            start = epoch_to_datetime((latest_timestamp - EPOCH).total_seconds() - max(self.windows(device_id)) + 1)
+
+            for row in weather_data_model.iter_by_device_id(device_id, start):
+                added += self.add(row[1], row[2], row[3])
+
+        return added
+
+#############################################################################################################
+# The windows of one device, and the timestamp (in seconds) of its latest reading.
+#############################################################################################################
+
+class _DeviceWindows:
+
+    def __init__(self, windows):
+        self.windows = {window: _Window(window) for window in windows}
+        self.latest = None
+
+    def add(self, seconds, value):
+        if (self.latest is not None and seconds <= self.latest):
+            return False
+
+        self.latest = seconds
+        for window in self.windows.values():
+            window.add(seconds, value)
+
+        return True
+
+#############################################################################################################
+# One window of one device. A reading at seconds t is in the window ending at e if e - length < t <= e.
+#############################################################################################################
+
+class _Window:
+
+    def __init__(self, length):
+        self.length = length
+        self.readings = deque()
+        self._min_readings = deque()
+        self._max_readings = deque()
+
+        self._count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, seconds, value):
+        self.readings.append((seconds, value))
+
+        self._count += 1
+        delta = value - self._mean
+        self._mean += delta / self._count
+        self._m2 += delta * (value - self._mean)
+
+        while (self._min_readings and self._min_readings[-1][1] >= value):
+            self._min_readings.pop()
+        self._min_readings.append((seconds, value))
+
+        while (self._max_readings and self._max_readings[-1][1] <= value):
+            self._max_readings.pop()
+        self._max_readings.append((seconds, value))
+
+        self._expire(seconds)
+
+    def _expire(self, end):
+        start = end - self.length
+
+        while (self.readings and self.readings[0][0] <= start):
+            _, value = self.readings.popleft()
+
+            self._count -= 1
+            if (self._count == 0):
+                self._mean = 0.0
+                self._m2 = 0.0
+            else:
+                delta = value - self._mean
+                self._mean -= delta / self._count
+                self._m2 = max(self._m2 - delta * (value - self._mean), 0.0)
+
+        while (self._min_readings and self._min_readings[0][0] <= start):
+            self._min_readings.popleft()
+        while (self._max_readings and self._max_readings[0][0] <= start):
+            self._max_readings.popleft()
+
+    def stats(self, now, latest):
+        if (now is not None):
+            self._expire(now)
+
+        if (not self._count):
+            return {'count': 0, 'mean': None, 'stddev': None, 'min': None, 'max': None, 'latest': epoch_to_datetime(latest)}
+
+        return {
+            'count': self._count,
+            'mean': self._mean,
+            'stddev': math.sqrt(self._m2 / self._count),
+            'min': self._min_readings[0][1],
+            'max': self._max_readings[0][1],
+            'latest': epoch_to_datetime(latest)
+        }
+
+def _window_seconds(windows):
+    return [int(window.total_seconds()) if hasattr(window, 'total_seconds') else int(window) for window in windows]
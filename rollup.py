@@ -0,0 +1,451 @@
+import datetime
+import json
+import math
+from decimal import Decimal
+
+from database import Database
+from model import WeatherDataModel, column_compare, settled_watermark
+from query import Query
+
+#############################################################################################################
+# A mergeable sketch of a distribution of values, that answers approximate percentiles.
+#
+# Values are counted in logarithmic buckets (the DDSketch scheme): bucket i holds the values in
+# (gamma^(i-1), gamma^i], with gamma = (1 + alpha) / (1 - alpha), so any percentile is answered within a
+# relative error of alpha. Negative values are counted in mirrored buckets, and zeros separately. Two sketches
+# merge exactly by adding their bucket counts - which is how the coarser rollup levels get their sketches from
+# the finer ones. Sketches are stored as compact JSON text.
+#############################################################################################################
+
+class QuantileSketch:
+    DEFAULT_ALPHA = 0.01
+
+    def __init__(self, alpha=DEFAULT_ALPHA):
+        self._alpha = alpha
+        self._gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self._gamma)
+        self._positive = {}
+        self._negative = {}
+        self._zero_count = 0
+        self._count = 0
+
+    @property
+    def count(self):
+        return self._count
+
+    def add(self, value):
+        value = float(value)
+
+        if (value > 0):
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self._positive[index] = self._positive.get(index, 0) + 1
+        elif (value < 0):
+            index = math.ceil(math.log(-value) / self._log_gamma)
+            self._negative[index] = self._negative.get(index, 0) + 1
+        else:
+            self._zero_count += 1
+
+        self._count += 1
+
+    def merge(self, other):
+        for index, count in other._positive.items():
+            self._positive[index] = self._positive.get(index, 0) + count
+        for index, count in other._negative.items():
+            self._negative[index] = self._negative.get(index, 0) + count
+
+        self._zero_count += other._zero_count
+        self._count += other._count
+
+#############################################################################################################
+# A function to get the approximate value at a percentile (0 to 1) - None for an empty sketch.
+#############################################################################################################
+
+    def percentile(self, fraction):
+        if (not self._count):
+            return None
+
+        rank = fraction * (self._count - 1)
+        seen = 0
+
+        for index in sorted(self._negative.keys(), reverse=True):
+            seen += self._negative[index]
+            if (seen > rank):
+                return -self._bucket_value(index)
+
+        seen += self._zero_count
+        if (seen > rank):
+            return 0.0
+
+        for index in sorted(self._positive.keys()):
+            seen += self._positive[index]
+            if (seen > rank):
+                return self._bucket_value(index)
+
+        return self._bucket_value(max(self._positive.keys()))
+
+    def _bucket_value(self, index):
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def to_json(self):
+        return json.dumps({
+            'a': self._alpha,
+            'p': self._positive,
+            'n': self._negative,
+            'z': self._zero_count
+        }, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+
+        sketch = cls(data['a'])
+        sketch._positive = {int(index): count for index, count in data['p'].items()}
+        sketch._negative = {int(index): count for index, count in data['n'].items()}
+        sketch._zero_count = data['z']
+        sketch._count = sum(sketch._positive.values()) + sum(sketch._negative.values()) + sketch._zero_count
+        return sketch
+
+#############################################################################################################
+# The model layer class that maintains the rollup tables - multi-granularity summaries of the weather_data
+# table, one row per device and time bucket:
+#   rollup_hourly - built from the raw weather_data rows
+#   rollup_daily - built from rollup_hourly
+#   rollup_weekly - built from rollup_daily (weeks start on Monday)
+#   rollup_monthly - built from rollup_daily
+#
+# Each row stores the sample count, the sum and the sum of squares of the values, and the min and max value -
+# all of which merge exactly, so the average and (population) standard deviation over any set of buckets are
+# exact too. A row can also hold a QuantileSketch of its values, for approximate percentiles.
+#
+# The rollups are refreshed incrementally, like the daily reports: only the buckets touched by weather_data
+# rows above the 'rollup' watermark are recomputed - at each level from the level below.
+#############################################################################################################
+
+class RollupModel:
+    HOURLY = 'hourly'
+    DAILY = 'daily'
+    WEEKLY = 'weekly'
+    MONTHLY = 'monthly'
+
+    LEVELS = [HOURLY, DAILY, WEEKLY, MONTHLY]
+
+    ROLLUP_TABLES = {
+        HOURLY: 'rollup_hourly',
+        DAILY: 'rollup_daily',
+        WEEKLY: 'rollup_weekly',
+        MONTHLY: 'rollup_monthly'
+    }
+
+    # The level each level is built from (None - the raw weather_data rows)
+
+    SOURCE_LEVELS = {
+        HOURLY: None,
+        DAILY: HOURLY,
+        WEEKLY: DAILY,
+        MONTHLY: DAILY
+    }
+
+    WATERMARK_TABLE = 'report_watermark'
+    WATERMARK_NAME = 'rollup'
+
+    ROLLUP_COLUMNS = ['device_id', 'bucket_start', 'sample_count', 'value_sum', 'value_sum_sq', 'min_value', 'max_value']
+
+    RU_DEVICE_ID_COL = 0
+    RU_BUCKET_START_COL = 1
+    RU_COUNT_COL = 2
+    RU_SUM_COL = 3
+    RU_SUM_SQ_COL = 4
+    RU_MIN_COL = 5
+    RU_MAX_COL = 6
+    RU_SKETCH_COL = 7
+
+    WD_VALUE_COL = 2
+    WD_TIMESTAMP_COL = 3
+    WM_LAST_ID_COL = 1
+
+    # Touched buckets of a device less than this far apart are recomputed by a single statement
+
+    RUN_GAP = datetime.timedelta(days=1)
+
+    def __init__(self, db_config, db=None, with_sketches=False, sketch_alpha=QuantileSketch.DEFAULT_ALPHA):
+        self._db_config = db_config
+        self._db = db or Database(db_config)
+        self._with_sketches = with_sketches
+        self._sketch_alpha = sketch_alpha
+        self._latest_error = ''
+
+    @property
+    def latest_error(self):
+        return self._latest_error
+
+    @latest_error.setter
+    def latest_error(self, latest_error):
+        self._latest_error = latest_error
+
+#############################################################################################################
+# Helper functions that give the start of the bucket a timestamp falls in, and the start of the next bucket -
+# and the SQL expression of the bucket a source row falls in, in the SQL dialect of the database.
+#############################################################################################################
+
+    @staticmethod
+    def bucket_start(level, timestamp):
+        if (level == RollupModel.HOURLY):
+            return timestamp.replace(minute=0, second=0, microsecond=0)
+
+        day = datetime.datetime(timestamp.year, timestamp.month, timestamp.day)
+        if (level == RollupModel.DAILY):
+            return day
+        if (level == RollupModel.WEEKLY):
+            return day - datetime.timedelta(days=day.weekday())
+        return day.replace(day=1)
+
+    @staticmethod
+    def bucket_end(level, bucket_start):
+        if (level == RollupModel.HOURLY):
+            return bucket_start + datetime.timedelta(hours=1)
+        if (level == RollupModel.DAILY):
+            return bucket_start + datetime.timedelta(days=1)
+        if (level == RollupModel.WEEKLY):
+            return bucket_start + datetime.timedelta(days=7)
+        if (bucket_start.month == 12):
+            return bucket_start.replace(year=bucket_start.year + 1, month=1)
+        return bucket_start.replace(month=bucket_start.month + 1)
+
+    def _bucket_expression(self, level):
+        dialect = self._db.dialect
+
+        if (level == RollupModel.HOURLY):
+            return dialect.hour_start_expression('data_timestamp')
+        if (level == RollupModel.DAILY):
+            return dialect.date_expression('bucket_start')
+        if (level == RollupModel.WEEKLY):
+            return dialect.week_start_expression('bucket_start')
+        return dialect.month_start_expression('bucket_start')
+
+#############################################################################################################
+# A function to refresh the rollups with the weather_data rows added since the last refresh (all of them,
+# the first time). It returns the number of (device, hour) buckets that were touched.
+#
+# The buckets and the new watermark are written in a single transaction, and the watermark is held back below
+# any gap in the ids, like the daily report watermark (see settled_watermark in model.py) - so the readings of
+# ingest transactions still open during the refresh are rolled up by a later one.
+#############################################################################################################
+
+    def refresh(self):
+        self.latest_error = ''
+
+        query_columns_dict = {
+            'name': (column_compare['EQUAL_TO'], RollupModel.WATERMARK_NAME)
+        }
+        result = self._db.get_single_data(RollupModel.WATERMARK_TABLE, query_columns_dict)
+        watermark = result[RollupModel.WM_LAST_ID_COL] if result else 0
+
+        hour_expression = self._bucket_expression(RollupModel.HOURLY)
+        touched = self._db.get_aggregated_data(WeatherDataModel.WEATHER_DATA_TABLE,
+                                               ['device_id', hour_expression, 'MAX(id)'],
+                                               ['device_id', hour_expression],
+                                               {'id': (column_compare['GREATER_THAN'], watermark)})
+        if (not touched):
+            return 0
+
+        with self._db.transaction():
+            self._rebuild_touched(touched)
+
+            self._db.upsert_single_data(RollupModel.WATERMARK_TABLE, {
+                'name': RollupModel.WATERMARK_NAME,
+                'last_id': settled_watermark(self._db, watermark, max(row[2] for row in touched))
+            }, ['last_id'])
+
+        return len(touched)
+
+#############################################################################################################
+# A function to archive the weather_data rows from start (inclusive, None - the oldest row) to end (exclusive)
+# into the rollups, before they are purged (see partitions.py): every (device, hour) bucket with rows in that
+# range is recomputed from them, at every level. Once archived, the range can be summarized from the rollups
+# alone. It returns the number of (device, hour) buckets that were archived.
+#############################################################################################################
+
+    def archive(self, start, end):
+        predicates = [(column_compare['LESSER_THAN'], end.strftime('%Y-%m-%d %H:%M:%S'))]
+        if (start is not None):
+            predicates.insert(0, (column_compare['GREATER_THAN_OR_EQUAL_TO'], start.strftime('%Y-%m-%d %H:%M:%S')))
+
+        hour_expression = self._bucket_expression(RollupModel.HOURLY)
+        touched = self._db.get_aggregated_data(WeatherDataModel.WEATHER_DATA_TABLE,
+                                               ['device_id', hour_expression],
+                                               ['device_id', hour_expression],
+                                               {'data_timestamp': predicates})
+
+        self._rebuild_touched(touched)
+        return len(touched)
+
+    def _rebuild_touched(self, touched):
+        touched_buckets = {}
+        for row in touched:
+            touched_buckets.setdefault(row[0], set()).add(row[1])
+
+        for device_id, hours in touched_buckets.items():
+            self.rebuild(device_id, min(hours), max(hours) + datetime.timedelta(hours=1), hours)
+
+#############################################################################################################
+# A function to recompute the rollups of a device, at every level, for the buckets that overlap the time
+# range from start (inclusive) to end (exclusive). If only some hours of that range changed, they can be
+# given as touched_hours - far apart hours are then recomputed separately, rather than the whole range.
+#############################################################################################################
+
+    def rebuild(self, device_id, start, end, touched_hours=None):
+        if (touched_hours is None):
+            touched_hours = set()
+            hour = RollupModel.bucket_start(RollupModel.HOURLY, start)
+            while (hour < end):
+                touched_hours.add(hour)
+                hour += datetime.timedelta(hours=1)
+
+        touched_buckets = {RollupModel.HOURLY: set(touched_hours)}
+        for level in RollupModel.LEVELS[1:]:
+            touched_buckets[level] = {RollupModel.bucket_start(level, hour) for hour in touched_hours}
+
+        for level in RollupModel.LEVELS:
+            for run_start, run_end in self._runs(level, touched_buckets[level]):
+                self._rebuild_run(level, device_id, run_start, run_end)
+
+    def _runs(self, level, buckets):
+        runs = []
+        for bucket in sorted(buckets):
+            bucket_end = RollupModel.bucket_end(level, bucket)
+            if (runs and bucket - runs[-1][1] <= RollupModel.RUN_GAP):
+                runs[-1][1] = bucket_end
+            else:
+                runs.append([bucket, bucket_end])
+
+        return runs
+
+    def _rebuild_run(self, level, device_id, run_start, run_end):
+        source_level = RollupModel.SOURCE_LEVELS[level]
+        bucket_expression = self._bucket_expression(level)
+
+        if (source_level is None):
+            source_table = WeatherDataModel.WEATHER_DATA_TABLE
+            source_column = 'data_timestamp'
+            aggregates = ['COUNT(data_value)', 'SUM(data_value)', 'SUM(data_value * data_value)',
+                          'MIN(data_value)', 'MAX(data_value)']
+        else:
+            source_table = RollupModel.ROLLUP_TABLES[source_level]
+            source_column = 'bucket_start'
+            aggregates = ['SUM(sample_count)', 'SUM(value_sum)', 'SUM(value_sum_sq)',
+                          'MIN(min_value)', 'MAX(max_value)']
+
+        query_columns_dict = {
+            'device_id': (column_compare['EQUAL_TO'], device_id),
+            source_column: [
+                (column_compare['GREATER_THAN_OR_EQUAL_TO'], run_start.strftime('%Y-%m-%d %H:%M:%S')),
+                (column_compare['LESSER_THAN'], run_end.strftime('%Y-%m-%d %H:%M:%S'))
+            ]
+        }
+
+        self._db.insert_aggregated_data(RollupModel.ROLLUP_TABLES[level], RollupModel.ROLLUP_COLUMNS, source_table,
+                                        ['device_id', bucket_expression] + aggregates,
+                                        ['device_id', bucket_expression],
+                                        query_columns_dict, RollupModel.ROLLUP_COLUMNS[2:])
+
+        if (self._with_sketches):
+            self._rebuild_sketches(level, device_id, run_start, run_end)
+
+#############################################################################################################
+# A helper function that recomputes the sketches of a run of buckets - from the raw values for the hourly
+# level, by merging the sketches of the source level for the others.
+#############################################################################################################
+
+    def _rebuild_sketches(self, level, device_id, run_start, run_end):
+        sketches = {}
+        source_level = RollupModel.SOURCE_LEVELS[level]
+
+        if (source_level is None):
+            weather_data_model = WeatherDataModel(self._db_config, self._db)
+            for row in weather_data_model.iter_by_device_id(device_id, run_start, run_end):
+                value = row[RollupModel.WD_VALUE_COL]
+                if (value is None):
+                    continue
+                bucket = RollupModel.bucket_start(level, row[RollupModel.WD_TIMESTAMP_COL])
+                sketches.setdefault(bucket, QuantileSketch(self._sketch_alpha)).add(value)
+        else:
+            for row in self.find(source_level, device_id, run_start, run_end):
+                if (row[RollupModel.RU_SKETCH_COL] is None):
+                    continue
+                bucket = RollupModel.bucket_start(level, row[RollupModel.RU_BUCKET_START_COL])
+                sketch = sketches.setdefault(bucket, QuantileSketch(self._sketch_alpha))
+                sketch.merge(QuantileSketch.from_json(row[RollupModel.RU_SKETCH_COL]))
+
+        for bucket, sketch in sketches.items():
+            query_columns_dict = {
+                'device_id': (column_compare['EQUAL_TO'], device_id),
+                'bucket_start': (column_compare['EQUAL_TO'], bucket.strftime('%Y-%m-%d %H:%M:%S'))
+            }
+            self._db.update_data(RollupModel.ROLLUP_TABLES[level], {'sketch': sketch.to_json()}, query_columns_dict)
+
+#############################################################################################################
+# A function to retrieve the rollup rows of a device at a level, for the buckets starting from start
+# (inclusive) to end (exclusive), in time order.
+#############################################################################################################
+
+    def find(self, level, device_id, start, end):
+        query_columns_dict = {
+            'device_id': (column_compare['EQUAL_TO'], device_id),
+            'bucket_start': [
+                (column_compare['GREATER_THAN_OR_EQUAL_TO'], start.strftime('%Y-%m-%d %H:%M:%S')),
+                (column_compare['LESSER_THAN'], end.strftime('%Y-%m-%d %H:%M:%S'))
+            ]
+        }
+
+        query = Query(RollupModel.ROLLUP_TABLES[level]).where_dict(query_columns_dict).order_by('bucket_start')
+        return self._db.fetch_all(query)
+
+#############################################################################################################
+# A function to pick the coarsest level whose buckets line up with both ends of a time range - e.g. the
+# monthly level for a whole year, which reads about 12 rows per device.
+#############################################################################################################
+
+    def choose_level(self, start, end):
+        for level in reversed(RollupModel.LEVELS):
+            if (RollupModel.bucket_start(level, start) == start and RollupModel.bucket_start(level, end) == end):
+                return level
+
+        return RollupModel.HOURLY
+
+#############################################################################################################
+# A function to summarize the readings of a device from start (inclusive) to end (exclusive), from the
+# rollups (at the given level, or the one chosen by choose_level). It returns a dictionary of the count,
+# avg, stddev (population), min and max value - and if percentiles (fractions from 0 to 1) are asked for,
+# and the rollups hold sketches, a dictionary of their approximate values.
+#
+# Buckets without values (the hours whose readings are all NULL have a count of 0, and a NULL sum) are left
+# out.
+#############################################################################################################
+
+    def summarize(self, device_id, start, end, level=None, percentiles=()):
+        rows = [row for row in self.find(level or self.choose_level(start, end), device_id, start, end)
+                if row[RollupModel.RU_COUNT_COL] and row[RollupModel.RU_SUM_COL] is not None]
+
+        count = sum(row[RollupModel.RU_COUNT_COL] for row in rows)
+        summary = {'count': count, 'avg': None, 'stddev': None, 'min': None, 'max': None}
+
+        if (count):
+            value_sum = sum(Decimal(row[RollupModel.RU_SUM_COL]) for row in rows)
+            value_sum_sq = sum(Decimal(row[RollupModel.RU_SUM_SQ_COL]) for row in rows)
+            avg = value_sum / count
+            variance = max(value_sum_sq / count - avg * avg, Decimal(0))
+
+            summary['avg'] = avg
+            summary['stddev'] = variance.sqrt()
+            summary['min'] = min(row[RollupModel.RU_MIN_COL] for row in rows if row[RollupModel.RU_MIN_COL] is not None)
+            summary['max'] = max(row[RollupModel.RU_MAX_COL] for row in rows if row[RollupModel.RU_MAX_COL] is not None)
+
+        if (percentiles):
+            sketch = QuantileSketch(self._sketch_alpha)
+            for row in rows:
+                if (row[RollupModel.RU_SKETCH_COL] is not None):
+                    sketch.merge(QuantileSketch.from_json(row[RollupModel.RU_SKETCH_COL]))
+
+            summary['percentiles'] = {fraction: sketch.percentile(fraction) for fraction in percentiles}
+
+        return summary
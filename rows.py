@@ -0,0 +1,164 @@
+import datetime
+from array import array
+from decimal import Decimal
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_DATE = EPOCH.date()
+SECONDS_PER_DAY = 86400
+
+#############################################################################################################
+# The typed row classes of the model layer - one per table, with a named attribute per column instead of
+# the positional tuple items (and the *_COL index constants) of the raw rows.
+#
+# They use __slots__, so a row takes no more memory than the tuple it replaces, and they still behave like
+# that tuple (indexing, unpacking, len, and equality with a tuple of the same values) - so code written for
+# the raw rows keeps working with them.
+#############################################################################################################
+
+class _Row:
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_row(cls, row):
+        if (row is None):
+            return None
+
+        return cls(*row)
+
+    def __getitem__(self, index):
+        if (isinstance(index, slice)):
+            return tuple(self)[index]
+
+        return getattr(self, self.__slots__[index])
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        if (isinstance(other, (_Row, tuple))):
+            return tuple(self) == tuple(other)
+
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class Device(_Row):
+    __slots__ = ('id', 'device_id', 'description', 'device_type', 'manufacturer')
+
+class Reading(_Row):
+    __slots__ = ('id', 'device_id', 'data_value', 'data_timestamp')
+
+class DailyReport(_Row):
+    __slots__ = ('id', 'device_id', 'avg_value', 'min_value', 'max_value', 'report_date')
+
+class LatestReading(_Row):
+    __slots__ = ('device_id', 'data_value', 'data_timestamp')
+
+#############################################################################################################
+# A function to convert a query result - a single raw row, a list of them, or None - to the given row type.
+# A row_type of None leaves the result as it is.
+#############################################################################################################
+
+def as_rows(row_type, result):
+    if (row_type is None or result is None):
+        return result
+    if (isinstance(result, list)):
+        return [row_type(*row) for row in result]
+
+    return row_type(*result)
+
+#############################################################################################################
+# An array-backed batch of weather_data rows - a column per field, instead of a row object per reading:
+#   ids - array of int64
+#   device_ids - list of str (the same string object for every reading of a device)
+#   values - array of int64 scaled integers (DECODE_SCALED - data_value * 100, exact for the DECIMAL(6,2)
+#            column), or array of float64 (DECODE_FLOAT)
+#   timestamps - array of int64 seconds since the epoch (the naive data_timestamp values, taken as UTC)
+# That is about 32 bytes per reading, against about 250 for a tuple holding an int, a Decimal and a datetime.
+#
+# The values and timestamps are converted by the database, in the SELECT list (see 
+# WeatherDataModel.find_all_chunked), so they arrive as plain numbers - no Decimal or datetime object is 
+# ever built for them. Indexing a batch still gives a Reading, converted back.
+#############################################################################################################
+
+DECODE_SCALED = 'scaled'
+DECODE_FLOAT = 'float'
+
+VALUE_DIGITS = 2
+
+class ReadingBatch:
+    __slots__ = ('ids', 'device_ids', 'values', 'timestamps', 'decode')
+
+    def __init__(self, decode=DECODE_SCALED):
+        self.ids = array('q')
+        self.device_ids = []
+        self.values = array('q' if decode == DECODE_SCALED else 'd')
+        self.timestamps = array('q')
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        value = self.values[index]
+        if (self.decode == DECODE_SCALED):
+            value = scaled_to_decimal(value)
+
+        return Reading(self.ids[index], self.device_ids[index], value, epoch_to_datetime(self.timestamps[index]))
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def nbytes(self):
+        return (self.ids.itemsize * len(self.ids) + self.values.itemsize * len(self.values) +
+                self.timestamps.itemsize * len(self.timestamps) + 8 * len(self.device_ids))
+
+#############################################################################################################
+# A function to pack decoded weather_data rows - (id, device_id, value, epoch seconds) tuples, the value
+# already scaled or a float - into a ReadingBatch. Readings with a NULL data_value are skipped, as the 
+# aggregate functions of SQL skip them.
+#############################################################################################################
+
+def decode_readings(rows, decode=DECODE_SCALED):
+    batch = ReadingBatch(decode)
+    device_ids = {}
+
+    ids_append = batch.ids.append
+    device_ids_append = batch.device_ids.append
+    values_append = batch.values.append
+    timestamps_append = batch.timestamps.append
+
+    for id, device_id, value, timestamp in rows:
+        if (value is None):
+            continue
+
+        ids_append(id)
+        device_ids_append(device_ids.setdefault(device_id, device_id))
+        values_append(value)
+        timestamps_append(timestamp)
+
+    return batch
+
+def scaled_to_decimal(value):
+    return Decimal(value).scaleb(-VALUE_DIGITS)
+
+def epoch_to_datetime(seconds):
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+def epoch_day_to_date(day):
+    return EPOCH_DATE + datetime.timedelta(days=day)
@@ -1,12 +1,12 @@
-import random
-from datetime import datetime
-import mysql.connector
+from datetime import datetime, timedelta
 import os
-import json
 
-
-CONFIG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__),'..', 'config'))
-DB_CONFIG_FILE_PATH = os.path.join(CONFIG_PATH, 'db.json')
+from backends import backend_for_config
+from config import CONFIG_PATH, load_db_config
+from database import Database
+from migrations import migrate
+from model import WeatherDataModel
+from data_generator import read_devices, generate_readings, load_rows, DEVICE_COLUMNS, WEATHER_DATA_COLUMNS
 
 DEVICE_TABLE = 'devices'
 WEATHER_DATA_TABLE = 'weather_data'
@@ -16,86 +16,43 @@ DAILY_REPORT_TABLE = 'daily_report'
 # The initial database setup logic - to pre-load the database tables
 #######################################################################################
 
-db_config = {}
-with open(DB_CONFIG_FILE_PATH) as db_fh:
-    db_config = json.load(db_fh)
-
-# Connect to the database by read in the configuration parameters from the JSON config file
-
-db_handle = mysql.connector.connect(
-        user=db_config['username'],
-        password=db_config['password'],
-        host=db_config['host'],
-        port=db_config['port'],
-    )
-
-# Obtain a cursor to execute database queries
-
-mycursor = db_handle.cursor()
-mycursor.execute(f'SHOW DATABASES')
-db_collection = mycursor.fetchall()
-
-# Drop the database if it exists, start from scratch
+def setup_database(db_config):
+    # Drop the database if it exists, and create it afresh - on the storage backend selected by the configuration
+    # (a MySQL server, or an SQLite database file - see backends.py)
 
-for db in db_collection:
-    if db[0] == db_config['db_name']:
-        mycursor.execute(f'DROP DATABASE {db[0]}')
-        break
+    backend_for_config(db_config).create_database(drop_existing=True)
 
-# Create the database afresh
+    # Create the tables, by applying all the schema migrations (see migrations.py, which also upgrades an existing
+    # database in place)
 
-mycursor.execute(f'CREATE DATABASE {db_config["db_name"]}')
-mycursor.execute(f'USE {db_config["db_name"]}')
+    db = Database(db_config)
+    migrate(db)
 
+    # Populate the devices table by reading the devices.csv configuration file, and the weather_data table by
+    # generating randomized data values (hourly, December 1-5 2021) corresponding to the different configured 
+    # devices - both in batches (see data_generator.py, which loads larger datasets)
 
-# Create and populate the devices table by reading the devices.csv configuration file
+    devices = read_devices(os.path.join(CONFIG_PATH, f'{DEVICE_TABLE}.csv'))
 
-mycursor.execute(f'CREATE TABLE devices (id INT NOT NULL AUTO_INCREMENT, device_id VARCHAR(15) NOT NULL UNIQUE, description VARCHAR(127), device_type VARCHAR(31) NOT NULL, manufacturer VARCHAR(63), PRIMARY KEY (id));')
+    load_rows(db, DEVICE_TABLE, DEVICE_COLUMNS, devices)
 
-with open(os.path.join(CONFIG_PATH, f'{DEVICE_TABLE}.csv'), 'r') as device_fh:
-    for row in device_fh:
-            row = row.rstrip()
-            
-            if row:
-                    device_id, desc, type, manufacturer = row.split(',')
-                    
-                    sql = 'INSERT INTO devices (device_id, description, device_type, manufacturer) VALUES (%s, %s, %s, %s)'
-                    val = (device_id, desc, type, manufacturer)
-                    mycursor.execute(sql, val)
+    readings = generate_readings(devices, datetime(2021, 12, 1, 0, 30, 0), datetime(2021, 12, 6, 0, 30, 0), timedelta(hours=1))
+    load_rows(db, WEATHER_DATA_TABLE, WEATHER_DATA_COLUMNS, readings)
 
-                    db_handle.commit()
+    # The bulk load bypasses the model, which keeps the latest_reading table up to date
 
-# Create and populate the weather_data table by generating randomized data values corresponding to different 
-# configured devices
+    WeatherDataModel(db_config, db).rebuild_latest_readings()
 
-mycursor.execute(f'CREATE TABLE weather_data (id INT NOT NULL AUTO_INCREMENT, device_id VARCHAR(31) NOT NULL, data_value DECIMAL(6,2), data_timestamp DATETIME, PRIMARY KEY (id), FOREIGN KEY (device_id) REFERENCES devices(device_id))')
+    # The daily_report table is left empty for now
+    # A trigger to create daily reports will cause aggregation on the weather_data table, populating this table
 
-with open(os.path.join(CONFIG_PATH, f'{DEVICE_TABLE}.csv'), 'r') as device_fh:
-    for row in device_fh:
-        row = row.rstrip()
-        if row:
-            (device_id, _, type, _) = row.split(',')
-
-        for day in range(1,6):
-            for hour in range(0,24):
-                timestamp = datetime(2021, 12, day, hour, 30, 0)
-                
-                value = None
-
-                if (type.lower() == 'temperature'):
-                    value = round(random.normalvariate(24, 2.2), 1)
-                elif (type.lower() == 'humidity'):
-                    value = round(random.normalvariate(45, 3), 1)
-
-                val_timestamp = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-                
-                sql = 'INSERT INTO weather_data (device_id, data_value, data_timestamp) VALUES (%s, %s, %s)'
-                val = (device_id, value, val_timestamp)
-
-                mycursor.execute(sql, val)
-                db_handle.commit()
+#######################################################################################
+# The entry point - the configuration is ../config/db.json, or the one named by the
+# environment (see config.py)
+#######################################################################################
 
-# Create the daily_report table, but leave it empty for now
-# A trigger to create daily reports will cause aggregation on the weather_data table, populating this table
+def main():
+    setup_database(load_db_config())
 
-mycursor.execute(f'CREATE TABLE daily_report (id INT NOT NULL AUTO_INCREMENT, device_id VARCHAR(31) NOT NULL, avg_value DECIMAL(6,2), min_value DECIMAL(6,2), max_value DECIMAL(6,2), report_date DATETIME, PRIMARY KEY (id), FOREIGN KEY (device_id) REFERENCES devices(device_id))')
+if __name__ == '__main__':
+    main()
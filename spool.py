@@ -0,0 +1,406 @@
+import datetime
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from decimal import Decimal
+
+logger = logging.getLogger(__name__)
+
+#######################################################################################
+# A durable local spool of readings - a write-ahead log that ingestion writes to first,
+# so that writers never wait on the database, and no reading is lost while MySQL is
+# slow, restarting, or down for maintenance.
+#
+# The spool is a directory of append-only segment files (0000000000.seg, ...). Each
+# record is a length and a CRC32 checksum followed by the reading, as UTF-8
+#   device_id <tab> value <tab> timestamp
+# A segment is closed, and the next one started, once it grows past segment_size
+# bytes.
+#
+# Durability: appends go straight to the file (no buffering in the process), so a
+# process crash loses nothing. The fsyncs are batched - every fsync_interval seconds
+# a background thread syncs what was written since - so a power loss can lose at most
+# that long of readings. An fsync_interval of 0 syncs on every append instead.
+#
+# A SpoolReplayer drains the spool into weather_data, and records the position up to
+# which the readings were written in the ack file (replaced atomically). Segments that
+# are entirely acknowledged are deleted. After a crash, replay resumes from the
+# acknowledged position - the readings after it may be written twice, which the
+# unique (device_id, data_timestamp) key turns into duplicates that are skipped.
+#
+# A record left half-written by a crash (a torn tail) fails its checksum, and is cut
+# off when the spool is opened again.
+#
+# Readings the database refuses for good are moved to the rejected file of the spool
+# directory - in the same record format, so that they can be inspected, and spooled
+# again once fixed.
+#######################################################################################
+
+class Spool:
+    DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+    DEFAULT_FSYNC_INTERVAL = 0.05
+
+    SEGMENT_SUFFIX = '.seg'
+    ACK_FILE = 'ack'
+    REJECTED_FILE = 'rejected'
+
+    HEADER = struct.Struct('<II')
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, fsync_interval=DEFAULT_FSYNC_INTERVAL):
+        self._directory = directory
+        self._segment_size = segment_size
+        self._fsync_interval = fsync_interval
+
+        os.makedirs(directory, exist_ok=True)
+
+        segment_numbers = self.segment_numbers()
+        if (segment_numbers):
+            self._truncate_torn_tail(segment_numbers[-1])
+            segment_number = segment_numbers[-1]
+        else:
+            segment_number = self.read_ack()[0]
+
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._unsynced = False
+        self._open_segment(segment_number)
+
+        self._sync_thread = None
+        if (fsync_interval):
+            self._sync_thread = threading.Thread(target=self._sync_periodically, name='spool-fsync', daemon=True)
+            self._sync_thread.start()
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def segment_numbers(self):
+        return sorted(int(name[:-len(Spool.SEGMENT_SUFFIX)]) for name in os.listdir(self._directory)
+                      if name.endswith(Spool.SEGMENT_SUFFIX))
+
+    def current_segment(self):
+        return self._segment_number
+
+    def _segment_path(self, segment_number):
+        return os.path.join(self._directory, f'{segment_number:010d}{Spool.SEGMENT_SUFFIX}')
+
+    def _open_segment(self, segment_number):
+        self._segment_number = segment_number
+        self._segment_file = open(self._segment_path(segment_number), 'ab', buffering=0)
+        self._segment_length = self._segment_file.tell()
+
+#######################################################################################
+# Functions to append readings - (device_id, value, timestamp) tuples - to the spool.
+# append_many writes all the records with a single write call.
+#######################################################################################
+
+    def append(self, reading):
+        self.append_many([reading])
+
+    def append_many(self, readings):
+        data = b''.join(_encode_record(reading) for reading in readings)
+        if (not data):
+            return
+
+        with self._lock:
+            if (self._segment_length >= self._segment_size):
+                self._rotate()
+
+            self._segment_file.write(data)
+            self._segment_length += len(data)
+
+            if (self._fsync_interval):
+                self._unsynced = True
+            else:
+                os.fsync(self._segment_file.fileno())
+
+    def _rotate(self):
+        os.fsync(self._segment_file.fileno())
+        self._segment_file.close()
+        self._unsynced = False
+        self._open_segment(self._segment_number + 1)
+
+    def sync(self):
+        with self._lock:
+            if (self._unsynced and not self._segment_file.closed):
+                os.fsync(self._segment_file.fileno())
+                self._unsynced = False
+
+    def _sync_periodically(self):
+        while (not self._closed.wait(self._fsync_interval)):
+            self.sync()
+
+    def close(self):
+        self._closed.set()
+        if (self._sync_thread is not None):
+            self._sync_thread.join()
+
+        self.sync()
+        with self._lock:
+            self._segment_file.close()
+
+#######################################################################################
+# A function to read up to max_records readings, starting from a (segment, offset)
+# position. It returns the readings and the position right after them - the same
+# position, with no readings, when there is nothing new yet.
+#
+# A record that fails its checksum in a closed segment (it can only be corruption of
+# the file) ends that segment: the rest of it is skipped, with a warning.
+#######################################################################################
+
+    def read(self, position, max_records):
+        segment_number, offset = position
+        readings = []
+
+        while (len(readings) < max_records):
+            # The segment is known to be complete only if it was already closed before it is read
+
+            active_segment_number = self._segment_number
+            path = self._segment_path(segment_number)
+            if (not os.path.exists(path)):
+                if (segment_number < active_segment_number):
+                    segment_number, offset = segment_number + 1, 0
+                    continue
+                break
+
+            with open(path, 'rb') as segment_file:
+                while (len(readings) < max_records):
+                    segment_file.seek(offset)
+                    data = segment_file.read(Spool.READ_SIZE)
+
+                    records, consumed, corrupt = _decode_records(data, max_records - len(readings))
+                    readings.extend(records)
+                    offset += consumed
+
+                    if (corrupt or len(data) < Spool.READ_SIZE):
+                        break
+
+            if (len(readings) >= max_records or segment_number >= active_segment_number):
+                break
+
+            # This segment is closed, and was read to its end - carry on with the next one
+
+            if (corrupt or consumed < len(data)):
+                logger.warning('Skipping a corrupt record, and the rest of spool segment %s', path)
+
+            segment_number, offset = segment_number + 1, 0
+
+        return readings, (segment_number, offset)
+
+#######################################################################################
+# Functions to read and record the acknowledged position - the position up to which
+# the readings are safely in the database. Recording a position deletes the segments
+# before it.
+#######################################################################################
+
+    def read_ack(self):
+        try:
+            with open(os.path.join(self._directory, Spool.ACK_FILE)) as ack_fh:
+                ack = json.load(ack_fh)
+                return (ack['segment'], ack['offset'])
+        except FileNotFoundError:
+            return (0, 0)
+
+    def ack(self, position):
+        segment_number, offset = position
+        ack_path = os.path.join(self._directory, Spool.ACK_FILE)
+        temp_path = ack_path + '.tmp'
+
+        with open(temp_path, 'w') as ack_fh:
+            json.dump({'segment': segment_number, 'offset': offset}, ack_fh)
+            ack_fh.flush()
+            os.fsync(ack_fh.fileno())
+        os.replace(temp_path, ack_path)
+
+        for number in self.segment_numbers():
+            if (number >= segment_number):
+                break
+            os.remove(self._segment_path(number))
+
+#######################################################################################
+# Functions to move readings to the rejected file (synced before they are acknowledged),
+# and to read them back.
+#######################################################################################
+
+    def reject(self, readings):
+        with open(os.path.join(self._directory, Spool.REJECTED_FILE), 'ab') as rejected_file:
+            rejected_file.write(b''.join(_encode_record(reading) for reading in readings))
+            rejected_file.flush()
+            os.fsync(rejected_file.fileno())
+
+    def read_rejected(self):
+        try:
+            with open(os.path.join(self._directory, Spool.REJECTED_FILE), 'rb') as rejected_file:
+                data = rejected_file.read()
+        except FileNotFoundError:
+            return []
+
+        return _decode_records(data, None)[0]
+
+    def _truncate_torn_tail(self, segment_number):
+        path = self._segment_path(segment_number)
+        with open(path, 'rb') as segment_file:
+            data = segment_file.read()
+
+        _, consumed, _ = _decode_records(data, None)
+        if (consumed < len(data)):
+            logger.warning('Truncating a torn record at the end of spool segment %s', path)
+            with open(path, 'r+b') as segment_file:
+                segment_file.truncate(consumed)
+                os.fsync(segment_file.fileno())
+
+#######################################################################################
+# The background thread that drains a spool into the weather_data table.
+#
+# It reads up to batch_size readings at a time from the acknowledged position, writes
+# them with WeatherDataModel.insert_many, and acknowledges them. When the write fails
+# with a transient error (the database is unreachable, say - see is_transient_error in
+# backends.py), it retries the same batch, waiting twice as long each time - up to
+# max_retry_interval seconds. Any other error would fail again on every retry, so the
+# batch is moved to the rejected file of the spool instead, and acknowledged - one bad
+# batch does not hold up the rest of the spool. Stopping the replayer leaves whatever
+# was not written yet in the spool, for the next run.
+#######################################################################################
+
+class SpoolReplayer:
+    DEFAULT_BATCH_SIZE = 5000
+    DEFAULT_POLL_INTERVAL = 0.1
+    DEFAULT_MAX_RETRY_INTERVAL = 30
+
+    def __init__(self, spool, weather_data_model, db, batch_size=DEFAULT_BATCH_SIZE, poll_interval=DEFAULT_POLL_INTERVAL,
+                 max_retry_interval=DEFAULT_MAX_RETRY_INTERVAL):
+        self._spool = spool
+        self._weather_data_model = weather_data_model
+        self._db = db
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._max_retry_interval = max_retry_interval
+
+        self._stopping = threading.Event()
+        self._drain_requested = False
+        self._thread = None
+
+        self._counts = {
+            'replayed': 0,
+            'inserted': 0,
+            'duplicate': 0,
+            'rejected': 0,
+            'quarantined': 0,
+            'retries': 0
+        }
+
+    def stats(self):
+        return dict(self._counts)
+
+    def start(self):
+        self._stopping.clear()
+        self._drain_requested = False
+        self._thread = threading.Thread(target=self._run, name='spool-replayer', daemon=True)
+        self._thread.start()
+
+#######################################################################################
+# A function to stop the replayer. With drain set, it first writes out everything
+# already in the spool (as long as the database takes it).
+#######################################################################################
+
+    def stop(self, drain=True):
+        if (drain):
+            self._spool.sync()
+            self._drain_requested = True
+        self._stopping.set()
+
+        if (self._thread is not None):
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        position = self._spool.read_ack()
+
+        while True:
+            readings, next_position = self._spool.read(position, self._batch_size)
+
+            if (not readings):
+                if (next_position != position):
+                    self._spool.ack(next_position)
+                    position = next_position
+                    continue
+                if (self._stopping.is_set()):
+                    return
+                self._stopping.wait(self._poll_interval)
+                continue
+
+            if (self._stopping.is_set() and not self._drain_requested):
+                return
+            if (not self._write(readings)):
+                return
+
+            self._spool.ack(next_position)
+            position = next_position
+
+    def _write(self, readings):
+        retry_interval = self._poll_interval
+
+        while True:
+            try:
+                counts = self._weather_data_model.insert_many(readings, self._batch_size)
+                break
+            except Exception as error:
+                if (not self._db.dialect.is_transient_error(error)):
+                    logger.error('Moved %d spooled readings to the rejected file after an error: %s', len(readings), error)
+                    self._spool.reject(readings)
+                    self._counts['quarantined'] += len(readings)
+                    return True
+
+                self._counts['retries'] += 1
+                logger.warning('Failed to replay %d spooled readings, retrying in %.1fs: %s',
+                               len(readings), retry_interval, error)
+
+                # A stop request gives up on the batch (it stays in the spool) rather than wait for the database
+
+                if (self._stopping.wait(retry_interval)):
+                    return False
+                retry_interval = min(retry_interval * 2, self._max_retry_interval)
+
+        self._counts['replayed'] += len(readings)
+        for name in ('inserted', 'duplicate', 'rejected'):
+            self._counts[name] += counts[name]
+
+        return True
+
+#######################################################################################
+# Helper functions that encode a reading as a record, and decode the records in a
+# chunk of segment data. _decode_records returns the readings, the number of bytes
+# they took, and whether it stopped on a record that fails its checksum (rather than
+# at max_records, or at the end of the data - possibly in the middle of a record).
+#######################################################################################
+
+def _encode_record(reading):
+    device_id, value, timestamp = reading
+    payload = f'{device_id}\t{value}\t{timestamp.isoformat(sep=" ")}'.encode()
+    return Spool.HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+def _decode_records(data, max_records):
+    readings = []
+    offset = 0
+    header_size = Spool.HEADER.size
+
+    while (max_records is None or len(readings) < max_records):
+        if (offset + header_size > len(data)):
+            break
+
+        length, checksum = Spool.HEADER.unpack_from(data, offset)
+        payload = data[offset + header_size:offset + header_size + length]
+        if (len(payload) < length):
+            break
+        if (zlib.crc32(payload) != checksum):
+            return readings, offset, True
+
+        device_id, value, timestamp = payload.decode().split('\t')
+        readings.append((device_id, Decimal(value), datetime.datetime.fromisoformat(timestamp)))
+        offset += header_size + length
+
+    return readings, offset, False
@@ -0,0 +1,41 @@
+import contextlib
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backends import backend_for_config
+from data_generator import load_rows, DEVICE_COLUMNS
+from database import Database
+from migrations import migrate
+
+#######################################################################################
+# The fixtures shared by the tests: a fresh SQLite database in a temporary directory
+# (see backends.py), with all the schema migrations applied, and a few devices.
+#######################################################################################
+
+DEVICES = [
+    ('DT001', 'Temperature Sensor', 'Temperature', 'Acme'),
+    ('DT002', 'Temperature Sensor', 'Temperature', 'Other'),
+    ('DH001', 'Humidity Sensor', 'Humidity', 'Acme')
+]
+
+@pytest.fixture
+def db_config(tmp_path):
+    db_config = {'backend': 'sqlite', 'path': str(tmp_path / 'weather.db')}
+    backend_for_config(db_config).create_database(drop_existing=True)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        migrate(Database(db_config))
+
+    yield db_config
+    backend_for_config(db_config).pool.close_all()
+
+@pytest.fixture
+def db(db_config):
+    db = Database(db_config)
+    load_rows(db, 'devices', DEVICE_COLUMNS, DEVICES)
+    return db
@@ -0,0 +1,44 @@
+import datetime
+import tracemalloc
+
+from data_generator import generate_readings, load_rows, WEATHER_DATA_COLUMNS
+from model import DailyReportModel
+
+from conftest import DEVICES
+
+CHUNK_SIZE = 500
+READINGS = 3000
+
+#######################################################################################
+# The chunked Python report engine streams weather_data, so its memory depends on the
+# chunk size and the number of (device, day) accumulators - not on the number of rows.
+# The readings of the larger table are 10 times denser over the same day, so the
+# accumulators are the same and only the rows grow.
+#######################################################################################
+
+def _aggregation_peak(db_config, db, readings):
+    start = datetime.datetime(2021, 12, 1)
+    interval = datetime.timedelta(seconds=86400 * len(DEVICES) / readings)
+    load_rows(db, 'weather_data', WEATHER_DATA_COLUMNS,
+              generate_readings(DEVICES, start, start + datetime.timedelta(days=1), interval, 1))
+
+    daily_report_model = DailyReportModel(db_config, db)
+
+    tracemalloc.start()
+    try:
+        report_data = daily_report_model.aggregate_data(chunk_size=CHUNK_SIZE)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert len(report_data) == len(DEVICES)
+    return peak
+
+def test_chunked_aggregation_memory_stays_flat(db_config, db):
+    small_peak = _aggregation_peak(db_config, db, READINGS)
+
+    db.delete_data('weather_data', None)
+    large_peak = _aggregation_peak(db_config, db, READINGS * 10)
+
+    assert large_peak < 2 * 2 ** 20
+    assert large_peak < small_peak * 1.5
@@ -0,0 +1,70 @@
+import datetime
+import time
+
+from cache import LRUCache, ReportCache
+from model import DailyReportModel, WeatherDataModel
+
+DAY = datetime.datetime(2021, 12, 1)
+
+def test_lru_evicts_the_least_recently_used_entry():
+    cache = LRUCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+
+    assert cache.get('b') == (False, None)
+    assert cache.get('a') == (True, 1)
+    assert cache.stats()['evictions'] == 1
+
+def test_negative_entries_expire_on_their_own_ttl():
+    cache = LRUCache(ttl=60, negative_ttl=0.01)
+    cache.put('missing', None)
+    assert cache.get('missing') == (True, None)
+
+    time.sleep(0.02)
+    assert cache.get('missing') == (False, None)
+
+def test_report_invalidation_is_precise():
+    cache = ReportCache()
+    cache.put((ReportCache.DATE_KEY, 'DT001', '2021-12-01 00:00:00'), 'one day')
+    cache.put((ReportCache.RANGE_KEY, 'DT001', '2021-12-01 00:00:00', '2021-12-03 00:00:00'), 'three days')
+    cache.put((ReportCache.DATE_KEY, 'DT001', '2021-12-05 00:00:00'), 'other day')
+    cache.put((ReportCache.DATE_KEY, 'DT002', '2021-12-02 00:00:00'), 'other device')
+
+    cache.invalidate_report('DT001', '2021-12-02 00:00:00')
+
+    assert cache.get((ReportCache.DATE_KEY, 'DT001', '2021-12-01 00:00:00')) == (True, 'one day')
+    assert cache.get((ReportCache.RANGE_KEY, 'DT001', '2021-12-01 00:00:00', '2021-12-03 00:00:00'))[0] is False
+    assert cache.get((ReportCache.DATE_KEY, 'DT001', '2021-12-05 00:00:00')) == (True, 'other day')
+    assert cache.get((ReportCache.DATE_KEY, 'DT002', '2021-12-02 00:00:00')) == (True, 'other device')
+
+def test_rows_read_before_an_invalidation_are_not_cached():
+    cache = ReportCache()
+    stamp = cache.stamp()
+    cache.invalidate_report('DT001')
+
+    cache.put((ReportCache.DATE_KEY, 'DT001', '2021-12-01 00:00:00'), 'stale', stamp)
+    assert len(cache) == 0
+
+def test_report_writes_invalidate_the_cached_lookups(db_config, db):
+    WeatherDataModel(db_config, db).insert('DT001', 20, DAY)
+
+    daily_report_model = DailyReportModel(db_config, db, cache=ReportCache(generation_check_interval=0))
+    assert daily_report_model.find_by_device_id_and_date('DT001', DAY) is None
+
+    daily_report_model.create_reports()
+    assert daily_report_model.find_by_device_id_and_date('DT001', DAY) is not None
+
+def test_reports_written_elsewhere_clear_the_cache(db_config, db):
+    weather_data_model = WeatherDataModel(db_config, db)
+    weather_data_model.insert('DT001', 20, DAY)
+
+    cached_model = DailyReportModel(db_config, db, cache=ReportCache(generation_check_interval=0))
+    other_model = DailyReportModel(db_config, db)
+    other_model.create_reports()
+    assert cached_model.find_by_device_id_and_date('DT001', DAY)[2] == 20
+
+    weather_data_model.insert('DT001', 30, DAY + datetime.timedelta(hours=1))
+    other_model.create_reports()
+    assert cached_model.find_by_device_id_and_date('DT001', DAY)[2] == 25
@@ -0,0 +1,52 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+CLI_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'cli.py'))
+PACKAGE_PATH = os.path.dirname(CLI_PATH)
+
+# Generous enough for a loaded CI machine - importing the model layer and its
+# dependencies on --help is what this guards against, not a few milliseconds
+HELP_BUDGET_SECONDS = 2.0
+
+HEAVY_MODULES = ['model', 'numpy', 'mysql.connector']
+
+def _run(arguments, **kwargs):
+    return subprocess.run([sys.executable] + arguments, capture_output=True, text=True, cwd=PACKAGE_PATH, **kwargs)
+
+def test_help_is_fast():
+    start = time.perf_counter()
+    result = _run([CLI_PATH, '--help'])
+    elapsed = time.perf_counter() - start
+
+    assert result.returncode == 0
+    assert 'query' in result.stdout
+    assert elapsed < HELP_BUDGET_SECONDS
+
+def test_help_does_not_import_heavy_modules():
+    script = (
+        'import json, sys\n'
+        'import cli\n'
+        'try:\n'
+        '    cli.main(["--help"])\n'
+        'except SystemExit:\n'
+        '    pass\n'
+        f'print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]), file=sys.stderr)\n'
+    )
+    result = _run(['-c', script])
+
+    assert result.returncode == 0
+    assert json.loads(result.stderr.strip().splitlines()[-1]) == []
+
+def test_query_device_uses_config_variable(db, db_config, tmp_path):
+    config_path = tmp_path / 'db.json'
+    with open(config_path, 'w') as config_fh:
+        json.dump(db_config, config_fh)
+
+    environ = dict(os.environ, WDM_CONFIG=str(config_path))
+    result = _run([CLI_PATH, 'query', 'device', 'DT001'], env=environ)
+
+    assert result.returncode == 0
+    assert json.loads(result.stdout)['device_id'] == 'DT001'
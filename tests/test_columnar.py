@@ -0,0 +1,55 @@
+import datetime
+
+import pytest
+
+from model import DailyReportModel, WeatherDataModel
+
+pytest.importorskip('numpy')
+
+from columnar import ColumnarStore
+
+DAY = datetime.datetime(2021, 12, 1)
+
+def test_store_answers_reading_queries_and_reports_stay_in_the_table(db_config, db):
+    weather_data_model = WeatherDataModel(db_config, db)
+    for hour, value in enumerate([20.5, 22.5, 21.0]):
+        weather_data_model.insert('DT001', value, DAY + datetime.timedelta(hours=hour))
+
+    daily_report_model = DailyReportModel(db_config, db)
+    assert daily_report_model.create_reports()
+    reports = daily_report_model.find_by_device_id_and_date_range('DT001', DAY, DAY)
+
+    store = ColumnarStore(weather_data_model)
+    assert store.load_device('DT001') == 3
+    weather_data_model.columnar_store = store
+
+    weather_data_model.insert('DT001', 30.0, DAY + datetime.timedelta(hours=5))
+
+    aggregate = store.aggregate('DT001', DAY, DAY + datetime.timedelta(days=1))
+    assert aggregate['count'] == 4
+    assert aggregate['max'] == 30.0
+
+    row = weather_data_model.find_by_device_id_and_value('DT001', 22, 25)
+    assert row[2] == 22.5
+
+    assert daily_report_model.find_by_device_id_and_date_range('DT001', DAY, DAY) == reports
+
+def test_inserted_readings_keep_their_ids_and_range_lookups_use_the_store(db_config, db):
+    weather_data_model = WeatherDataModel(db_config, db)
+    weather_data_model.insert('DT001', 20.5, DAY)
+
+    store = ColumnarStore(weather_data_model)
+    store.load_device('DT001')
+    weather_data_model.columnar_store = store
+
+    weather_data_model.insert('DT001', 22.5, DAY + datetime.timedelta(hours=1))
+    weather_data_model.insert_many([('DT001', 24.5, DAY + datetime.timedelta(hours=2)),
+                                    ('DT001', 99.0, DAY)])
+
+    from_database = db.run_query('SELECT id, device_id, data_value, data_timestamp FROM weather_data ORDER BY data_timestamp')
+    rows = list(weather_data_model.iter_by_device_id('DT001', DAY, DAY + datetime.timedelta(days=1)))
+    assert [(row[0], row[2], row[3]) for row in rows] == [(id, float(value), timestamp) for id, _, value, timestamp in from_database]
+    assert weather_data_model.find_by_device_id_and_value('DT001', 22, 23)[0] == from_database[1][0]
+
+    assert weather_data_model.aggregate_by_device_id('DT001', DAY + datetime.timedelta(hours=1))['count'] == 2
+    assert store.load_device('DT001') == 3
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+import config
+from config import load_db_config
+
+def _write_config(path, db_config):
+    with open(path, 'w') as config_fh:
+        json.dump(db_config, config_fh)
+    return str(path)
+
+def test_explicit_path_is_read(tmp_path):
+    path = _write_config(tmp_path / 'db.json', {'backend': 'sqlite', 'path': 'weather.db'})
+    assert load_db_config(path, environ={}) == {'backend': 'sqlite', 'path': 'weather.db'}
+
+def test_config_variable_names_the_file(tmp_path):
+    path = _write_config(tmp_path / 'other.json', {'backend': 'sqlite', 'path': 'other.db'})
+    assert load_db_config(environ={'WDM_CONFIG': path}) == {'backend': 'sqlite', 'path': 'other.db'}
+
+def test_explicit_path_wins_over_config_variable(tmp_path):
+    path = _write_config(tmp_path / 'db.json', {'backend': 'sqlite', 'path': 'explicit.db'})
+    other_path = _write_config(tmp_path / 'other.json', {'backend': 'sqlite', 'path': 'other.db'})
+    assert load_db_config(path, environ={'WDM_CONFIG': other_path})['path'] == 'explicit.db'
+
+def test_environment_overrides_keys_and_coerces_types(tmp_path):
+    path = _write_config(tmp_path / 'db.json', {'backend': 'sqlite', 'path': 'weather.db', 'pool_size': 2})
+    environ = {
+        'WDM_CONFIG': path,
+        'WDM_DB_BACKEND': 'mysql',
+        'WDM_DB_HOST': 'db.internal',
+        'WDM_DB_PORT': '3307',
+        'WDM_DB_USERNAME': 'weather',
+        'WDM_DB_PASSWORD': 'secret',
+        'WDM_DB_NAME': 'weather_data',
+        'WDM_DB_POOL_SIZE': '8'
+    }
+
+    assert load_db_config(environ=environ) == {
+        'backend': 'mysql',
+        'path': 'weather.db',
+        'host': 'db.internal',
+        'port': 3307,
+        'username': 'weather',
+        'password': 'secret',
+        'db_name': 'weather_data',
+        'pool_size': 8
+    }
+
+def test_missing_default_file_uses_environment_only(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DB_CONFIG_FILE_PATH', str(tmp_path / 'missing.json'))
+    environ = {'WDM_DB_BACKEND': 'sqlite', 'WDM_DB_PATH': 'env.db'}
+    assert load_db_config(environ=environ) == {'backend': 'sqlite', 'path': 'env.db'}
+
+def test_missing_named_file_is_an_error(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        load_db_config(environ={'WDM_CONFIG': str(tmp_path / 'missing.json')})
+
+def test_invalid_number_is_an_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DB_CONFIG_FILE_PATH', str(tmp_path / 'missing.json'))
+    with pytest.raises(ValueError):
+        load_db_config(environ={'WDM_DB_PORT': 'not-a-port'})
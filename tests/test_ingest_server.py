@@ -0,0 +1,103 @@
+import asyncio
+import datetime
+import sqlite3
+import time
+from decimal import Decimal
+
+import pytest
+
+from ingest_server import IngestServer
+
+READINGS = [('DT001', Decimal('20.5'), datetime.datetime(2021, 12, 1, hour)) for hour in range(3)]
+
+@pytest.fixture
+def server(db_config, db, monkeypatch):
+    monkeypatch.setattr(IngestServer, 'RETRY_INTERVAL', 0)
+    server = IngestServer(db_config, udp_port=None)
+    yield server
+    server._executor.shutdown(wait=True)
+
+def _write(server, readings):
+    async def write():
+        await server._write_batch(asyncio.get_running_loop(), readings)
+
+    asyncio.run(write())
+
+def _failing(insert_many, errors):
+    def write(readings, batch_size):
+        if (errors):
+            raise errors.pop(0)
+        return insert_many(readings, batch_size)
+
+    return write
+
+def test_transient_errors_are_retried(server, monkeypatch):
+    model = server._weather_data_model
+    errors = [sqlite3.OperationalError('database is locked'), sqlite3.OperationalError('database is locked')]
+    monkeypatch.setattr(model, 'insert_many', _failing(model.insert_many, errors))
+
+    _write(server, READINGS)
+
+    stats = server.stats()
+    assert stats['inserted'] == 3 and stats['retries'] == 2 and stats['failed'] == 0
+
+def test_other_errors_drop_the_batch(server, monkeypatch):
+    model = server._weather_data_model
+    monkeypatch.setattr(model, 'insert_many', _failing(model.insert_many, [sqlite3.IntegrityError('broken')]))
+
+    _write(server, READINGS)
+
+    stats = server.stats()
+    assert stats['inserted'] == 0 and stats['retries'] == 0 and stats['failed'] == 3
+
+def test_non_finite_values_are_malformed(server):
+    lines = [b'DT001,nan,2021-12-01 10:00:00', b'DT001,Infinity,2021-12-01 10:00:00', b'DT001,-inf,2021-12-01 10:00:00',
+             b'DT001,sNaN,2021-12-01 10:00:00', b'DT001,24.5,2021-12-01 10:00:00']
+
+    readings = [server._parse(line) for line in lines]
+
+    assert readings[:4] == [None] * 4
+    assert readings[4] == ('DT001', Decimal('24.5'), datetime.datetime(2021, 12, 1, 10))
+    assert server.stats()['malformed'] == 4
+
+def test_the_readings_of_a_device_stay_in_order_across_writers(db_config, db, tmp_path, monkeypatch):
+    server = IngestServer(db_config, udp_port=None, batch_size=2, flush_interval=0.01, writers=2,
+                          rolling_snapshot=str(tmp_path / 'rolling.json'))
+    model = server._weather_data_model
+    insert_many = model.insert_many
+    calls = []
+
+    # The first batch finishes last - with a single shared queue, the other writer would write the newer
+    # readings of its device first
+
+    def slow_first_batch(readings, batch_size):
+        calls.append(readings)
+        if (len(calls) == 1):
+            time.sleep(0.2)
+        return insert_many(readings, batch_size)
+
+    monkeypatch.setattr(model, 'insert_many', slow_first_batch)
+
+    async def ingest():
+        server._queues = [asyncio.Queue() for _ in range(2)]
+        writer_tasks = [asyncio.create_task(server._write_batches(queue)) for queue in server._queues]
+
+        for hour in range(6):
+            for device_id in ('DT001', 'DH001'):
+                await server._queue_for(device_id).put((device_id, Decimal(20 + hour), datetime.datetime(2021, 12, 1, hour)))
+                await asyncio.sleep(0)
+
+        for queue in server._queues:
+            await queue.join()
+        for task in writer_tasks:
+            task.cancel()
+        await asyncio.gather(*writer_tasks, return_exceptions=True)
+
+    try:
+        asyncio.run(ingest())
+    finally:
+        server._executor.shutdown(wait=True)
+
+    assert server._queue_for('DT001') is not server._queue_for('DH001')
+    assert server.stats()['inserted'] == 12
+    assert server.rolling_stats.counts()['late'] == 0
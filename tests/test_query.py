@@ -0,0 +1,49 @@
+import pytest
+
+from model import WeatherDataModel
+from query import Query
+
+def test_sql_depends_on_the_shape_only():
+    first = Query('weather_data').where('device_id', '=', 'DT001').where_between('data_timestamp', 'a', 'b')
+    second = Query('weather_data').where('device_id', '=', 'DT002').where_between('data_timestamp', 'c', 'd')
+
+    assert first.to_sql()[0] == second.to_sql()[0]
+    assert first.to_sql() == ('SELECT * FROM weather_data WHERE device_id = %s AND data_timestamp BETWEEN %s AND %s',
+                              ('DT001', 'a', 'b'))
+
+def test_select_order_by_and_limit():
+    query = Query('weather_data').select('id', 'data_value').where('id', '>', 5).order_by('id', descending=True).limit(10)
+    assert query.to_sql() == ('SELECT id,data_value FROM weather_data WHERE id > %s ORDER BY id DESC LIMIT %s', (5, 10))
+
+def test_where_after_is_a_keyset_predicate():
+    sql, values = Query('weather_data').where_after('data_timestamp', 't', 'id', 7).where_clause()
+    assert sql == ' WHERE data_timestamp >= %s AND (data_timestamp > %s OR id > %s)'
+    assert values == ('t', 't', 7)
+
+def test_where_dict_orders_columns_and_accepts_several_predicates():
+    query = Query('weather_data').where_dict({'id': [('>', 1), ('<', 9)], 'device_id': ('=', 'DT001')})
+    assert query.where_clause() == (' WHERE device_id = %s AND id > %s AND id < %s', ('DT001', 1, 9))
+
+def test_unknown_comparison_is_rejected():
+    with pytest.raises(ValueError):
+        Query('weather_data').where('id', 'LIKE', 'x')
+
+def test_in_lists_are_padded_to_powers_of_two():
+    texts = {Query('devices').where_in('device_id', [f'D{n}' for n in range(count)]).to_sql()[0]
+             for count in range(1, Query.IN_PADDING_LIMIT + 1)}
+    assert len(texts) == 10
+
+    sql, values = Query('devices').where_in('device_id', ['A', 'B', 'C']).to_sql()
+    assert sql == 'SELECT * FROM devices WHERE device_id IN (%s,%s,%s,%s)'
+    assert values == ('A', 'B', 'C', 'C')
+
+    long_list = list(range(Query.IN_PADDING_LIMIT + 1))
+    assert len(Query('devices').where_in('id', long_list).to_sql()[1]) == len(long_list)
+
+def test_padded_in_lists_match_the_same_rows(db_config, db):
+    weather_data_model = WeatherDataModel(db_config, db)
+    rows = weather_data_model.find_multiple_by_device_ids(['DT001', 'DT002', 'DH001'])
+    assert rows == []
+
+    query = Query('devices').select('device_id').where_in('device_id', ['DT001', 'DT002', 'DH001']).order_by('device_id')
+    assert db.fetch_all(query) == [('DH001',), ('DT001',), ('DT002',)]
@@ -0,0 +1,52 @@
+import datetime
+from decimal import Decimal
+
+from model import DailyReportModel, WeatherDataModel
+
+DAY = datetime.datetime(2021, 12, 1)
+
+def _insert_readings(db_config, db, device_id, values, hour=0):
+    weather_data_model = WeatherDataModel(db_config, db)
+    for offset, value in enumerate(values):
+        assert weather_data_model.insert(device_id, value, DAY + datetime.timedelta(hours=hour + offset)) == 1
+
+def test_refresh_only_rebuilds_touched_reports(db_config, db):
+    _insert_readings(db_config, db, 'DT001', [20, 22])
+    _insert_readings(db_config, db, 'DT002', [10])
+
+    daily_report_model = DailyReportModel(db_config, db)
+    assert daily_report_model.create_reports()
+
+    _insert_readings(db_config, db, 'DT001', [30], hour=5)
+    assert daily_report_model.refresh_reports() == 1
+
+    report = daily_report_model.find_by_device_id_and_date('DT001', DAY)
+    assert report[2:5] == (Decimal('24.00'), Decimal('20'), Decimal('30'))
+
+#######################################################################################
+# A reading whose id was handed out before a refresh, but that was committed after it
+# (a concurrent ingest transaction), is simulated by deleting a row before the refresh
+# and putting it back with the same id afterwards.
+#######################################################################################
+
+def test_refresh_picks_up_ids_committed_late(db_config, db):
+    daily_report_model = DailyReportModel(db_config, db)
+    _insert_readings(db_config, db, 'DT001', [20])
+    assert daily_report_model.create_reports()
+
+    _insert_readings(db_config, db, 'DT001', [21, 40, 23], hour=1)
+    _insert_readings(db_config, db, 'DT002', [10])
+
+    late_id, _, late_value, late_timestamp = db.run_query('SELECT * FROM weather_data WHERE data_value = 40')[0]
+    db.run_statement('DELETE FROM weather_data WHERE id = %s', (late_id,))
+
+    daily_report_model.refresh_reports()
+    assert daily_report_model.get_watermark() == late_id - 1
+
+    db.run_statement('INSERT INTO weather_data (id, device_id, data_value, data_timestamp) VALUES (%s, %s, %s, %s)',
+                     (late_id, 'DT001', late_value, late_timestamp))
+    daily_report_model.refresh_reports()
+
+    report = daily_report_model.find_by_device_id_and_date('DT001', DAY)
+    assert report[4] == Decimal('40')
+    assert daily_report_model.get_watermark() == db.run_query('SELECT MAX(id) FROM weather_data')[0][0]
@@ -0,0 +1,77 @@
+import datetime
+import math
+import random
+
+import pytest
+
+from model import WeatherDataModel
+from rolling import RollingStats
+
+START = datetime.datetime(2021, 12, 1)
+
+def _readings(seed, count=500):
+    rng = random.Random(seed)
+    return [(rng.choice(['DT001', 'DT002']), round(rng.uniform(10, 30), 1), START + datetime.timedelta(seconds=60 * index))
+            for index in range(count)]
+
+def _brute_force(readings, device_id, window):
+    readings = [reading for reading in readings if reading[0] == device_id]
+    end = readings[-1][2]
+    values = [value for _, value, timestamp in readings if timestamp > end - datetime.timedelta(seconds=window)]
+    mean = sum(values) / len(values)
+    return len(values), mean, math.sqrt(sum((value - mean) ** 2 for value in values) / len(values)), min(values), max(values)
+
+def test_window_statistics_match_a_brute_force_computation():
+    readings = _readings(1)
+    rolling_stats = RollingStats(windows=(3600, 6 * 3600))
+    assert rolling_stats.add_many(readings) == len(readings)
+
+    for device_id in ('DT001', 'DT002'):
+        for window in (3600, 6 * 3600):
+            stats = rolling_stats.stats(device_id, window)
+            count, mean, stddev, low, high = _brute_force(readings, device_id, window)
+            assert stats['count'] == count
+            assert math.isclose(stats['mean'], mean) and math.isclose(stats['stddev'], stddev, abs_tol=1e-9)
+            assert (stats['min'], stats['max']) == (low, high)
+
+def test_late_readings_are_counted_and_not_added():
+    rolling_stats = RollingStats()
+    assert rolling_stats.add('DT001', 20, START + datetime.timedelta(minutes=5))
+    assert not rolling_stats.add('DT001', 30, START)
+    assert not rolling_stats.add('DT001', 30, START + datetime.timedelta(minutes=5))
+
+    assert rolling_stats.counts()['late'] == 2
+    assert rolling_stats.stats('DT001', 3600)['count'] == 1
+
+def _assert_same_stats(stats, expected):
+    assert stats.pop('latest') == expected.pop('latest')
+    assert stats == pytest.approx(expected)
+
+def test_a_restored_snapshot_is_the_same_engine(tmp_path):
+    rolling_stats = RollingStats(windows=(600, 3600))
+    rolling_stats.add_many(_readings(2))
+
+    path = str(tmp_path / 'rolling.json')
+    rolling_stats.save(path)
+    restored = RollingStats.load(path)
+
+    now = START + datetime.timedelta(hours=9)
+    for window in (600, 3600):
+        for device_id, stats in rolling_stats.stats_all(window).items():
+            _assert_same_stats(restored.stats(device_id, window), stats)
+            _assert_same_stats(restored.stats(device_id, window, now), rolling_stats.stats(device_id, window, now))
+    assert restored.counts() == rolling_stats.counts()
+
+def test_warm_up_reads_the_longest_window_back(db_config, db):
+    weather_data_model = WeatherDataModel(db_config, db)
+    readings = _readings(3, 200)
+    weather_data_model.insert_many(readings)
+
+    rolling_stats = RollingStats(windows=(3600,))
+    rolling_stats.warm_up(weather_data_model)
+
+    for device_id in ('DT001', 'DT002'):
+        count, mean, _, low, high = _brute_force(readings, device_id, 3600)
+        stats = rolling_stats.stats(device_id, 3600)
+        assert stats['count'] == count and math.isclose(stats['mean'], mean)
+        assert (stats['min'], stats['max']) == (low, high)
@@ -0,0 +1,80 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+
+from model import WeatherDataModel
+from rollup import RollupModel
+
+DAY = datetime.datetime(2021, 12, 1)
+
+def _insert(db, device_id, value, timestamp):
+    db.run_statement('INSERT INTO weather_data (device_id, data_value, data_timestamp) VALUES (%s, %s, %s)',
+                     (device_id, value, timestamp.strftime('%Y-%m-%d %H:%M:%S')))
+
+def test_summaries_merge_the_hourly_buckets(db_config, db):
+    weather_data_model = WeatherDataModel(db_config, db)
+    values = [10, 20, 30, 40]
+    for hour, value in enumerate(values):
+        weather_data_model.insert('DT001', value, DAY + datetime.timedelta(hours=hour, minutes=30))
+
+    rollup_model = RollupModel(db_config, db)
+    assert rollup_model.refresh() == len(values)
+
+    hourly = rollup_model.find(RollupModel.HOURLY, 'DT001', DAY, DAY + datetime.timedelta(days=1))
+    assert [row[RollupModel.RU_BUCKET_START_COL] for row in hourly] == [DAY + datetime.timedelta(hours=hour)
+                                                                        for hour in range(len(values))]
+
+    summary = rollup_model.summarize('DT001', DAY, DAY + datetime.timedelta(days=1))
+    assert summary['count'] == 4
+    assert summary['avg'] == Decimal(25)
+    assert summary['min'] == 10 and summary['max'] == 40
+    assert abs(summary['stddev'] - Decimal('11.1803')) < Decimal('0.001')
+
+def test_hours_without_values_are_left_out(db_config, db):
+    _insert(db, 'DT001', 20, DAY + datetime.timedelta(hours=1))
+    _insert(db, 'DT001', None, DAY + datetime.timedelta(hours=2))
+    _insert(db, 'DT001', 30, DAY + datetime.timedelta(hours=3))
+
+    rollup_model = RollupModel(db_config, db)
+    rollup_model.refresh()
+
+    summary = rollup_model.summarize('DT001', DAY, DAY + datetime.timedelta(hours=6), RollupModel.HOURLY)
+    assert summary['count'] == 2
+    assert summary['avg'] == Decimal(25)
+
+def _watermark(db):
+    return db.run_query("SELECT last_id FROM report_watermark WHERE name = 'rollup'")[0][0]
+
+def test_refresh_picks_up_ids_committed_late(db_config, db):
+    for hour, value in enumerate([10, 20, 30]):
+        _insert(db, 'DT001', value, DAY + datetime.timedelta(hours=hour))
+
+    late_id, _, late_value, late_timestamp = db.run_query('SELECT * FROM weather_data WHERE data_value = 20')[0]
+    db.run_statement('DELETE FROM weather_data WHERE id = %s', (late_id,))
+
+    rollup_model = RollupModel(db_config, db)
+    rollup_model.refresh()
+    assert _watermark(db) == late_id - 1
+
+    db.run_statement('INSERT INTO weather_data (id, device_id, data_value, data_timestamp) VALUES (%s, %s, %s, %s)',
+                     (late_id, 'DT001', late_value, late_timestamp))
+    rollup_model.refresh()
+
+    summary = rollup_model.summarize('DT001', DAY, DAY + datetime.timedelta(days=1), RollupModel.HOURLY)
+    assert summary['count'] == 3
+    assert summary['avg'] == Decimal(20)
+    assert _watermark(db) == db.run_query('SELECT MAX(id) FROM weather_data')[0][0]
+
+def test_failed_watermark_write_rolls_back_the_buckets(db_config, db, monkeypatch):
+    _insert(db, 'DT001', 10, DAY)
+
+    def failing_upsert(*args, **kwargs):
+        raise RuntimeError('watermark write failed')
+
+    monkeypatch.setattr(db, 'upsert_single_data', failing_upsert)
+    rollup_model = RollupModel(db_config, db)
+    with pytest.raises(RuntimeError):
+        rollup_model.refresh()
+
+    assert db.run_query('SELECT COUNT(*) FROM rollup_hourly')[0][0] == 0
@@ -0,0 +1,121 @@
+import datetime
+import os
+import sqlite3
+import time
+from decimal import Decimal
+
+from model import WeatherDataModel
+from spool import Spool, SpoolReplayer
+
+def _readings(count, device_id='DT001'):
+    start = datetime.datetime(2021, 12, 1)
+    return [(device_id, Decimal(f'{20 + index % 10}.5'), start + datetime.timedelta(minutes=index)) for index in range(count)]
+
+def test_readings_round_trip_across_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=256, fsync_interval=0)
+    readings = _readings(40)
+    for reading in readings:
+        spool.append(reading)
+    assert len(spool.segment_numbers()) > 1
+
+    read, position = spool.read(spool.read_ack(), 1000)
+    assert read == readings
+
+    spool.ack(position)
+    assert spool.segment_numbers() == [spool.current_segment()]
+    assert spool.read(spool.read_ack(), 1000) == ([], position)
+    spool.close()
+
+def test_a_torn_tail_is_cut_off_on_open(tmp_path):
+    spool = Spool(str(tmp_path), fsync_interval=0)
+    spool.append_many(_readings(3))
+    spool.close()
+
+    path = os.path.join(str(tmp_path), f'{0:010d}{Spool.SEGMENT_SUFFIX}')
+    size = os.path.getsize(path)
+    with open(path, 'ab') as segment_file:
+        segment_file.write(Spool.HEADER.pack(100, 0) + b'DT001\t2')
+
+    spool = Spool(str(tmp_path), fsync_interval=0)
+    assert os.path.getsize(path) == size
+
+    spool.append_many(_readings(1, 'DT002'))
+    readings, _ = spool.read((0, 0), 100)
+    assert readings == _readings(3) + _readings(1, 'DT002')
+    spool.close()
+
+def test_a_corrupt_record_skips_the_rest_of_its_closed_segment(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=1, fsync_interval=0)
+    for reading in _readings(3):
+        spool.append(reading)
+
+    path = os.path.join(str(tmp_path), f'{1:010d}{Spool.SEGMENT_SUFFIX}')
+    with open(path, 'r+b') as segment_file:
+        segment_file.seek(Spool.HEADER.size)
+        segment_file.write(b'X')
+
+    readings, _ = spool.read((0, 0), 100)
+    assert readings == [_readings(3)[0], _readings(3)[2]]
+    spool.close()
+
+def test_the_replayer_drains_the_spool_into_weather_data(tmp_path, db_config, db):
+    spool = Spool(str(tmp_path / 'spool'), fsync_interval=0)
+    spool.append_many(_readings(50) + _readings(5, 'NOPE'))
+
+    replayer = SpoolReplayer(spool, WeatherDataModel(db_config, db), db, batch_size=20, poll_interval=0.01)
+    replayer.start()
+    replayer.stop(drain=True)
+
+    stats = replayer.stats()
+    assert stats['inserted'] == 50 and stats['rejected'] == 5
+    assert db.run_query('SELECT COUNT(*) FROM weather_data')[0][0] == 50
+    assert spool.read(spool.read_ack(), 100)[0] == []
+    spool.close()
+
+def _failing(insert_many, errors):
+    def write(readings, batch_size):
+        if (errors):
+            raise errors.pop(0)
+        return insert_many(readings, batch_size)
+
+    return write
+
+def test_a_batch_that_keeps_failing_is_moved_to_the_rejected_file(tmp_path, db_config, db, monkeypatch):
+    spool = Spool(str(tmp_path / 'spool'), fsync_interval=0)
+    spool.append_many(_readings(40))
+
+    weather_data_model = WeatherDataModel(db_config, db)
+    errors = [sqlite3.IntegrityError('CHECK constraint failed')]
+    monkeypatch.setattr(weather_data_model, 'insert_many', _failing(weather_data_model.insert_many, errors))
+
+    replayer = SpoolReplayer(spool, weather_data_model, db, batch_size=20, poll_interval=0.01)
+    replayer.start()
+    replayer.stop(drain=True)
+
+    stats = replayer.stats()
+    assert stats['quarantined'] == 20 and stats['inserted'] == 20 and stats['retries'] == 0
+    assert spool.read_rejected() == _readings(40)[:20]
+    assert spool.read(spool.read_ack(), 100)[0] == []
+    spool.close()
+
+def test_transient_errors_are_retried(tmp_path, db_config, db, monkeypatch):
+    spool = Spool(str(tmp_path / 'spool'), fsync_interval=0)
+    spool.append_many(_readings(20))
+
+    weather_data_model = WeatherDataModel(db_config, db)
+    errors = [sqlite3.OperationalError('database is locked')] * 2
+    monkeypatch.setattr(weather_data_model, 'insert_many', _failing(weather_data_model.insert_many, errors))
+
+    # A stop request gives up on a batch that is waiting to be retried, so wait for it to be written first
+
+    replayer = SpoolReplayer(spool, weather_data_model, db, batch_size=20, poll_interval=0.001)
+    replayer.start()
+    deadline = time.monotonic() + 5
+    while (replayer.stats()['inserted'] < 20 and time.monotonic() < deadline):
+        time.sleep(0.01)
+    replayer.stop(drain=True)
+
+    stats = replayer.stats()
+    assert stats['retries'] == 2 and stats['inserted'] == 20 and stats['quarantined'] == 0
+    assert spool.read_rejected() == []
+    spool.close()
@@ -0,0 +1,88 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+
+from data_generator import load_rows, DEVICE_COLUMNS
+from model import DailyReportModel, WeatherDataModel
+from transfer import export_table, import_table
+
+START = datetime.datetime(2021, 12, 1)
+
+@pytest.fixture
+def readings(db_config, db):
+    readings = [(device_id, 20 + hour % 7 + 0.5, START + datetime.timedelta(hours=hour))
+                for device_id in ('DT001', 'DT002', 'DH001') for hour in range(48)]
+    WeatherDataModel(db_config, db).insert_many(readings)
+    return db.run_query('SELECT device_id, data_value, data_timestamp FROM weather_data ORDER BY id')
+
+@pytest.mark.parametrize('file_name', ['readings.csv', 'readings.ndjson.gz', 'readings.wdc.xz', 'readings.csv.bz2'])
+def test_readings_round_trip(tmp_path, db, readings, file_name):
+    path = str(tmp_path / file_name)
+    assert export_table(db, 'weather_data', path, chunk_size=50) == len(readings)
+
+    db.delete_data('weather_data', None)
+    counts = import_table(db, 'weather_data', path, batch_size=40)
+    assert counts == {'inserted': len(readings), 'duplicate': 0, 'rejected': 0}
+    assert db.run_query('SELECT device_id, data_value, data_timestamp FROM weather_data ORDER BY id') == readings
+
+    assert import_table(db, 'weather_data', path)['duplicate'] == len(readings)
+
+def test_exports_are_filtered_by_device_and_time(tmp_path, db, readings):
+    path = str(tmp_path / 'readings.ndjson')
+    exported = export_table(db, 'weather_data', path, device_ids=['DT001'], start=START + datetime.timedelta(hours=10),
+                            end=START + datetime.timedelta(hours=20))
+    assert exported == 10
+
+def test_reports_round_trip(tmp_path, db_config, db, readings):
+    DailyReportModel(db_config, db).create_reports()
+    reports = db.run_query('SELECT device_id, avg_value, min_value, max_value, report_date FROM daily_report ORDER BY id')
+
+    path = str(tmp_path / 'reports.csv')
+    assert export_table(db, 'daily_report', path) == len(reports)
+
+    db.delete_data('daily_report', None)
+    assert import_table(db, 'daily_report', path)['inserted'] == len(reports)
+    assert db.run_query('SELECT device_id, avg_value, min_value, max_value, report_date FROM daily_report ORDER BY id') == reports
+
+def test_csv_fields_are_quoted(tmp_path, db_config, db):
+    load_rows(db, 'devices', DEVICE_COLUMNS, [('DT,"9"', 'Odd Sensor', 'Temperature', 'Acme')])
+    WeatherDataModel(db_config, db).insert_many([('DT,"9"', Decimal('20.5'), START)])
+
+    path = str(tmp_path / 'readings.csv')
+    assert export_table(db, 'weather_data', path) == 1
+
+    db.delete_data('weather_data', None)
+    assert import_table(db, 'weather_data', path)['inserted'] == 1
+    assert db.run_query('SELECT device_id, data_value FROM weather_data') == [('DT,"9"', Decimal('20.5'))]
+
+def test_csv_files_of_other_tools_are_read(tmp_path, db):
+    path = tmp_path / 'readings.csv'
+    path.write_bytes(b'\xef\xbb\xbfdevice_id,data_value,data_timestamp\r\n'
+                     b'"DT001","20.5","2021-12-01 00:00:00"\r\n'
+                     b'DT002,21,2021-12-01 01:00:00\r\n')
+
+    assert import_table(db, 'weather_data', str(path))['inserted'] == 2
+    assert db.run_query('SELECT device_id, data_value FROM weather_data ORDER BY id') == [('DT001', Decimal('20.5')),
+                                                                                        ('DT002', Decimal('21'))]
+
+def test_ndjson_values_are_exact(tmp_path, db_config, db):
+    DailyReportModel(db_config, db).insert_multiple([('DT001', Decimal('0.33'), Decimal('0.1'), Decimal('0.7'),
+                                                      START)])
+
+    path = tmp_path / 'reports.ndjson'
+    export_table(db, 'daily_report', str(path))
+    assert '"avg_value": "0.33"' in path.read_text()
+
+    db.delete_data('daily_report', None)
+    import_table(db, 'daily_report', str(path))
+    assert db.run_query('SELECT avg_value, min_value, max_value FROM daily_report') == [
+        (Decimal('0.33'), Decimal('0.1'), Decimal('0.7'))]
+
+def test_reports_of_unknown_devices_are_rejected(tmp_path, db):
+    path = tmp_path / 'reports.csv'
+    path.write_text('device_id,avg_value,min_value,max_value,report_date\n'
+                    'DT001,20.5,20,21,2021-12-01 00:00:00\n'
+                    'NOPE,20.5,20,21,2021-12-01 00:00:00\n')
+
+    assert import_table(db, 'daily_report', str(path)) == {'inserted': 1, 'duplicate': 0, 'rejected': 1}
@@ -0,0 +1,56 @@
+import datetime
+from decimal import Decimal
+
+from model import WeatherDataModel
+
+DAY = datetime.datetime(2021, 12, 1)
+
+def test_insert_rejects_duplicates_and_unknown_devices(db_config, db):
+    weather_data_model = WeatherDataModel(db_config, db)
+    assert weather_data_model.insert('DT001', 20, DAY) == 1
+
+    assert weather_data_model.insert('DT001', 21, DAY) == -1
+    assert 'already exists' in weather_data_model.latest_error
+
+    assert weather_data_model.insert('NOPE', 21, DAY) == -1
+    assert weather_data_model.latest_error == 'Device id NOPE does not exist'
+    assert db.run_query('SELECT COUNT(*) FROM weather_data')[0][0] == 1
+
+def test_insert_many_counts_duplicates_and_rejects(db_config, db):
+    weather_data_model = WeatherDataModel(db_config, db)
+    readings = [('DT001', Decimal('20.5'), DAY), ('DT001', Decimal('20.5'), DAY), ('NOPE', 1, DAY), ('DT002', 'x', DAY)]
+
+    assert weather_data_model.insert_many(readings) == {'inserted': 1, 'duplicate': 1, 'rejected': 2}
+
+def test_latest_readings_ignore_late_arrivals(db_config, db):
+    weather_data_model = WeatherDataModel(db_config, db)
+    weather_data_model.insert('DT001', 20, DAY + datetime.timedelta(hours=2))
+    weather_data_model.insert_many([('DT001', Decimal(21), DAY), ('DT002', Decimal(22), DAY)])
+
+    latest = weather_data_model.find_latest_by_device_ids(['DT001', 'DT002'])
+    assert [(row[0], row[1]) for row in latest] == [('DT001', Decimal(20)), ('DT002', Decimal(22))]
+
+def test_aggregate_by_device_id_reads_the_window(db_config, db):
+    weather_data_model = WeatherDataModel(db_config, db)
+    for hour, value in enumerate([10, 20, 30, 40]):
+        weather_data_model.insert('DT001', value, DAY + datetime.timedelta(hours=hour))
+
+    aggregate = weather_data_model.aggregate_by_device_id('DT001', DAY + datetime.timedelta(hours=1),
+                                                          DAY + datetime.timedelta(hours=4))
+    assert aggregate['count'] == 3 and aggregate['sum'] == 90.0
+    assert aggregate['mean'] == 30.0 and aggregate['min'] == 20.0 and aggregate['max'] == 40.0
+    assert abs(aggregate['stddev'] - 8.16497) < 1e-4
+
+    assert weather_data_model.aggregate_by_device_id('DT002')['count'] == 0
+
+def test_non_finite_values_are_rejected(db_config, db):
+    weather_data_model = WeatherDataModel(db_config, db)
+    values = [Decimal('NaN'), Decimal('sNaN'), Decimal('Infinity'), Decimal('-Infinity'), float('nan'), float('inf')]
+    readings = [('DT001', value, DAY + datetime.timedelta(hours=hour)) for hour, value in enumerate(values)]
+
+    assert weather_data_model.insert_many(readings + [('DT001', 20.5, DAY)]) == {'inserted': 1, 'duplicate': 0,
+                                                                                 'rejected': len(values)}
+
+    assert weather_data_model.insert('DT002', float('nan'), DAY) == -1
+    assert 'not a finite number' in weather_data_model.latest_error
+    assert db.run_query('SELECT COUNT(*) FROM weather_data')[0][0] == 1
@@ -0,0 +1,547 @@
+import argparse
+import bz2
+import csv
+import datetime
+import gzip
+import io
+import json
+import lzma
+import os
+import queue
+import struct
+import sys
+import threading
+from array import array
+from decimal import Decimal
+
+from config import load_db_config
+from database import Database
+from model import column_compare, DeviceModel, WeatherDataModel, DailyReportModel
+from rows import VALUE_DIGITS, scaled_to_decimal, epoch_to_datetime
+
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+FORMAT_COLUMNAR = 'columnar'
+
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_BATCH_SIZE = 5000
+
+#######################################################################################
+# Streaming bulk export and import of the weather_data and daily_report tables.
+#
+# An export reads the (optionally filtered) rows chunk_size at a time from the
+# database layer's unbuffered cursor, and writes each chunk out before reading the
+# next - memory stays bounded whatever the size of the table. An import reads the file
+# the same way, and feeds the rows to the batched model inserts (insert_many for
+# readings - which checks the devices and skips duplicates - and insert_multiple for
+# reports, skipping the reports that already exist).
+#
+# The rows can be filtered by device and by time range (start inclusive, end
+# exclusive - on data_timestamp, or report_date).
+#
+# The file formats:
+#   csv - a header line with the column names, then one row per line, written and
+#         read with the csv module (quoted fields, CRLF line ends and a UTF-8 BOM
+#         are read too)
+#   ndjson - one JSON object per line, the values as decimal strings (exact - JSON
+#            numbers are read too) and the timestamps as 'YYYY-MM-DD HH:MM:SS' strings
+#   columnar - a compact binary format (see _ColumnarWriter): blocks of rows stored
+#              column by column - the device_ids dictionary encoded, the values as
+#              scaled integers and the timestamps as epoch seconds, converted by the
+#              database itself (as for WeatherDataModel.find_all_chunked)
+#
+# A file name ending in .gz, .bz2 or .xz is compressed (or decompressed) on a
+# background thread, so that compressing overlaps with reading the database (the
+# compressors release the GIL while they work).
+#######################################################################################
+
+TABLES = {
+    WeatherDataModel.WEATHER_DATA_TABLE: {
+        'columns': ['device_id', 'data_value', 'data_timestamp'],
+        'values': ['data_value'],
+        'timestamp': 'data_timestamp'
+    },
+    DailyReportModel.DAILY_REPORT_TABLE: {
+        'columns': ['device_id', 'avg_value', 'min_value', 'max_value', 'report_date'],
+        'values': ['avg_value', 'min_value', 'max_value'],
+        'timestamp': 'report_date'
+    }
+}
+
+COMPRESSION_OPENERS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open
+}
+
+FORMAT_EXTENSIONS = {
+    '.csv': FORMAT_CSV,
+    '.ndjson': FORMAT_NDJSON,
+    '.jsonl': FORMAT_NDJSON,
+    '.wdc': FORMAT_COLUMNAR
+}
+
+#######################################################################################
+# A function to export a table to a file. It returns the number of rows exported.
+#
+# Function parameters:
+# 1. db: The Database to read from
+# 2. table: weather_data or daily_report
+# 3. file_path: The file to write - its extension gives the format (.csv, .ndjson or
+#               .wdc) and the compression (an extra .gz, .bz2 or .xz), unless file_format
+#               is given
+# 4. device_ids: An optional list of the devices to export
+# 5. start, end: An optional time range (datetimes) to export
+#######################################################################################
+
+def export_table(db, table, file_path, file_format=None, device_ids=None, start=None, end=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    spec = TABLES[table]
+    file_format = file_format or _file_format(file_path)
+    query_columns_dict = _filter(spec, device_ids, start, end)
+
+    if (file_format == FORMAT_COLUMNAR):
+        columns = [_projection(db, spec, column) for column in spec['columns']]
+    else:
+        columns = spec['columns']
+
+    exported = 0
+    with _open_output(file_path) as output_fh:
+        writer = _WRITERS[file_format](output_fh, table, spec['columns'])
+
+        for rows in db.get_multiple_data_chunked(table, query_columns_dict, chunk_size, columns):
+            writer.write_rows(rows)
+            exported += len(rows)
+
+        writer.close()
+
+    return exported
+
+#######################################################################################
+# A function to import a file into a table, batch_size rows at a time. It returns a
+# dictionary with the number of rows inserted, skipped as duplicates, and rejected
+# (readings or reports of unknown devices).
+#######################################################################################
+
+def import_table(db, table, file_path, file_format=None, batch_size=DEFAULT_BATCH_SIZE):
+    spec = TABLES[table]
+    file_format = file_format or _file_format(file_path)
+
+    with _open_input(file_path) as input_fh:
+        rows = _READERS[file_format](input_fh, table, spec['columns'])
+
+        if (table == WeatherDataModel.WEATHER_DATA_TABLE):
+            return WeatherDataModel(None, db).insert_many(rows, batch_size)
+
+        counts = {'inserted': 0, 'duplicate': 0, 'rejected': 0}
+        device_model = DeviceModel(None, db)
+        daily_report_model = DailyReportModel(None, db)
+
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if (len(batch) >= batch_size):
+                _import_reports(device_model, daily_report_model, batch, counts)
+                batch = []
+
+        if (batch):
+            _import_reports(device_model, daily_report_model, batch, counts)
+
+        return counts
+
+def _import_reports(device_model, daily_report_model, batch, counts):
+    known_device_ids = device_model.find_existing_device_ids([row[0] for row in batch])
+    reports = [row for row in batch if row[0] in known_device_ids]
+    counts['rejected'] += len(batch) - len(reports)
+
+    if (reports):
+        inserted = daily_report_model.insert_multiple(reports, ignore_duplicates=True)
+        counts['inserted'] += inserted
+        counts['duplicate'] += len(reports) - inserted
+
+#######################################################################################
+# Helper functions that give the format of a file from its name, the filter of an
+# export, and the SELECT expression of a column for the columnar format.
+#######################################################################################
+
+def _file_format(file_path):
+    root, extension = os.path.splitext(file_path)
+    if (extension in COMPRESSION_OPENERS):
+        root, extension = os.path.splitext(root)
+
+    if (extension not in FORMAT_EXTENSIONS):
+        raise ValueError(f'Cannot tell the format of {file_path} - give it explicitly')
+
+    return FORMAT_EXTENSIONS[extension]
+
+def _filter(spec, device_ids, start, end):
+    query_columns_dict = {}
+
+    if (device_ids):
+        query_columns_dict['device_id'] = (column_compare['IN'], list(device_ids))
+
+    timestamp_predicates = []
+    if (start is not None):
+        timestamp_predicates.append((column_compare['GREATER_THAN_OR_EQUAL_TO'], start.strftime('%Y-%m-%d %H:%M:%S')))
+    if (end is not None):
+        timestamp_predicates.append((column_compare['LESSER_THAN'], end.strftime('%Y-%m-%d %H:%M:%S')))
+    if (timestamp_predicates):
+        query_columns_dict[spec['timestamp']] = timestamp_predicates
+
+    return query_columns_dict
+
+def _projection(db, spec, column):
+    if (column in spec['values']):
+        return db.dialect.scaled_integer_expression(column, VALUE_DIGITS)
+    if (column == spec['timestamp']):
+        return db.dialect.epoch_seconds_expression(column)
+
+    return column
+
+#######################################################################################
+# Helper functions that open the file to write or read - through the compressor of its
+# extension, on a background thread, if it has one.
+#######################################################################################
+
+def _open_output(file_path):
+    opener = COMPRESSION_OPENERS.get(os.path.splitext(file_path)[1])
+    if (opener is None):
+        return open(file_path, 'wb')
+
+    return _BackgroundWriter(opener(file_path, 'wb'))
+
+def _open_input(file_path):
+    opener = COMPRESSION_OPENERS.get(os.path.splitext(file_path)[1])
+    if (opener is None):
+        return open(file_path, 'rb')
+
+    return io.BufferedReader(_BackgroundReader(opener(file_path, 'rb')), _BackgroundReader.BLOCK_SIZE)
+
+#######################################################################################
+# A file wrapper that hands the writes over to a background thread, which writes them
+# to the wrapped (compressing) file. The queue between them is bounded, so a slow
+# compressor slows the export down instead of piling up data in memory. A write error
+# of the thread is raised by the next write, or by close.
+#######################################################################################
+
+class _BackgroundWriter:
+    QUEUE_SIZE = 16
+
+    def __init__(self, file_obj):
+        self._file_obj = file_obj
+        self._queue = queue.Queue(maxsize=_BackgroundWriter.QUEUE_SIZE)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='transfer-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                data = self._queue.get()
+                if (data is None):
+                    break
+                if (self._error is None):
+                    self._file_obj.write(data)
+        except BaseException as error:
+            self._error = error
+            while (self._queue.get() is not None):
+                pass
+        finally:
+            self._file_obj.close()
+
+    def write(self, data):
+        if (self._error is not None):
+            raise self._error
+        self._queue.put(bytes(data))
+
+    def close(self):
+        if (self._thread.is_alive()):
+            self._queue.put(None)
+            self._thread.join()
+        if (self._error is not None):
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+#######################################################################################
+# A raw stream that reads its data from a background thread, which reads (and
+# decompresses) the wrapped file BLOCK_SIZE bytes at a time, up to QUEUE_SIZE blocks
+# ahead. It is wrapped in an io.BufferedReader, for readline and read.
+#######################################################################################
+
+class _BackgroundReader(io.RawIOBase):
+    BLOCK_SIZE = 1024 * 1024
+    QUEUE_SIZE = 8
+
+    def __init__(self, file_obj):
+        self._file_obj = file_obj
+        self._queue = queue.Queue(maxsize=_BackgroundReader.QUEUE_SIZE)
+        self._pending = b''
+        self._eof = False
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='transfer-reader', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while (not self._stopping.is_set()):
+                data = self._file_obj.read(_BackgroundReader.BLOCK_SIZE)
+                self._put(data)
+                if (not data):
+                    break
+        except BaseException as error:
+            self._put(error)
+        finally:
+            self._file_obj.close()
+
+    def _put(self, item):
+        while (not self._stopping.is_set()):
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if (not self._pending and not self._eof):
+            item = self._queue.get()
+            if (isinstance(item, BaseException)):
+                raise item
+            self._pending = item
+            self._eof = not item
+
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+    def close(self):
+        self._stopping.set()
+        self._thread.join()
+        super().close()
+
+#######################################################################################
+# The writers and readers of the text formats. The readers give the rows the model
+# inserts take: the device_id, the values as Decimals and the timestamp as a datetime.
+#######################################################################################
+
+class _CsvWriter:
+
+    def __init__(self, output_fh, table, columns):
+        self._output_fh = output_fh
+        self.write_rows([columns])
+
+    def write_rows(self, rows):
+        text = io.StringIO()
+        csv.writer(text, lineterminator='\n').writerows(rows)
+        self._output_fh.write(text.getvalue().encode())
+
+    def close(self):
+        pass
+
+class _NdjsonWriter:
+
+    def __init__(self, output_fh, table, columns):
+        self._output_fh = output_fh
+        self._columns = columns
+
+    def write_rows(self, rows):
+        lines = [json.dumps({column: _json_value(value) for column, value in zip(self._columns, row)}) for row in rows]
+        self._output_fh.write(('\n'.join(lines) + '\n').encode())
+
+    def close(self):
+        pass
+
+def _json_value(value):
+    if (isinstance(value, Decimal)):
+        return str(value)
+    if (isinstance(value, datetime.datetime)):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+
+    return value
+
+def _read_csv(input_fh, table, columns):
+    reader = csv.reader(io.TextIOWrapper(input_fh, encoding='utf-8-sig', newline=''))
+
+    header = next(reader, [])
+    if (header != columns):
+        raise ValueError(f'The CSV columns {header} do not match the {table} columns {columns}')
+
+    for row in reader:
+        if (row):
+            yield _typed_row(row)
+
+def _read_ndjson(input_fh, table, columns):
+    for line in input_fh:
+        if (line.strip()):
+            document = json.loads(line, parse_float=Decimal, parse_int=Decimal)
+            yield _typed_row([document.get(column) for column in columns])
+
+def _typed_row(values):
+    device_id, *values, timestamp = values
+    values = [None if value in (None, '') else Decimal(value) for value in values]
+    return (device_id, *values, datetime.datetime.fromisoformat(timestamp))
+
+#######################################################################################
+# The columnar format. A file is
+#   the magic bytes WDC1, a uint32 header length and a JSON header - the table, and its
+#   columns
+# followed by blocks (one per exported chunk) of
+#   a uint32 row count, then the columns in order, each as a uint32 byte length and
+#   the encoded column:
+#     device_id - a uint32 dictionary length, the distinct device_ids (newline
+#                 separated, UTF-8), and a uint32 array of dictionary indexes
+#     values - an int64 array of the values scaled by 10^VALUE_DIGITS (NULL_VALUE for
+#              NULL)
+#     timestamp - an int64 array of epoch seconds
+# All the integers are little-endian. The values and timestamps come from the
+# database already converted (see _projection) - no Decimal or datetime object is
+# built for them.
+#######################################################################################
+
+COLUMNAR_MAGIC = b'WDC1'
+NULL_VALUE = -2 ** 63
+UINT32 = struct.Struct('<I')
+
+class _ColumnarWriter:
+
+    def __init__(self, output_fh, table, columns):
+        self._output_fh = output_fh
+        header = json.dumps({'table': table, 'columns': columns}).encode()
+        self._output_fh.write(COLUMNAR_MAGIC + UINT32.pack(len(header)) + header)
+
+    def write_rows(self, rows):
+        columns = list(zip(*rows))
+        parts = [UINT32.pack(len(rows))]
+
+        encoded = [_encode_device_ids(columns[0])]
+        encoded.extend(_encode_integers(column) for column in columns[1:])
+        for data in encoded:
+            parts.append(UINT32.pack(len(data)))
+            parts.append(data)
+
+        self._output_fh.write(b''.join(parts))
+
+    def close(self):
+        pass
+
+def _encode_device_ids(device_ids):
+    dictionary = {}
+    indexes = array('I', [dictionary.setdefault(device_id, len(dictionary)) for device_id in device_ids])
+    words = '\n'.join(dictionary).encode()
+
+    return UINT32.pack(len(words)) + words + _little_endian(indexes).tobytes()
+
+def _encode_integers(values):
+    return _little_endian(array('q', [NULL_VALUE if value is None else value for value in values])).tobytes()
+
+def _little_endian(values):
+    if (sys.byteorder == 'big'):
+        values.byteswap()
+    return values
+
+def _read_columnar(input_fh, table, columns):
+    magic = input_fh.read(len(COLUMNAR_MAGIC))
+    if (magic != COLUMNAR_MAGIC):
+        raise ValueError('Not a columnar export file')
+
+    header = json.loads(_read_exactly(input_fh, UINT32.unpack(_read_exactly(input_fh, UINT32.size))[0]))
+    if (header['table'] != table or header['columns'] != columns):
+        raise ValueError(f'The file holds {header["table"]} {header["columns"]}, not {table} {columns}')
+
+    while True:
+        row_count = input_fh.read(UINT32.size)
+        if (not row_count):
+            return
+
+        encoded = [_read_exactly(input_fh, UINT32.unpack(_read_exactly(input_fh, UINT32.size))[0]) for _ in columns]
+
+        device_ids = _decode_device_ids(encoded[0])
+        values = [_decode_integers(data) for data in encoded[1:-1]]
+        timestamps = _decode_integers(encoded[-1])
+
+        for index in range(UINT32.unpack(row_count)[0]):
+            yield (device_ids[index],
+                   *[None if column[index] == NULL_VALUE else scaled_to_decimal(column[index]) for column in values],
+                   epoch_to_datetime(timestamps[index]))
+
+def _decode_device_ids(data):
+    words_length = UINT32.unpack_from(data)[0]
+    dictionary = data[UINT32.size:UINT32.size + words_length].decode().split('\n')
+
+    indexes = array('I')
+    indexes.frombytes(data[UINT32.size + words_length:])
+    return [dictionary[index] for index in _little_endian(indexes)]
+
+def _decode_integers(data):
+    values = array('q')
+    values.frombytes(data)
+    return _little_endian(values)
+
+def _read_exactly(input_fh, size):
+    data = input_fh.read(size)
+    if (len(data) < size):
+        raise ValueError('The columnar export file is truncated')
+    return data
+
+_WRITERS = {
+    FORMAT_CSV: _CsvWriter,
+    FORMAT_NDJSON: _NdjsonWriter,
+    FORMAT_COLUMNAR: _ColumnarWriter
+}
+
+_READERS = {
+    FORMAT_CSV: _read_csv,
+    FORMAT_NDJSON: _read_ndjson,
+    FORMAT_COLUMNAR: _read_columnar
+}
+
+#######################################################################################
+# The command line entry point:
+#   python transfer.py export weather_data readings.csv.gz [--devices DT001,DT002]
+#                             [--start 2021-12-01] [--end 2021-12-06]
+#   python transfer.py import weather_data readings.csv.gz
+#######################################################################################
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Export or import the weather_data and daily_report tables')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('table', choices=sorted(TABLES))
+    parser.add_argument('file', help='file to write or read - .csv, .ndjson or .wdc, optionally with .gz, .bz2 or .xz')
+    parser.add_argument('--format', choices=[FORMAT_CSV, FORMAT_NDJSON, FORMAT_COLUMNAR], default=None,
+                        help='file format (default: from the file extension)')
+    parser.add_argument('--devices', default=None, help='comma separated device_ids to export (default: all)')
+    parser.add_argument('--start', type=datetime.datetime.fromisoformat, default=None,
+                        help='export the rows from this time on, ISO format')
+    parser.add_argument('--end', type=datetime.datetime.fromisoformat, default=None,
+                        help='export the rows before this time, ISO format')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='rows read from the database at a time')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='rows inserted at a time')
+    parser.add_argument('--config', default=None,
+                        help='path of the db.json configuration file (default: $WDM_CONFIG, or ../config/db.json)')
+    args = parser.parse_args(args)
+
+    db_config = load_db_config(args.config)
+
+    db = Database(db_config)
+
+    if (args.command == 'export'):
+        device_ids = args.devices.split(',') if args.devices else None
+        exported = export_table(db, args.table, args.file, args.format, device_ids, args.start, args.end, args.chunk_size)
+        print(f'Exported {exported} rows of {args.table} to {args.file}')
+        return 0
+
+    counts = import_table(db, args.table, args.file, args.format, args.batch_size)
+    print(f'Imported {args.file} into {args.table}: {counts}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())